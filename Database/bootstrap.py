@@ -0,0 +1,174 @@
+import asyncio
+from time import perf_counter
+from typing import Set
+
+import asyncpg
+
+from db_operations.resources import startup_timer
+from config import (
+    DB_MODE, DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD,
+    DB_READY_TIMEOUT, DB_READY_MAX_DELAY
+)
+
+CONTAINER_NAME = "pgvector_db"
+IMAGE_NAME = "agent/pgvector"
+
+# Расширения, без которых бот не работает, и те, что создаются только если доступны на сервере
+REQUIRED_EXTENSIONS = ("vector", "pg_trgm")
+OPTIONAL_EXTENSIONS = ("plpython3u",)
+
+READY_FIRST_DELAY = 0.05  # Первая пауза между попытками подключения, секунд (дальше растёт вдвое)
+READY_CONNECT_TIMEOUT = 2.0  # Таймаут одной попытки подключения, секунд
+
+# Ошибки, при которых ждать бессмысленно: неверные логин, пароль или права
+FATAL_CONNECT_ERRORS = (
+    asyncpg.InvalidPasswordError,
+    asyncpg.InvalidAuthorizationSpecificationError,
+)
+
+
+def setup_docker_container() -> None:
+    """
+    Запускает контейнер pgvector (создаёт при первом запуске).
+
+    Готовности PostgreSQL здесь не ждём: это делает wait_for_postgres,
+    которая возвращает управление, как только сервер начал принимать подключения.
+    """
+    # docker нужен только в режиме DB_MODE = "docker"
+    import docker
+
+    try:
+        client = docker.from_env()
+        client.ping()
+
+        try:
+            client.images.get(IMAGE_NAME)
+        except docker.errors.ImageNotFound:
+            raise RuntimeError(
+                f"Образ {IMAGE_NAME} не найден. Сначала соберите его используя:\n"
+                f"docker build -t {IMAGE_NAME} ."
+            )
+
+        try:
+            container = client.containers.get(CONTAINER_NAME)
+            if container.status != "running":
+                container.start()
+                print(f"Контейнер {CONTAINER_NAME} запущен")
+            else:
+                print(f"Контейнер {CONTAINER_NAME} уже запущен")
+            return
+        except docker.errors.NotFound:
+            pass
+
+        print(f"Создаём новый контейнер из образа {IMAGE_NAME}...")
+        container = client.containers.run(
+            IMAGE_NAME,
+            name=CONTAINER_NAME,
+            environment={
+                "POSTGRES_USER": DB_USER,
+                "POSTGRES_PASSWORD": DB_PASSWORD,
+                "POSTGRES_DB": DB_NAME
+            },
+            ports={'5432/tcp': DB_PORT},
+            detach=True,
+            volumes={
+                'pgdata': {'bind': '/var/lib/postgresql/data', 'mode': 'rw'}
+            }
+        )
+        print(f"Контейнер {container.id} создан и запущен")
+
+    except docker.errors.DockerException as e:
+        print(f"Ошибка Docker: {e}")
+        print("Убедитесь, что Docker Desktop установлен и запущен, или укажите DB_MODE = \"external\" в config.py")
+        raise
+
+
+async def _connect() -> asyncpg.Connection:
+    return await asyncpg.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_NAME,
+        timeout=READY_CONNECT_TIMEOUT
+    )
+
+
+async def wait_for_postgres(timeout: float = DB_READY_TIMEOUT, max_delay: float = DB_READY_MAX_DELAY) -> asyncpg.Connection:
+    """
+    Ждёт, пока PostgreSQL начнёт принимать подключения; возвращает открытое соединение.
+
+    Паузы между попытками растут от READY_FIRST_DELAY вдвое до max_delay,
+    поэтому уже работающий сервер отвечает с первой попытки, а только что
+    запущенный контейнер — вскоре после готовности, без фиксированных ожиданий.
+    """
+    started = perf_counter()
+    deadline = started + timeout
+    delay = READY_FIRST_DELAY
+    attempt = 0
+    while True:
+        attempt += 1
+        conn = None
+        try:
+            conn = await _connect()
+            await conn.fetchval("SELECT 1")
+        except FATAL_CONNECT_ERRORS:
+            raise
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            if conn is not None:
+                conn.terminate()
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                raise RuntimeError(
+                    f"PostgreSQL на {DB_HOST}:{DB_PORT} не стал доступен за {timeout:g} с: {e}"
+                ) from e
+            if attempt == 1:
+                print(f"PostgreSQL ещё не готов ({type(e).__name__}), ждём...")
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+            continue
+        print(f"PostgreSQL готов через {perf_counter() - started:.2f} с (попыток: {attempt})")
+        return conn
+
+
+async def ensure_extensions(conn: asyncpg.Connection) -> None:
+    """Создаёт только отсутствующие расширения; необязательные — если они установлены на сервере"""
+    installed: Set[str] = {row["extname"] for row in await conn.fetch("SELECT extname FROM pg_extension")}
+    missing = [name for name in REQUIRED_EXTENSIONS + OPTIONAL_EXTENSIONS if name not in installed]
+    if not missing:
+        return
+
+    available: Set[str] = {
+        row["name"] for row in await conn.fetch("SELECT name FROM pg_available_extensions")
+    }
+    for name in missing:
+        if name not in available:
+            if name in REQUIRED_EXTENSIONS:
+                raise RuntimeError(f"Расширение {name} не установлено на сервере PostgreSQL")
+            print(f"Расширение {name} недоступно на сервере, пропускаем")
+            continue
+        await conn.execute(f"CREATE EXTENSION IF NOT EXISTS {name}")
+        print(f"Расширение {name} создано")
+
+
+async def bootstrap_database() -> None:
+    """
+    Готовит PostgreSQL к работе: контейнер (DB_MODE = "docker"), ожидание готовности, расширения.
+
+    В режиме "external" Docker не используется: бот подключается к уже
+    работающему серверу (например, управляемому PostgreSQL).
+    """
+    if DB_MODE == "docker":
+        with startup_timer.phase("db.docker"):
+            # Docker SDK синхронный — выполняем в потоке, не блокируя event loop
+            await asyncio.to_thread(setup_docker_container)
+    elif DB_MODE != "external":
+        raise ValueError(f"Неизвестный DB_MODE: {DB_MODE!r} (ожидается \"docker\" или \"external\")")
+
+    with startup_timer.phase("db.ready"):
+        conn = await wait_for_postgres()
+    try:
+        with startup_timer.phase("db.extensions"):
+            await ensure_extensions(conn)
+    finally:
+        await conn.close()
@@ -1,30 +1,30 @@
 import os
-from sqlalchemy import Column, Integer, String, ForeignKey, Text, Float, Date, Time
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Text, Float, Date, Time, DateTime
 from sqlalchemy.dialects.postgresql import ARRAY
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.sql import text
-from sqlalchemy import select, func
+from sqlalchemy import select, func, literal, or_
 from pgvector.sqlalchemy import Vector
-import docker
-import time
-import psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 import numpy as np
-from typing import List, Tuple
+from typing import List, Tuple, NamedTuple
 
-# Конфигурация базы данных
-DB_NAME = "vector_db"
-DB_USER = "postgres"
-DB_PASSWORD = "postgres"
-DB_HOST = "localhost"
-DB_PORT = 5432
-CONTAINER_NAME = "pgvector_db"
-IMAGE_NAME = "agent/pgvector"
+from Database.migrations import apply_migrations
+from Database.bootstrap import bootstrap_database
+from Database.pools import DatabasePools, create_pooled_engine, INTERACTIVE_POOL, INGESTION_POOL
+from db_operations.resources import startup_timer
+from config import (
+    DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_INGESTION_POOL_SIZE, DB_INGESTION_MAX_OVERFLOW,
+    DB_STATEMENT_TIMEOUT_MS, DB_INGESTION_STATEMENT_TIMEOUT_MS
+)
 
 # Настраиваем SQLAlchemy
 Base = declarative_base()
 
+# Таблицы, которые создают и изменяют версионные миграции (Database/migrations.py), а не create_all
+MIGRATED_TABLES = {'ingestion_jobs', 'imported_transcripts'}
+
 class User(Base):
     __tablename__ = 'users'
     
@@ -52,12 +52,57 @@ class Message(Base):
     processed_text = Column(Text, nullable=True)
     embeddings = Column(Vector(768), nullable=True)
 
+class IngestionJob(Base):
+    """
+    Фоновая загрузка файла разговора: статус (queued/running/done/failed), прогресс и ошибка.
+    
+    worker_id и heartbeat_at — аренда выполняемой задачи: экземпляр бота,
+    который её выполняет, и время его последнего подтверждения.
+    Таблица создаётся миграцией 6.
+    """
+    __tablename__ = 'ingestion_jobs'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(BigInteger, nullable=False)
+    owner_id = Column(BigInteger, nullable=False)
+    file_name = Column(String, nullable=False)
+    file_path = Column(String, nullable=False)
+    conversation_date = Column(String, nullable=False)
+    conversation_time = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='queued')
+    turns_total = Column(Integer, nullable=False, default=0)
+    turns_done = Column(Integer, nullable=False, default=0)
+    conversation_id = Column(Integer, nullable=True)
+    progress_message_id = Column(BigInteger, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    worker_id = Column(String, nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+
+class ImportedTranscript(Base):
+    """Файл транскрипта, уже загруженный пакетным импортом (по SHA-256 содержимого). Таблица создаётся миграцией 7"""
+    __tablename__ = 'imported_transcripts'
+    
+    sha256 = Column(String(64), primary_key=True)
+    file_name = Column(String, nullable=False)
+    conversation_id = Column(Integer, ForeignKey('conversation.id'), nullable=False)
+    imported_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class SearchHit(NamedTuple):
+    """Результат поиска: (id сообщения, текст, обработанный текст, оценка)"""
+    id: int
+    text: str
+    processed_text: str
+    score: float
+
 async def find_similar_messages(
     session: AsyncSession,
     embedding: List[float],
     threshold: float = 0.3,
     limit: int = 3
-) -> List[Tuple[str, str, float]]:
+) -> List[Tuple[int, str, str, float]]:
     """
     Ищет похожие сообщения в БД по косинусной близости векторов.
     
@@ -68,7 +113,7 @@ async def find_similar_messages(
         limit: Максимальное количество результатов
     
     Returns:
-        Список кортежей (текст, обработанный текст, оценка сходства)
+        Список кортежей (id сообщения, текст, обработанный текст, оценка сходства)
     """
     # query = (
     #     select(
@@ -85,6 +130,7 @@ async def find_similar_messages(
     
     query = (
         select(
+            Message.id,
             Message.text,
             Message.processed_text,
             (1 - func.cast(Message.embeddings.cosine_distance(embedding), Float)).label("score")
@@ -97,6 +143,50 @@ async def find_similar_messages(
     result = await session.execute(query)
     return result.all()
 
+async def find_lexical_messages(
+    session: AsyncSession,
+    query_text: str,
+    processed_query: str,
+    limit: int = 3
+) -> List[Tuple[int, str, str, float]]:
+    """
+    Ищет сообщения по триграммному сходству слов (pg_trgm) с исходным и обработанным запросом.
+    Находит точные имена, числа и коды проектов, которые теряются в эмбеддингах.
+    
+    Args:
+        session: Асинхронная сессия SQLAlchemy
+        query_text: Исходный текст запроса
+        processed_query: Лемматизированный текст запроса
+        limit: Максимальное количество результатов
+    
+    Returns:
+        Список кортежей (id сообщения, текст, обработанный текст, оценка сходства)
+    """
+    score = func.greatest(
+        func.word_similarity(query_text, Message.text),
+        func.word_similarity(processed_query, func.coalesce(Message.processed_text, ''))
+    )
+    
+    # Операторы <% используют GIN-индексы gin_trgm_ops по text и processed_text
+    conditions = [literal(query_text).op('<%')(Message.text)]
+    if processed_query:
+        conditions.append(literal(processed_query).op('<%')(Message.processed_text))
+    
+    query = (
+        select(
+            Message.id,
+            Message.text,
+            Message.processed_text,
+            func.cast(score, Float).label("score")
+        )
+        .where(or_(*conditions))
+        .order_by(score.desc())
+        .limit(limit)
+    )
+    
+    result = await session.execute(query)
+    return result.all()
+
 async def store_message_embedding(
     session: AsyncSession,
     message_id: int,
@@ -115,140 +205,44 @@ async def store_message_embedding(
         message.embeddings = embedding
         await session.commit()
 
-def setup_docker_container():
-    try:
-        client = docker.from_env()
-        client.ping()
-        print("Docker работает, продолжаем...")
-        
-        try:
-            client.images.get(IMAGE_NAME)
-            print(f"Образ {IMAGE_NAME} найден")
-        except docker.errors.ImageNotFound:
-            raise RuntimeError(
-                f"Образ {IMAGE_NAME} не найден. Сначала соберите его используя:\n"
-                f"docker build -t {IMAGE_NAME} ."
-            )
-        
-        try:
-            container = client.containers.get(CONTAINER_NAME)
-            if container.status != "running":
-                container.start()
-            print(f"Контейнер {CONTAINER_NAME} уже существует и запущен")
-            return container
-        except docker.errors.NotFound:
-            pass
-        
-        print(f"Создаём новый контейнер из образа {IMAGE_NAME}...")
-        container = client.containers.run(
-            IMAGE_NAME,
-            name=CONTAINER_NAME,
-            environment={
-                "POSTGRES_USER": DB_USER,
-                "POSTGRES_PASSWORD": DB_PASSWORD,
-                "POSTGRES_DB": DB_NAME
-            },
-            ports={'5432/tcp': DB_PORT},
-            detach=True,
-            volumes={
-                'pgdata': {'bind': '/var/lib/postgresql/data', 'mode': 'rw'}
-            }
-        )
-        print(f"Контейнер {container.id} создан и запущен")
-        time.sleep(15)
-        return container
-        
-    except docker.errors.DockerException as e:
-        print(f"Ошибка Docker: {e}")
-        print("Убедитесь, что Docker Desktop установлен и запущен")
-        raise
-    
-def wait_for_postgres(max_retries=10, delay=5):
-    for attempt in range(max_retries):
-        try:
-            with psycopg2.connect(
-                user=DB_USER,
-                password=DB_PASSWORD,
-                host=DB_HOST,
-                port=DB_PORT,
-                database=DB_NAME
-            ) as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute("SELECT 1")
-            return True
-        except psycopg2.OperationalError:
-            print(f"Попытка {attempt + 1}/{max_retries}: PostgreSQL ещё не готов...")
-            time.sleep(delay)
-    return False
-
-def setup_database():
-    if not wait_for_postgres():
-        raise RuntimeError("PostgreSQL не стал доступен после ожидания")
-    
-    max_retries = 5
-    for attempt in range(max_retries):
-        try:
-            with psycopg2.connect(
-                user=DB_USER,
-                password=DB_PASSWORD,
-                host=DB_HOST,
-                port=DB_PORT,
-                database=DB_NAME
-            ) as conn:
-                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-                with conn.cursor() as cursor:
-                    cursor.execute("""
-                        CREATE EXTENSION IF NOT EXISTS vector;
-                        CREATE EXTENSION IF NOT EXISTS plpython3u;
-                        CREATE EXTENSION IF NOT EXISTS pg_trgm;
-                    """)
-                    print("Расширения успешно созданы")
-                    return True
-        except psycopg2.Error as e:
-            print(f"Попытка {attempt + 1}/{max_retries}: Ошибка: {e}")
-            time.sleep(5)
-    
-    raise RuntimeError("Не удалось настроить БД после нескольких попыток")
-
-async def init_db():
-    # Настраиваем Docker контейнер
-    setup_docker_container()
-    
-    # Создаём базу данных и расширения
-    setup_database()
+async def init_db() -> DatabasePools:
+    # Запускаем контейнер (DB_MODE = "docker"), ждём готовности PostgreSQL и создаём недостающие расширения
+    await bootstrap_database()
     
     # Строка подключения для асинхронного подключения
     DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
     
     try:
-        # Создаём асинхронный движок
-        engine = create_async_engine(DATABASE_URL)
+        # Создаём асинхронные движки: интерактивные запросы и загрузка разговоров не делят соединения
+        engine = create_pooled_engine(
+            DATABASE_URL, INTERACTIVE_POOL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_STATEMENT_TIMEOUT_MS
+        )
+        ingestion_engine = create_pooled_engine(
+            DATABASE_URL, INGESTION_POOL, DB_INGESTION_POOL_SIZE, DB_INGESTION_MAX_OVERFLOW,
+            DB_INGESTION_STATEMENT_TIMEOUT_MS
+        )
         
-        # Создаём фабрику сессий
-        session_maker = async_sessionmaker(engine, expire_on_commit=False)
+        # Создаём фабрики сессий
+        pools = DatabasePools(
+            engine=engine,
+            ingestion_engine=ingestion_engine,
+            session_maker=async_sessionmaker(engine, expire_on_commit=False),
+            ingestion_session_maker=async_sessionmaker(ingestion_engine, expire_on_commit=False)
+        )
         
-        # Создаём таблицы
-        async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
-            print("Таблицы успешно созданы")
-            
-            # Явно указываем тип вектора для столбца embeddings
-            await conn.execute(text("""
-                ALTER TABLE messages 
-                ALTER COLUMN embeddings TYPE vector(768)
-                USING embeddings::vector(768)
-            """))
-            
-            # Создаем индекс для ускорения поиска
-            await conn.execute(text("""
-                CREATE INDEX IF NOT EXISTS messages_embeddings_idx 
-                ON messages USING hnsw (embeddings vector_cosine_ops)
-            """))
+        with startup_timer.phase("db.schema"):
+            # Создаём таблицы (DDL и миграции — через пул загрузки, без statement_timeout)
+            async with ingestion_engine.begin() as conn:
+                await conn.run_sync(
+                    Base.metadata.create_all,
+                    tables=[table for table in Base.metadata.sorted_tables if table.name not in MIGRATED_TABLES]
+                )
+                print("Таблицы успешно созданы")
             
-            print("Установлена размерность вектора 768 для столбца embeddings")
-            print("Создан HNSW индекс для ускорения векторного поиска")
+            # Применяем только недостающие миграции (размерность вектора, HNSW индекс и т.д.)
+            await apply_migrations(ingestion_engine)
         
-        return engine, session_maker
+        return pools
     except ImportError as e:
         print("\nОШИБКА: Не удалось импортировать модуль asyncpg")
         print("Убедитесь, что вы установили все необходимые зависимости:")
@@ -0,0 +1,254 @@
+import asyncio
+from dataclasses import dataclass
+from typing import List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.sql import text
+
+# Ключ advisory-блокировки, чтобы несколько запущенных ботов не применяли миграции одновременно
+MIGRATIONS_LOCK_KEY = 7_310_001
+
+
+@dataclass
+class Migration:
+    """
+    Шаг миграции схемы БД.
+    
+    Все инструкции должны быть идемпотентными (IF NOT EXISTS, проверки в DO-блоках),
+    чтобы прерванная миграция безопасно повторялась при следующем запуске.
+    concurrent=True — инструкции выполняются вне транзакции (для CREATE INDEX CONCURRENTLY)
+    в фоновой задаче, не задерживая запуск бота.
+    """
+    version: int
+    description: str
+    statements: List[str]
+    concurrent: bool = False
+
+
+def drop_invalid_index(index_name: str) -> str:
+    """Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс — удаляем его перед повторной попыткой"""
+    return f"""
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = '{index_name}' AND NOT i.indisvalid
+            ) THEN
+                DROP INDEX {index_name};
+            END IF;
+        END $$
+    """
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        version=1,
+        description="Размерность вектора 768 для столбца embeddings",
+        statements=[
+            """
+            DO $$
+            BEGIN
+                IF (
+                    SELECT format_type(atttypid, atttypmod)
+                    FROM pg_attribute
+                    WHERE attrelid = 'messages'::regclass AND attname = 'embeddings'
+                ) <> 'vector(768)' THEN
+                    ALTER TABLE messages
+                    ALTER COLUMN embeddings TYPE vector(768)
+                    USING embeddings::vector(768);
+                END IF;
+            END $$
+            """,
+        ],
+    ),
+    Migration(
+        version=2,
+        description="HNSW индекс для ускорения векторного поиска",
+        statements=[
+            drop_invalid_index("messages_embeddings_idx"),
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_embeddings_idx
+            ON messages USING hnsw (embeddings vector_cosine_ops)
+            """,
+        ],
+        concurrent=True,
+    ),
+    Migration(
+        version=3,
+        description="Индекс по порядку сообщений в беседе для выборки контекста",
+        statements=[
+            drop_invalid_index("messages_conversation_order_idx"),
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_conversation_order_idx
+            ON messages (conversation_id, date, time, id)
+            """,
+        ],
+        concurrent=True,
+    ),
+    Migration(
+        version=4,
+        description="Триграммные индексы для лексического поиска по сообщениям",
+        statements=[
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            drop_invalid_index("messages_text_trgm_idx"),
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_text_trgm_idx
+            ON messages USING gin (text gin_trgm_ops)
+            """,
+            drop_invalid_index("messages_processed_text_trgm_idx"),
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_processed_text_trgm_idx
+            ON messages USING gin (processed_text gin_trgm_ops)
+            """,
+        ],
+        concurrent=True,
+    ),
+    Migration(
+        version=5,
+        description="Хранилище контекстов диалогов и состояний FSM",
+        statements=[
+            """
+            CREATE TABLE IF NOT EXISTS kv_store (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value JSONB NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (namespace, key)
+            )
+            """,
+        ],
+    ),
+    Migration(
+        version=6,
+        description="Очередь фоновых загрузок с арендой задач",
+        statements=[
+            """
+            CREATE TABLE IF NOT EXISTS ingestion_jobs (
+                id SERIAL PRIMARY KEY,
+                chat_id BIGINT NOT NULL,
+                owner_id BIGINT NOT NULL,
+                file_name VARCHAR NOT NULL,
+                file_path VARCHAR NOT NULL,
+                conversation_date VARCHAR NOT NULL,
+                conversation_time VARCHAR NOT NULL,
+                status VARCHAR NOT NULL DEFAULT 'queued',
+                turns_total INTEGER NOT NULL DEFAULT 0,
+                turns_done INTEGER NOT NULL DEFAULT 0,
+                conversation_id INTEGER,
+                progress_message_id BIGINT,
+                error TEXT,
+                created_at TIMESTAMPTZ DEFAULT now(),
+                started_at TIMESTAMPTZ,
+                finished_at TIMESTAMPTZ
+            )
+            """,
+            # Таблица могла быть создана раньше через create_all, без столбцов аренды
+            "ALTER TABLE ingestion_jobs ADD COLUMN IF NOT EXISTS worker_id VARCHAR",
+            "ALTER TABLE ingestion_jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ",
+        ],
+    ),
+    Migration(
+        version=7,
+        description="Журнал файлов пакетного импорта транскриптов",
+        statements=[
+            """
+            CREATE TABLE IF NOT EXISTS imported_transcripts (
+                sha256 VARCHAR(64) PRIMARY KEY,
+                file_name VARCHAR NOT NULL,
+                conversation_id INTEGER NOT NULL REFERENCES conversation (id),
+                imported_at TIMESTAMPTZ DEFAULT now()
+            )
+            """,
+        ],
+    ),
+]
+
+# Ссылка на фоновую задачу, чтобы её не собрал сборщик мусора
+background_migration_task: Optional[asyncio.Task] = None
+
+
+async def _ensure_version_table(engine: AsyncEngine) -> set:
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """))
+        result = await conn.execute(text("SELECT version FROM schema_version"))
+        return set(result.scalars().all())
+
+
+async def _apply_transactional(engine: AsyncEngine, migration: Migration) -> None:
+    async with engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+        
+        # Пока ждали блокировку, миграцию мог применить другой процесс
+        applied = await conn.execute(
+            text("SELECT 1 FROM schema_version WHERE version = :version"),
+            {"version": migration.version}
+        )
+        if applied.scalar():
+            return
+        
+        for statement in migration.statements:
+            await conn.execute(text(statement))
+        await conn.execute(
+            text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+            {"version": migration.version, "description": migration.description}
+        )
+    print(f"Миграция {migration.version} применена: {migration.description}")
+
+
+async def _apply_concurrent(engine: AsyncEngine, migrations: List[Migration]) -> None:
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+        try:
+            for migration in migrations:
+                applied = await conn.execute(
+                    text("SELECT 1 FROM schema_version WHERE version = :version"),
+                    {"version": migration.version}
+                )
+                if applied.scalar():
+                    continue
+                
+                print(f"Миграция {migration.version} запущена в фоне: {migration.description}")
+                for statement in migration.statements:
+                    await conn.execute(text(statement))
+                await conn.execute(
+                    text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+                    {"version": migration.version, "description": migration.description}
+                )
+                print(f"Миграция {migration.version} применена: {migration.description}")
+        except Exception as e:
+            print(f"Ошибка фоновой миграции: {e}")
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+
+
+async def apply_migrations(engine: AsyncEngine) -> None:
+    """
+    Применяет недостающие миграции по порядку версий.
+    
+    Обычные миграции выполняются сразу, каждая в своей транзакции, — от них
+    зависит работа бота (таблицы, типы столбцов). Concurrent-миграции только
+    строят индексы, поэтому они выполняются в фоновой задаче и не блокируют запуск.
+    """
+    global background_migration_task
+    applied = await _ensure_version_table(engine)
+    pending = [m for m in sorted(MIGRATIONS, key=lambda m: m.version) if m.version not in applied]
+    
+    if not pending:
+        print("Схема БД актуальна")
+        return
+    
+    for migration in pending:
+        if not migration.concurrent:
+            await _apply_transactional(engine, migration)
+    
+    concurrent = [m for m in pending if m.concurrent]
+    if concurrent:
+        background_migration_task = asyncio.create_task(_apply_concurrent(engine, concurrent))
@@ -0,0 +1,143 @@
+from collections import deque
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Deque, Dict, Optional
+
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from metrics import percentile
+from config import (
+    DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_STATEMENT_CACHE_SIZE
+)
+
+# Имена пулов: интерактивные запросы (поиск контекста, хранилище, обработчики) и загрузка разговоров
+INTERACTIVE_POOL = "interactive"
+INGESTION_POOL = "ingestion"
+
+
+@dataclass
+class PoolMetrics:
+    """
+    Метрики пула соединений (время получения соединения — по последним window выдачам).
+    
+    pool — текущий пул с этим именем: число занятых соединений берётся у него,
+    разность выдач и возвратов расходится при сбоях и пересоздании пула.
+    """
+    window: int = 1000
+    checkouts: int = 0
+    checkins: int = 0
+    timeouts: int = 0
+    waits_ms: Deque[float] = field(default_factory=deque)
+    pool: Optional["MeteredQueuePool"] = None
+
+    def record_checkout(self, wait_ms: float) -> None:
+        self.checkouts += 1
+        self.waits_ms.append(wait_ms)
+        if len(self.waits_ms) > self.window:
+            self.waits_ms.popleft()
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    """
+    AsyncAdaptedQueuePool, который считает выдачи и возвраты соединений
+    и время ожидания свободного соединения (вместе с pre-ping и открытием нового).
+    """
+
+    metrics: PoolMetrics
+
+    def connect(self):
+        started = perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        self.metrics.record_checkout((perf_counter() - started) * 1000)
+        return connection
+
+    def _do_return_conn(self, record) -> None:
+        self.metrics.checkins += 1
+        super()._do_return_conn(record)
+
+    def recreate(self) -> "MeteredQueuePool":
+        # dispose() и потеря соединения с БД пересоздают пул — метрики переносятся
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        self.metrics.pool = pool
+        return pool
+
+
+# Метрики по имени пула (переживают пересоздание пула)
+pool_metrics: Dict[str, PoolMetrics] = {}
+
+
+def create_pooled_engine(
+    url: str,
+    name: str,
+    pool_size: int,
+    max_overflow: int,
+    statement_timeout_ms: int
+) -> AsyncEngine:
+    """
+    Движок с отдельным пулом соединений.
+
+    Подготовленные запросы кэшируются на каждом соединении (DB_STATEMENT_CACHE_SIZE),
+    поэтому частые запросы (поиск похожих сообщений) разбираются сервером один раз
+    на соединение. statement_timeout задаётся при подключении.
+    """
+    engine = create_async_engine(
+        url,
+        poolclass=MeteredQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args={
+            "prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+            "server_settings": {
+                "application_name": f"ai_personal_assistant:{name}",
+                "statement_timeout": str(statement_timeout_ms),
+            },
+        },
+    )
+    metrics = pool_metrics.setdefault(name, PoolMetrics())
+    engine.pool.metrics = metrics
+    metrics.pool = engine.pool
+    return engine
+
+
+@dataclass
+class DatabasePools:
+    """
+    Движки и фабрики сессий основной БД.
+
+    Интерактивные запросы и загрузка разговоров идут через разные пулы:
+    долгая загрузка не занимает соединения, нужные для ответа пользователю.
+    """
+    engine: AsyncEngine
+    ingestion_engine: AsyncEngine
+    session_maker: async_sessionmaker[AsyncSession]
+    ingestion_session_maker: async_sessionmaker[AsyncSession]
+
+    async def dispose(self) -> None:
+        await self.engine.dispose()
+        await self.ingestion_engine.dispose()
+
+
+def pool_stats() -> Dict[str, dict]:
+    """Метрики пулов для /stats"""
+    stats = {}
+    for name, metrics in pool_metrics.items():
+        stats[name] = {
+            "checkouts": metrics.checkouts,
+            "checkins": metrics.checkins,
+            "in_use": metrics.pool.checkedout() if metrics.pool is not None else 0,
+            "timeouts": metrics.timeouts,
+            "wait_p50_ms": percentile(metrics.waits_ms, 50),
+            "wait_p95_ms": percentile(metrics.waits_ms, 95),
+            "wait_max_ms": max(metrics.waits_ms, default=0.0),
+        }
+    return stats
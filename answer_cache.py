@@ -0,0 +1,157 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import (
+    ANSWER_CACHE_ENABLED, ANSWER_CACHE_SIMILARITY,
+    ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES
+)
+
+
+def prompt_fingerprint(prompt: str) -> str:
+    """Короткий отпечаток системного промта: ответы делятся между гостями с одинаковым промтом"""
+    return hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class CachedAnswer:
+    """Итоговый ответ на вопрос гостя, полученный с системным промтом prompt_key"""
+    prompt_key: str
+    question: str
+    answer: str
+    created_at: float = field(default_factory=monotonic)
+    hits: int = 0
+
+
+class AnswerCache:
+    """
+    Семантический кэш ответов на вопросы о владельце.
+
+    Ответ зависит от системного промта (в него входят примеры стиля из бесед
+    с гостем), поэтому кэш разделён по отпечатку промта (prompt_fingerprint):
+    гости с одинаковым промтом получают общие ответы, а персональный ответ
+    другому гостю не попадает. Кэшируются и ищутся только первые вопросы
+    диалога — ответ на них не зависит от предыдущих реплик.
+
+    Вопрос хранится как нормированный вектор; при новом вопросе ищется
+    самый похожий из вопросов с тем же промтом (скалярное произведение
+    по матрице их векторов), и если сходство не ниже ANSWER_CACHE_SIMILARITY,
+    ответ возвращается без вызова LLM и поиска. Записи живут ANSWER_CACHE_TTL_SECONDS,
+    при переполнении вытесняются самые старые, загрузка новой беседы
+    сбрасывает кэш целиком (ответы могли устареть).
+    """
+
+    def __init__(
+        self,
+        similarity: float = ANSWER_CACHE_SIMILARITY,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        enabled: bool = ANSWER_CACHE_ENABLED
+    ):
+        self.similarity = similarity
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._vectors: Dict[int, np.ndarray] = {}
+        self._by_prompt: Dict[str, List[int]] = {}
+        self._matrices: Dict[str, np.ndarray] = {}
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def lookup(self, prompt_key: str, embedding: Optional[List[float]]) -> Optional[CachedAnswer]:
+        """Ответ на похожий вопрос, полученный с тем же системным промтом, или None"""
+        if not self.enabled or embedding is None:
+            return None
+
+        self._expire()
+        entry_ids = self._by_prompt.get(prompt_key)
+        if not entry_ids:
+            self.misses += 1
+            return None
+
+        matrix = self._matrices.get(prompt_key)
+        if matrix is None:
+            matrix = self._matrices[prompt_key] = np.stack([self._vectors[entry_id] for entry_id in entry_ids])
+
+        scores = matrix @ self._normalize(embedding)
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            self.misses += 1
+            return None
+
+        entry = self._entries[entry_ids[best]]
+        entry.hits += 1
+        self.hits += 1
+        return entry
+
+    def store(self, prompt_key: str, question: str, embedding: Optional[List[float]], answer: str) -> None:
+        """Сохраняет итоговый ответ, полученный с системным промтом prompt_key"""
+        if not self.enabled or embedding is None or not answer:
+            return
+
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = CachedAnswer(prompt_key, question, answer)
+        self._vectors[entry_id] = self._normalize(embedding)
+        self._by_prompt.setdefault(prompt_key, []).append(entry_id)
+        self._matrices.pop(prompt_key, None)
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        """Сбрасывает кэш: после загрузки беседы поиск может найти другой контекст"""
+        if self._entries:
+            self.invalidations += 1
+        self._entries.clear()
+        self._vectors.clear()
+        self._by_prompt.clear()
+        self._matrices.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "prompts": len(self._by_prompt),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+    def _expire(self) -> None:
+        # Записи добавляются по порядку, поэтому истёкшие всегда в начале
+        now = monotonic()
+        while self._entries:
+            entry_id, entry = next(iter(self._entries.items()))
+            if now - entry.created_at <= self.ttl_seconds:
+                break
+            self._remove(entry_id)
+            self.expirations += 1
+
+    def _remove(self, entry_id: int) -> None:
+        prompt_key = self._entries.pop(entry_id).prompt_key
+        del self._vectors[entry_id]
+        entry_ids = self._by_prompt[prompt_key]
+        entry_ids.remove(entry_id)
+        if not entry_ids:
+            del self._by_prompt[prompt_key]
+        self._matrices.pop(prompt_key, None)
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+answer_cache = AnswerCache()
@@ -2,7 +2,126 @@ TOKEN = "" # Вставьте свой токен подключения
 ADMIN_GROUP_ID = -100  # Добавьте ID вашей группы в ТГ с админами
 DEESEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 DEESEEK_API_KEY1 = "" # Вставьте свой API-ключ
+LLM_MODEL = "deepseek/deepseek-chat-v3-0324:free" # Модель на OpenRouter
 
 developers = [] # Внесите в список ID разработчиков
 owners = {} # Внесите в список ID владельцев
-owner_username = "" # Добавьте имя_пользователя владельца (после знака "@")
\ No newline at end of file
+owner_username = "" # Добавьте имя_пользователя владельца (после знака "@")
+
+# Векторизация
+EMBEDDING_MODEL_NAME = "DeepPavlov/rubert-base-cased-sentence" # Модель SentenceTransformer (768-мерные эмбеддинги)
+EMBEDDING_BATCH_SIZE = 64 # Размер батча при векторизации реплик загружаемого разговора
+EMBEDDING_MAX_BATCH_SIZE = 32 # Максимальный размер микробатча для поисковых фраз
+EMBEDDING_MAX_WAIT_MS = 10 # Сколько миллисекунд ждать других запросов перед векторизацией
+
+# Предобработка текста
+PREPROCESS_LEMMA_CACHE_SIZE = 100_000 # Сколько лемм хранить в кэше
+PREPROCESS_INLINE_MAX_TEXTS = 8 # Пачки больше этого размера обрабатываются в отдельном потоке
+
+# Поиск по базе разговоров (RAG)
+SEARCH_MODE = "hybrid" # "vector" — только косинусный поиск, "hybrid" — косинусный + триграммный (pg_trgm)
+SEARCH_LIMIT = 3 # Сколько найденных сообщений подставлять в контекст
+SEARCH_THRESHOLD = 0.1 # Порог косинусного сходства
+HYBRID_CANDIDATES = 20 # Сколько кандидатов брать из каждого вида поиска перед слиянием
+HYBRID_VECTOR_WEIGHT = 1.0 # Вес косинусного поиска при слиянии (reciprocal rank fusion)
+HYBRID_LEXICAL_WEIGHT = 1.0 # Вес триграммного поиска при слиянии
+HYBRID_RRF_K = 60 # Константа сглаживания RRF
+
+# Спекулятивный поиск: искать по сообщению пользователя параллельно с первым вызовом LLM
+SPECULATIVE_RETRIEVAL = False # Включить спекулятивный поиск
+SPECULATION_SIMILARITY = 0.8 # Минимальное косинусное сходство фразы модели и сообщения, чтобы использовать предзагруженный контекст
+
+# Потоковая выдача ответов
+STREAMING_RESPONSES = True # Показывать ответ по мере генерации, редактируя сообщение
+STREAM_EDIT_INTERVAL = 1.5 # Минимальный интервал между редактированиями сообщения, секунд (лимиты Telegram)
+STREAM_PLACEHOLDER = "✍️ Печатает..." # Текст сообщения до появления первых токенов
+
+# Контексты диалогов с ИИ
+CONTEXT_MAX_USERS = 1000 # Сколько контекстов держать в памяти одновременно
+CONTEXT_MAX_BYTES = 50 * 1024 * 1024 # Лимит суммарного объёма текста всех контекстов
+CONTEXT_TTL_SECONDS = 24 * 60 * 60 # Через сколько секунд неактивности контекст удаляется
+CONTEXT_TOKEN_BUDGET = 6000 # Бюджет токенов на контекст одного пользователя (системный промт не обрезается)
+CONTEXT_CHARS_PER_TOKEN = 3 # Оценка числа символов на токен для русского текста
+
+# Постоянное хранение контекстов диалогов и состояний FSM (переживают перезапуск, общие для нескольких экземпляров бота)
+STORAGE_BACKEND = "postgres" # "memory" — только в памяти процесса, "postgres" — таблица kv_store основной БД, "sqlite" — локальный файл
+STORAGE_SQLITE_PATH = "storage.sqlite3" # Файл для STORAGE_BACKEND = "sqlite"
+CONTEXT_FLUSH_INTERVAL = 2.0 # Как часто (секунд) записывать изменённые контексты
+CONTEXT_FLUSH_BATCH = 50 # Записывать сразу, если накопилось столько изменений
+STORAGE_READ_CACHE_SECONDS = 2.0 # Сколько секунд прочитанные из хранилища контекст и состояние FSM считаются свежими (0 — читать при каждом обращении)
+
+# Примеры стиля владельца в системном промте
+STYLE_MODE = "digest" # "digest" — начало и конец последних бесед с гостем (из кэша, без запросов к БД), "exemplars" — реплики владельца, самые похожие на сообщение гостя (векторизация и 2 запроса к БД на каждый новый диалог)
+STYLE_EXEMPLARS_LIMIT = 10 # Сколько похожих реплик владельца отбирать
+STYLE_EXEMPLARS_CHAR_BUDGET = 1200 # Лимит символов на примеры стиля в системном промте
+STYLE_EXEMPLARS_EF_SEARCH = 200 # hnsw.ef_search при отборе: фильтр по беседам с гостем применяется после обхода индекса
+
+# Семантический кэш ответов: повторный вопрос о владельце отвечается без вызова LLM и поиска
+ANSWER_CACHE_ENABLED = True # Включить кэш ответов
+ANSWER_CACHE_SIMILARITY = 0.92 # Минимальное косинусное сходство вопросов, чтобы вернуть сохранённый ответ
+ANSWER_CACHE_TTL_SECONDS = 6 * 60 * 60 # Сколько секунд хранится ответ
+ANSWER_CACHE_MAX_ENTRIES = 1000 # Сколько ответов хранить (вытесняются самые старые)
+
+# Обращения к LLM (OpenAI-совместимый API)
+LLM_BASE_URL = "https://openrouter.ai/api/v1" # Адрес API (для проверки можно указать локальный поддельный сервер)
+LLM_HEDGE_MODEL = "" # Запасная модель для дублирующего запроса при долгом ответе ("" — не дублировать)
+LLM_HEDGE_AFTER_SECONDS = 8.0 # Через сколько секунд без ответа (первого токена) дублировать запрос
+LLM_CONNECT_TIMEOUT = 5.0 # Таймаут соединения, секунд
+LLM_READ_TIMEOUT = 60.0 # Таймаут чтения ответа, секунд
+LLM_MAX_CONNECTIONS = 20 # Размер пула HTTP-соединений
+LLM_MAX_KEEPALIVE_CONNECTIONS = 10 # Сколько соединений держать открытыми между запросами
+LLM_MAX_CONCURRENCY = 8 # Одновременных запросов к модели всего
+LLM_MAX_CONCURRENCY_PER_USER = 1 # Одновременных запросов к модели от одного пользователя
+LLM_MAX_QUEUE = 50 # Сколько запросов может ждать свободного слота, остальные сразу получают отказ
+LLM_MAX_RETRIES = 3 # Повторы при 429/5xx и сетевых ошибках
+LLM_BACKOFF_BASE = 0.5 # Начальная задержка перед повтором, секунд (растёт вдвое, со случайным джиттером)
+LLM_BACKOFF_MAX = 8.0 # Максимальная задержка перед повтором, секунд
+
+# Очередь реплик пользователя в режиме общения с ИИ
+CHAT_MAX_PENDING_MESSAGES = 3 # Сколько сообщений может накопиться во время генерации ответа (объединяются в одну реплику)
+
+# Загрузка разговоров в БД
+INGESTION_BULK_COPY = True # Писать сообщения одной командой COPY (False — по одной ORM-записи, запасной путь)
+INGESTION_WORKERS = 2 # Сколько загрузок обрабатывать одновременно (остальные ждут в очереди)
+INGESTION_PROGRESS_INTERVAL = 3.0 # Как часто (секунд) обновлять сообщение о ходе загрузки
+INGESTION_HEARTBEAT_INTERVAL = 30.0 # Как часто (секунд) экземпляр подтверждает аренду своих загрузок и проверяет чужие
+INGESTION_LEASE_SECONDS = 120.0 # Через сколько секунд без подтверждения загрузка считается брошенной и выполняется заново
+INGESTION_SPOOL_BYTES = 8 * 1024 * 1024 # Сколько обработанных реплик держать в памяти до записи, дальше — во временный файл
+TRANSCRIPT_READ_CHUNK_BYTES = 64 * 1024 # Размер куска при потоковом чтении файла транскрипта
+IMPORT_WORKERS = 0 # Процессов предобработки и векторизации в import_transcripts.py (0 — по числу ядер)
+ACCESS_STORAGE = "json" # Где хранить списки доступа: "json" — файлы lists_of_users, "storage" — общее хранилище STORAGE_BACKEND
+ACCESS_FLUSH_DELAY = 1.0 # Через сколько секунд после изменения записывать списки доступа (изменения за это время пишутся разом)
+ACCESS_REFRESH_INTERVAL = 30.0 # Как часто (секунд) перечитывать списки доступа из общего хранилища (ACCESS_STORAGE = "storage")
+
+# Получение апдейтов от Telegram
+RUN_MODE = "polling" # "polling" — long polling, "webhook" — встроенный HTTP-сервер (несколько экземпляров — только при маршрутизации апдейтов по chat_id, см. README)
+TELEGRAM_API_SERVER = "" # Адрес Bot API ("" — api.telegram.org; можно указать локальный telegram-bot-api или поддельный сервер для проверки)
+WEBHOOK_BASE_URL = "" # Публичный адрес бота для Telegram, например https://bot.example.com (без пути)
+WEBHOOK_PATH = "/webhook" # Путь, на который Telegram присылает апдейты
+WEBHOOK_SECRET = "" # Секрет заголовка X-Telegram-Bot-Api-Secret-Token ("" — вычисляется из TOKEN, одинаковый у всех экземпляров)
+WEBHOOK_HOST = "0.0.0.0" # Адрес, на котором слушает HTTP-сервер
+WEBHOOK_PORT = 8080 # Порт HTTP-сервера (там же /healthz и /readyz)
+MAX_CONCURRENT_UPDATES = 64 # Сколько апдейтов обрабатывать одновременно (остальные ждут свободного слота)
+SHUTDOWN_DRAIN_TIMEOUT = 30.0 # Сколько секунд при остановке ждать завершения начатых ответов
+
+# Пулы соединений с БД (интерактивные запросы и загрузка разговоров — в разных пулах)
+DB_POOL_SIZE = 10 # Постоянных соединений для интерактивных запросов (поиск контекста, хранилище, обработчики)
+DB_MAX_OVERFLOW = 10 # Сколько соединений можно открыть сверх DB_POOL_SIZE при всплеске запросов
+DB_INGESTION_POOL_SIZE = 3 # Соединений для загрузки разговоров, импорта и миграций
+DB_INGESTION_MAX_OVERFLOW = 2 # Сколько соединений можно открыть сверх DB_INGESTION_POOL_SIZE
+DB_POOL_TIMEOUT = 10.0 # Сколько секунд ждать свободного соединения, затем ошибка
+DB_POOL_RECYCLE = 1800 # Через сколько секунд переоткрывать соединение
+DB_POOL_PRE_PING = True # Проверять соединение перед выдачей из пула (оборванные соединения заменяются незаметно)
+DB_STATEMENT_CACHE_SIZE = 256 # Подготовленных запросов в кэше каждого соединения (0 — не кэшировать, нужно за pgbouncer в режиме transaction)
+DB_STATEMENT_TIMEOUT_MS = 10_000 # statement_timeout интерактивных запросов, мс (0 — без ограничения)
+DB_INGESTION_STATEMENT_TIMEOUT_MS = 0 # statement_timeout загрузки разговоров и миграций, мс (0 — без ограничения)
+
+# Подключение к PostgreSQL
+DB_MODE = "docker" # "docker" — запускать локальный контейнер из образа agent/pgvector, "external" — подключаться к уже работающему серверу (Docker не нужен)
+DB_HOST = "localhost" # Адрес сервера PostgreSQL
+DB_PORT = 5432 # Порт сервера PostgreSQL
+DB_NAME = "vector_db" # Имя базы данных
+DB_USER = "postgres" # Пользователь БД
+DB_PASSWORD = "postgres" # Пароль пользователя БД
+DB_READY_TIMEOUT = 60.0 # Сколько секунд при запуске ждать, пока PostgreSQL начнёт принимать подключения
+DB_READY_MAX_DELAY = 1.0 # Максимальная пауза между попытками подключения, секунд (начинается с 0.05 и растёт вдвое)
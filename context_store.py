@@ -0,0 +1,453 @@
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from time import monotonic, time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from config import (
+    CONTEXT_MAX_USERS, CONTEXT_MAX_BYTES, CONTEXT_TTL_SECONDS,
+    CONTEXT_TOKEN_BUDGET, CONTEXT_CHARS_PER_TOKEN,
+    CONTEXT_FLUSH_INTERVAL, CONTEXT_FLUSH_BATCH, STORAGE_READ_CACHE_SECONDS
+)
+from storage import KeyValueBackend
+
+# Компактное хранение ролей: одна буква вместо словаря на каждую реплику
+ROLE_CODES = {"user": "u", "assistant": "a"}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+
+# Пространство имён контекстов в KeyValueBackend
+CONTEXT_NAMESPACE = "chat_context"
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов без токенизатора"""
+    return len(text) // CONTEXT_CHARS_PER_TOKEN + 1
+
+
+@dataclass
+class StoredContext:
+    """
+    Контекст диалога одного пользователя: системный промт отдельно, реплики — кортежами (роль, текст).
+
+    version — версия записи в постоянном хранилище, на которой основана копия в памяти,
+    unsaved — сколько последних реплик ещё не записано,
+    checked_at — когда (monotonic) копия последний раз сверялась с хранилищем.
+    """
+    system: Optional[str] = None
+    turns: List[Tuple[str, str]] = field(default_factory=list)
+    tokens: int = 0
+    size_bytes: int = 0
+    last_access: float = field(default_factory=monotonic)
+    updated_at: float = field(default_factory=time)
+    version: int = 0
+    unsaved: int = 0
+    checked_at: float = 0.0
+
+    def messages(self) -> List[dict]:
+        """Сообщения в формате chat.completions"""
+        result = [{"role": "system", "content": self.system}] if self.system is not None else []
+        result.extend({"role": ROLE_NAMES[code], "content": content} for code, content in self.turns)
+        return result
+
+    def recount(self) -> None:
+        """Пересчитывает оценку токенов и объём текста"""
+        texts = ([self.system] if self.system is not None else []) + [content for _, content in self.turns]
+        self.tokens = sum(estimate_tokens(text) for text in texts)
+        self.size_bytes = sum(len(text.encode("utf-8")) for text in texts)
+
+    def to_payload(self, version: int) -> Dict[str, Any]:
+        return {
+            "system": self.system,
+            "turns": [list(turn) for turn in self.turns],
+            "updated_at": self.updated_at,
+            "version": version,
+        }
+
+    @classmethod
+    def from_payload(cls, payload: Dict[str, Any]) -> "StoredContext":
+        context = cls(
+            system=payload.get("system"),
+            turns=[(code, content) for code, content in payload.get("turns", [])],
+            updated_at=payload.get("updated_at", time()),
+            version=payload.get("version", 0)
+        )
+        context.recount()
+        return context
+
+
+class ContextStore:
+    """
+    Хранилище контекстов диалогов с ограничением памяти.
+
+    Между пользователями — вытеснение давно неактивных (LRU) и по TTL,
+    с лимитами на число пользователей и суммарный объём текста.
+    Внутри контекста — обрезка старых реплик по бюджету токенов;
+    системный промт и последняя реплика не удаляются.
+
+    Если подключён KeyValueBackend, контексты переживают перезапуск и общие
+    для нескольких экземпляров бота. fetch читает запись из хранилища, если
+    копия в памяти не сверялась с ним дольше read_cache_seconds (несколько
+    fetch за одну реплику стоят одного чтения): если запись обновил другой
+    экземпляр, копия перестраивается по ней (несохранённые реплики остаются
+    в конце).
+    Изменения пишутся пачками фоновой задачей (раз в CONTEXT_FLUSH_INTERVAL
+    секунд или при накоплении CONTEXT_FLUSH_BATCH изменений) с проверкой
+    версии: если запись успели изменить, она перечитывается, объединяется
+    с несохранёнными репликами и пишется снова — реплики не теряются.
+    """
+
+    def __init__(
+        self,
+        max_users: int = CONTEXT_MAX_USERS,
+        max_bytes: int = CONTEXT_MAX_BYTES,
+        ttl_seconds: float = CONTEXT_TTL_SECONDS,
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+        backend: Optional[KeyValueBackend] = None,
+        read_cache_seconds: float = STORAGE_READ_CACHE_SECONDS
+    ):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.token_budget = token_budget
+        self.backend = backend
+        self.read_cache_seconds = read_cache_seconds
+        self._contexts: "OrderedDict[int, StoredContext]" = OrderedDict()
+        self._bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.conflicts = 0
+        self.reloads = 0
+        # Изменённые контексты в памяти, вытесненные из памяти до записи и удалённые
+        self._dirty: Set[int] = set()
+        self._evicted: Dict[int, StoredContext] = {}
+        self._deleted: Set[int] = set()
+        # Контексты, запись которых сейчас идёт (fetch дожидается её окончания)
+        self._writing: Set[int] = set()
+        self._flush_lock = asyncio.Lock()
+        self._flush_event: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    def attach(self, backend: KeyValueBackend) -> None:
+        """Подключает постоянное хранилище и запускает фоновую запись"""
+        self.backend = backend
+        self._flush_event = asyncio.Event()
+        self._flusher = asyncio.create_task(self._run_flusher())
+
+    async def close(self) -> None:
+        """Останавливает фоновую запись и сохраняет оставшиеся изменения"""
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+    def get(self, user_id: int) -> Optional[StoredContext]:
+        """Возвращает контекст пользователя из памяти (None, если его нет или истёк TTL)"""
+        context = self._contexts.get(user_id)
+        if context is None:
+            return None
+
+        now = monotonic()
+        if now - context.last_access > self.ttl_seconds:
+            self.expirations += 1
+            if self.backend is None:
+                self._remove(user_id)
+            else:
+                # Запись в хранилище не удаляем: гость мог продолжить диалог на другом экземпляре,
+                # а устаревшие записи отсекает fetch по updated_at
+                self._evict(user_id)
+            return None
+
+        context.last_access = now
+        self._contexts.move_to_end(user_id)
+        return context
+
+    async def fetch(self, user_id: int) -> Optional[StoredContext]:
+        """
+        Контекст пользователя с учётом постоянного хранилища.
+
+        Запись новее копии в памяти бывает, если гость писал через другой
+        экземпляр бота. Недавно сверенная копия возвращается без чтения:
+        запись с проверкой версии всё равно не даст потерять чужие реплики.
+        """
+        if self.backend is None or user_id in self._deleted:
+            return self.get(user_id)
+
+        cached = self._contexts.get(user_id)
+        if cached is not None and monotonic() - cached.checked_at < self.read_cache_seconds:
+            return self.get(user_id)
+
+        context = await self._read_through(user_id)
+        if context is not None:
+            context.checked_at = monotonic()
+        return context
+
+    async def _read_through(self, user_id: int) -> Optional[StoredContext]:
+        """Читает запись из хранилища и сверяет с ней копию в памяти"""
+        key = str(user_id)
+        payload = await self.backend.get(CONTEXT_NAMESPACE, key)
+        if user_id in self._writing:
+            # Версию прочитанной записи сравниваем с копией уже после окончания её записи
+            async with self._flush_lock:
+                pass
+        if user_id in self._deleted:
+            return self.get(user_id)
+
+        # Вытесненный до записи контекст возвращается в память: он новее записи в хранилище
+        if user_id in self._evicted and user_id not in self._contexts:
+            self._restore(user_id, self._evicted.pop(user_id))
+        context = self.get(user_id)
+
+        if payload is not None and time() - payload.get("updated_at", 0) > self.ttl_seconds:
+            self.expirations += 1
+            payload = None
+            if context is None:
+                self._deleted.add(user_id)
+                self._request_flush()
+
+        if payload is None:
+            if context is not None and context.version > 0 and not context.unsaved and user_id not in self._dirty:
+                # Записанный ранее контекст удалён другим экземпляром (гость вышел из диалога с ИИ)
+                self._remove(user_id)
+                self._dirty.discard(user_id)
+                return None
+            return context
+
+        if context is None:
+            context = StoredContext.from_payload(payload)
+            self._restore(user_id, context, dirty=False)
+            return context
+
+        if payload.get("version", 0) > context.version:
+            self.reloads += 1
+            self._rebase(user_id, context, payload)
+        return context
+
+    def create(self, user_id: int, system: Optional[str] = None) -> StoredContext:
+        """Создаёт новый контекст (старый, если был, заменяется)"""
+        self.delete(user_id)
+        context = StoredContext(system=system)
+        context.recount()
+        self._bytes += context.size_bytes
+        self._contexts[user_id] = context
+        self._mark_dirty(user_id)
+        self._enforce_limits()
+        return context
+
+    def set_system(self, user_id: int, system: str) -> Optional[StoredContext]:
+        """Задаёт системный промт контексту из памяти; None, если контекста нет"""
+        context = self.get(user_id)
+        if context is None:
+            return None
+        old = context.system
+        if old is not None:
+            context.tokens -= estimate_tokens(old)
+            context.size_bytes -= len(old.encode("utf-8"))
+            self._bytes -= len(old.encode("utf-8"))
+        context.system = system
+        size = len(system.encode("utf-8"))
+        context.tokens += estimate_tokens(system)
+        context.size_bytes += size
+        context.updated_at = time()
+        self._bytes += size
+
+        self._trim(context)
+        self._mark_dirty(user_id)
+        self._enforce_limits()
+        return context
+
+    def append(self, user_id: int, role: str, content: str) -> Optional[StoredContext]:
+        """Добавляет реплику в контекст из памяти и обрезает его по бюджету токенов; None, если контекста нет"""
+        context = self.get(user_id)
+        if context is None:
+            # Вытесненный или истёкший контекст не пересоздаётся пустым: при записи
+            # он затёр бы сохранённую историю гостя вместе с системным промтом
+            return None
+        size = len(content.encode("utf-8"))
+        context.turns.append((ROLE_CODES[role], content))
+        context.tokens += estimate_tokens(content)
+        context.size_bytes += size
+        context.updated_at = time()
+        context.unsaved += 1
+        self._bytes += size
+
+        self._trim(context)
+        self._mark_dirty(user_id)
+        self._enforce_limits()
+        return context
+
+    async def add_turns(self, user_id: int, *turns: Tuple[str, str]) -> Optional[StoredContext]:
+        """Добавляет реплики (роль, текст), при необходимости прочитав контекст из хранилища; None, если контекста нет"""
+        context = await self.fetch(user_id)
+        for role, content in turns:
+            context = self.append(user_id, role, content)
+        return context
+
+    def delete(self, user_id: int) -> None:
+        if user_id in self._contexts:
+            self._remove(user_id)
+        self._dirty.discard(user_id)
+        self._evicted.pop(user_id, None)
+        if self.backend is not None:
+            self._deleted.add(user_id)
+            self._request_flush()
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения в постоянное хранилище"""
+        if self.backend is None:
+            return
+        async with self._flush_lock:
+            if not (self._dirty or self._evicted or self._deleted):
+                return
+
+            deleted = set(self._deleted)
+            contexts = {user_id: self._contexts[user_id] for user_id in self._dirty if user_id in self._contexts}
+            contexts.update(self._evicted)
+            self._deleted.clear()
+            self._dirty.clear()
+            self._evicted.clear()
+            # Сколько реплик уходит в запись: добавленные за время записи останутся несохранёнными
+            written = {user_id: (context.unsaved, context.version + 1) for user_id, context in contexts.items()}
+
+            self._writing = set(contexts)
+            try:
+                if deleted:
+                    await self.backend.set_many(CONTEXT_NAMESPACE, {str(user_id): None for user_id in deleted})
+                conflicts = await self.backend.set_versioned(CONTEXT_NAMESPACE, {
+                    str(user_id): context.to_payload(written[user_id][1])
+                    for user_id, context in contexts.items()
+                })
+            except Exception as e:
+                print(f"Ошибка сохранения контекстов: {e}")
+                self._deleted |= deleted
+                for user_id, context in contexts.items():
+                    self._requeue(user_id, context)
+                return
+            finally:
+                self._writing = set()
+
+            for user_id, context in contexts.items():
+                if str(user_id) in conflicts:
+                    continue
+                saved, version = written[user_id]
+                context.version = max(context.version, version)
+                context.unsaved = max(0, context.unsaved - saved)
+                if context.unsaved:
+                    self._requeue(user_id, context)
+
+            # Запись изменили на другом экземпляре: объединяем и пишем при следующем проходе
+            for key in conflicts:
+                user_id = int(key)
+                context = contexts[user_id]
+                self.conflicts += 1
+                try:
+                    payload = await self.backend.get(CONTEXT_NAMESPACE, key)
+                except Exception as e:
+                    print(f"Ошибка чтения контекста {key}: {e}")
+                    self._requeue(user_id, context)
+                    continue
+                if payload is None:
+                    # Запись удалили — несохранённые реплики создадут её заново
+                    context.version = 0
+                else:
+                    self._rebase(user_id, context, payload)
+                self._requeue(user_id, context)
+            if conflicts:
+                self._request_flush(force=True)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "users": len(self._contexts),
+            "bytes": self._bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "unsaved": len(self._dirty) + len(self._evicted) + len(self._deleted),
+            "reloads": self.reloads,
+            "conflicts": self.conflicts,
+        }
+
+    def _rebase(self, user_id: int, context: StoredContext, payload: Dict[str, Any]) -> None:
+        # Копия перестраивается по записи из хранилища, несохранённые реплики добавляются в конец
+        remote = StoredContext.from_payload(payload)
+        unsaved_turns = context.turns[len(context.turns) - context.unsaved:] if context.unsaved else []
+        old_size = context.size_bytes
+        if remote.system is not None:
+            context.system = remote.system
+        context.turns = remote.turns + unsaved_turns
+        context.version = remote.version
+        context.updated_at = max(context.updated_at, remote.updated_at)
+        context.recount()
+        resident = self._contexts.get(user_id) is context
+        if resident:
+            self._bytes += context.size_bytes - old_size
+        self._trim(context, resident=resident)
+
+    def _trim(self, context: StoredContext, resident: bool = True) -> None:
+        # Удаляем самые старые реплики, пока не уложимся в бюджет; последняя реплика остаётся всегда
+        while context.tokens > self.token_budget and len(context.turns) > 1:
+            _, content = context.turns.pop(0)
+            size = len(content.encode("utf-8"))
+            context.tokens -= estimate_tokens(content)
+            context.size_bytes -= size
+            if resident:
+                self._bytes -= size
+        context.unsaved = min(context.unsaved, len(context.turns))
+
+    def _restore(self, user_id: int, context: StoredContext, dirty: bool = True) -> None:
+        context.last_access = monotonic()
+        self._contexts[user_id] = context
+        self._bytes += context.size_bytes
+        if dirty:
+            self._dirty.add(user_id)
+        self._trim(context)
+        self._enforce_limits()
+
+    def _requeue(self, user_id: int, context: StoredContext) -> None:
+        if self._contexts.get(user_id) is context:
+            self._dirty.add(user_id)
+        elif user_id not in self._contexts and user_id not in self._deleted:
+            self._evicted.setdefault(user_id, context)
+
+    def _remove(self, user_id: int) -> None:
+        context = self._contexts.pop(user_id)
+        self._bytes -= context.size_bytes
+
+    def _evict(self, user_id: int) -> None:
+        if user_id in self._dirty:
+            # Несохранённый контекст уходит из памяти, но не теряется
+            self._evicted[user_id] = self._contexts[user_id]
+            self._dirty.discard(user_id)
+        self._remove(user_id)
+
+    def _enforce_limits(self) -> None:
+        # Вытесняем самых давно активных, но не только что использованный контекст
+        while len(self._contexts) > 1 and (
+            len(self._contexts) > self.max_users or self._bytes > self.max_bytes
+        ):
+            self._evict(next(iter(self._contexts)))
+            self.evictions += 1
+
+    def _mark_dirty(self, user_id: int) -> None:
+        if self.backend is not None:
+            self._dirty.add(user_id)
+            self._request_flush()
+
+    def _request_flush(self, force: bool = False) -> None:
+        pending = len(self._dirty) + len(self._evicted) + len(self._deleted)
+        if self._flush_event and (force or pending >= CONTEXT_FLUSH_BATCH):
+            self._flush_event.set()
+
+    async def _run_flusher(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), CONTEXT_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+
+context_store = ContextStore()
@@ -1,10 +1,17 @@
 import os
 import re
+import io
+import csv
 import json
+import tempfile
+from dataclasses import dataclass
+from typing import IO, TYPE_CHECKING, Awaitable, Callable, Iterable, Iterator, Optional
 from datetime import time, date
+from time import perf_counter
 from sqlalchemy import select, and_, update
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy import func
+from sqlalchemy.sql import text
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
@@ -21,8 +28,13 @@ sys.path.append(str(project_root))  # Добавляем корень в sys.pat
 from Database.db_create import User, Conversation, Message
 from Database.db_create import DB_HOST, DB_NAME, DB_PORT, DB_USER, DB_PASSWORD
 from keyboards import get_cancel_keyboard
-from db_operations.process_messages import process_single_message, embedding_single_message
-from config import owners
+from db_operations.process_messages import embedding_many_messages, preprocessor
+from db_operations.extracting_style import style_digests
+from db_operations.transcripts import TranscriptReader, dedup_first_message, batched
+from config import owners, EMBEDDING_BATCH_SIZE, INGESTION_BULK_COPY, INGESTION_SPOOL_BYTES
+
+if TYPE_CHECKING:
+    from db_operations.ingestion_jobs import IngestionQueue
 
 async def get_sessionmaker(dispatcher: Dispatcher) -> async_sessionmaker[AsyncSession]:
     return dispatcher['async_session_maker']
@@ -41,6 +53,9 @@ class UploadConversation(StatesGroup):
     time = State()
     json_file = State()
     
+# Данные FSM, которые заполняет диалог загрузки разговора
+UPLOAD_DATA_KEYS = ("conversation_date", "conversation_time", "last_message_id", "last_bot_message_id", "cancel_message_id")
+
 class UpdateUsernames(StatesGroup):
     waiting_for_username = State()  # Состояние ожидания ввода username
     current_speaker = State()      # Состояние для хранения текущего спикера
@@ -183,7 +198,7 @@ async def process_json_file(
     message: types.Message, 
     state: FSMContext, 
     bot: Bot,
-    async_session_maker: async_sessionmaker[AsyncSession] = Depends(get_sessionmaker)
+    ingestion_queue: "IngestionQueue"
 ):
     if not message.document.file_name.lower().endswith('.json'):
         await message.answer("Файл должен быть в формате JSON")
@@ -200,9 +215,9 @@ async def process_json_file(
                 message_id=data['last_bot_message_id']
             )
 
-        # Подготовка файла
+        # Подготовка файла: пока файл ждёт в очереди, следующий файл с тем же именем не должен его перезаписать
         file_name = message.document.file_name
-        file_path = os.path.join(JSON_FOLDER, file_name)
+        file_path = os.path.join(JSON_FOLDER, f"{message.message_id}_{file_name}")
         os.makedirs(JSON_FOLDER, exist_ok=True)
         
         await bot.download(
@@ -211,81 +226,39 @@ async def process_json_file(
         )
         print(f"[DEBUG] Файл {file_name} успешно скачан")
 
-        # Получаем дату и время из состояния
-        conversation_date = data['conversation_date']
-        conversation_time = data['conversation_time']
-        
-        # Обработка файла
-        async with async_session_maker() as session:
-            try:
-                # 1. Сначала добавляем данные в БД
-                participants_without_username = await process_json_and_insert_data(
-                    file_path=file_path,
-                    session=session,
-                    conversation_date=conversation_date,
-                    conversation_time=conversation_time
-                )
-                await session.commit()
-                
-                # 2. Теперь проверяем и исправляем файл
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    json_data = json.load(f)
-                
-                # Проверяем первые два сообщения
-                if len(json_data) >= 2:
-                    first_msg = json_data[0]
-                    second_msg = json_data[1]
-                    
-                    # Если первые два сообщения одинаковые (по тексту и спикеру)
-                    if (first_msg.get('text') == second_msg.get('text') and 
-                        first_msg.get('speaker') == second_msg.get('speaker')):
-                        
-                        # Удаляем дубликат
-                        json_data.pop(1)
-                        
-                        # Перезаписываем файл
-                        with open(file_path, 'w', encoding='utf-8') as f:
-                            json.dump(json_data, f, ensure_ascii=False, indent=2)
-                        
-                        print(f"[DEBUG] Удален дубликат первого сообщения в файле")
-                
-                # 3. Продолжаем обычную обработку
-                conversation_id = await get_next_conversation_id(session) - 1
-                
-                await message.answer(f"✅ Файл {file_name} успешно обработан\nДанные сохранены в БД")
-                
-                if participants_without_username:
-                    await state.update_data(
-                        conversation_id=conversation_id,
-                        participants_to_update=participants_without_username
-                    )
-                    await ask_for_usernames(message, state, participants_without_username)
-                else:
-                    await state.clear()
-                    
-            except Exception as db_error:
-                await session.rollback()
-                raise db_error
+        # Обработка идёт в фоне, ход загрузки показывается в отдельном сообщении
+        job = await ingestion_queue.submit(
+            chat_id=message.chat.id,
+            owner_id=message.from_user.id,
+            file_name=file_name,
+            file_path=file_path,
+            conversation_date=data['conversation_date'],
+            conversation_time=data['conversation_time']
+        )
+        print(f"[DEBUG] Загрузка {job.id} поставлена в очередь")
                 
     except Exception as e:
         error_msg = f"Ошибка при обработке файла: {str(e)}"
         print(f"[ERROR] {error_msg}")
         await message.answer(f"❌ {error_msg}")
     finally:
-        if 'participants_to_update' not in (await state.get_data()):
-            await state.clear()
-            print(f"[DEBUG] Состояние FSM очищено")
+        # Владелец может сразу загружать следующий файл. Удаляются только данные загрузки:
+        # завершившаяся раньше загрузка могла оставить ожидающий ввод username участников
+        data = await state.get_data()
+        await state.set_data({key: value for key, value in data.items() if key not in UPLOAD_DATA_KEYS})
+        await state.set_state(None)
+        print(f"[DEBUG] Состояние загрузки очищено")
             
 
-async def ask_for_usernames(message: types.Message, state: FSMContext, participants: list):
+async def ask_for_usernames(bot: Bot, chat_id: int, state: FSMContext, participants: list):
     """Отправляет сообщение с кнопками для выбора участника, которому нужно указать username"""
     # Удаляем предыдущие сообщения с кнопками
     data = await state.get_data()
     if 'username_messages' in data:
         try:
             for msg_id in data['username_messages']:
-                await message.bot.delete_message(
-                    chat_id=message.chat.id,
+                await bot.delete_message(
+                    chat_id=chat_id,
                     message_id=msg_id
                 )
         except Exception as e:
@@ -308,7 +281,8 @@ async def ask_for_usernames(message: types.Message, state: FSMContext, participa
         )
     ])
     
-    msg = await message.answer(
+    msg = await bot.send_message(
+        chat_id,
         "Необходимо указать tg_username для участников разговора:",
         reply_markup=keyboard
     )
@@ -358,6 +332,7 @@ async def process_username_input(
             select(User).where(User.id == speaker['id'])
         )
         current_user = current_user.scalar_one()
+        affected_ids = [current_user.id]
         
         if existing_user:
             # Если username уже существует
@@ -387,6 +362,7 @@ async def process_username_input(
                         conv.participants = new_participants
                 
                 await session.delete(current_user)
+                affected_ids.append(existing_user.id)
                 
             await message.answer(f"✅ Username {new_username} обновлён")
         else:
@@ -396,6 +372,13 @@ async def process_username_input(
         
         await session.commit()
         
+        # По новому username гость должен сразу получать пример стиля владельца
+        style_digests.invalidate(affected_ids)
+        try:
+            await style_digests.refresh(async_session_maker)
+        except Exception as e:
+            print(f"Ошибка обновления примеров стиля: {e}")
+        
         # Обновляем список участников, которым нужно указать username
         participants_to_update = data['participants_to_update']
         updated_participants = [
@@ -405,7 +388,7 @@ async def process_username_input(
         
         if updated_participants:
             await state.update_data(participants_to_update=updated_participants)
-            await ask_for_usernames(message, state, updated_participants)
+            await ask_for_usernames(message.bot, message.chat.id, state, updated_participants)
         else:
             # Удаляем все сообщения с кнопками
             if 'username_messages' in data:
@@ -509,76 +492,117 @@ async def get_next_conversation_id(session: AsyncSession) -> int:
 
 
 
-# Модифицируем функцию process_json_and_insert_data
-async def process_json_and_insert_data(
-    file_path: str,
-    session: AsyncSession,
-    conversation_date: str,
-    conversation_time: str
-) -> list:
-    """Обрабатывает JSON файл и вставляет данные в БД. 
-    Возвращает список участников без username (словари с id и name)."""
-    # Получаем следующий ID беседы
-    conversation_id = await get_next_conversation_id(session)
-    
-    # Преобразуем дату и время из строк в объекты
-    from datetime import datetime
-    conv_date = datetime.strptime(conversation_date, "%Y-%m-%d").date()
-    conv_time = datetime.strptime(conversation_time, "%H:%M").time()
+@dataclass
+class SpeakerTurn:
+    """Реплика спикера: подряд идущие сообщения одного спикера, объединённые в одно"""
+    speaker: str
+    texts: list[str]
+    message_time: time
+
+
+@dataclass
+class IngestionStats:
+    """Статистика загрузки разговора в БД"""
+    turns: int = 0
+    seconds: float = 0.0
+    write_seconds: float = 0.0
+    conversation_id: Optional[int] = None
     
-    # Создаём множество для хранения уникальных ID участников
-    participants_ids = set()
-    participants_without_username = []
+    @property
+    def turns_per_second(self) -> float:
+        return self.turns / self.seconds if self.seconds > 0 else 0.0
     
-    # Загружаем JSON для предварительного анализа участников
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    @property
+    def rows_per_second(self) -> float:
+        """Скорость записи строк messages (без предобработки и векторизации)"""
+        return self.turns / self.write_seconds if self.write_seconds > 0 else 0.0
+
+
+# Участники беседы одним запросом; если имя повторяется, берётся самый ранний пользователь
+FIND_SPEAKERS_QUERY = text("""
+    SELECT DISTINCT ON (name) id, name, tg_username
+    FROM users
+    WHERE name = ANY(CAST(:names AS text[]))
+    ORDER BY name, id
+""")
+
+# Недостающие участники создаются одной многострочной вставкой
+CREATE_SPEAKERS_QUERY = text("""
+    INSERT INTO users (name, tg_username)
+    SELECT name, 'unknown_' || name
+    FROM unnest(CAST(:names AS text[])) AS name
+    RETURNING id, name, tg_username
+""")
+
+# Ключ advisory-блокировки записи загружаемых бесед
+INGESTION_LOCK_KEY = 7_310_002
+
+MESSAGE_COPY_COLUMNS = ["user_id", "conversation_id", "text", "date", "time", "processed_text", "embeddings"]
+# Сколько строк кодируется в CSV и отправляется за один кусок COPY
+COPY_CHUNK_ROWS = 1000
+
+
+async def resolve_speakers(session: AsyncSession, speakers: set) -> dict:
+    """Возвращает {имя спикера: (id, tg_username)}, создавая недостающих пользователей"""
+    names = sorted(speakers)
+    result = await session.execute(FIND_SPEAKERS_QUERY, {"names": names})
+    users = {name: (user_id, tg_username) for user_id, name, tg_username in result}
     
-    # Сначала собираем всех уникальных спикеров из JSON
-    speakers = {item['speaker'] for item in data if 'speaker' in item}
+    missing = [name for name in names if name not in users]
+    if missing:
+        result = await session.execute(CREATE_SPEAKERS_QUERY, {"names": missing})
+        users.update({name: (user_id, tg_username) for user_id, name, tg_username in result})
     
-    # Для каждого спикера находим или создаём пользователя и добавляем его ID
-    for speaker in speakers:
-        user = await session.execute(
-            select(User).where(User.name == speaker)
-        )
-        user = user.scalar_one_or_none()
-        
-        if not user:
-            user = User(
-                name=speaker,
-                tg_username=f"unknown_{speaker}"
-            )
-            session.add(user)
-            await session.flush()  # Чтобы получить ID
-        
-        participants_ids.add(user.id)
-        
-        # Если у пользователя стандартный username (начинается с unknown_), добавляем в список для обновления
-        if user.tg_username.startswith("unknown_"):
-            participants_without_username.append({
-                'id': user.id,
-                'name': user.name
-            })
+    return users
+
+
+def vector_literal(embedding) -> Optional[str]:
+    """Текстовое представление вектора pgvector: [0.1,0.2,...]"""
+    if embedding is None:
+        return None
+    # pgvector хранит float4: 7 значащих цифр достаточно и вдвое короче repr
+    return "[" + ",".join(["%.7g" % value for value in embedding]) + "]"
+
+
+async def copy_messages(session: AsyncSession, rows: Iterable[tuple]) -> None:
+    """
+    Пишет строки messages одной командой COPY в транзакции сессии.
     
-    # Создаем беседу с указанной датой, временем и участниками
-    conversation = Conversation(
-        id=conversation_id,
-        date_created=conv_date,
-        time_created=conv_time,
-        participants=list(participants_ids)  # Преобразуем множество в список
+    Формат CSV: вектор передаётся текстом и разбирается типом vector,
+    поэтому не нужен бинарный кодек pgvector на соединении.
+    Строки кодируются и отправляются пачками, а не одним буфером на всю беседу.
+    """
+    async def encoded_chunks():
+        for batch in batched(rows, COPY_CHUNK_ROWS):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+            writer.writerows(batch)
+            yield buffer.getvalue().encode("utf-8")
+    
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_to_table(
+        "messages",
+        source=encoded_chunks(),
+        columns=MESSAGE_COPY_COLUMNS,
+        format="csv",
+        force_null=["embeddings"]  # пустой вектор ("") записывается как NULL
     )
-    session.add(conversation)
-    
-    if not data:
-        return participants_without_username
+
+
+def collect_speaker_turns(items: Iterable[dict], conv_time: time) -> Iterator[SpeakerTurn]:
+    """Склеивает подряд идущие сообщения одного спикера в реплики (по мере чтения сообщений)"""
+    items = iter(items)
+    first_item = next(items, None)
+    if first_item is None:
+        return
     
     # Инициализация первым сообщением
-    first_item = data[0]
     previous_speaker = first_item.get('speaker')
     combined_texts = [first_item.get('text')] if previous_speaker else []
+    message_time = conv_time
 
-    for item in data[1:]:  # Обрабатываем остальные сообщения
+    for item in items:  # Обрабатываем остальные сообщения
         speaker = item.get('speaker')
         text = item.get('text')
         start = item.get('start')
@@ -598,160 +622,266 @@ async def process_json_and_insert_data(
             combined_texts.append(text)
             continue
             
-        # Обрабатываем накопленные сообщения
+        # Сохраняем накопленные сообщения
         if combined_texts and previous_speaker:
-            await process_speaker_messages(
-                session=session,
-                speaker=previous_speaker,
-                texts=combined_texts,
-                conversation_id=conversation_id,
-                current_date=conv_date,
-                message_time=message_time
-            )
+            yield SpeakerTurn(previous_speaker, combined_texts, message_time)
             
         combined_texts = [text]
         previous_speaker = speaker
 
-    # Обрабатываем последнего спикера
+    # Последний спикер (используем последнее вычисленное время)
     if combined_texts and previous_speaker:
-        await process_speaker_messages(
-            session=session,
-            speaker=previous_speaker,
-            texts=combined_texts,
-            conversation_id=conversation_id,
-            current_date=conv_date,
-            message_time=message_time  # Используем последнее вычисленное время
-        )
+        yield SpeakerTurn(previous_speaker, combined_texts, message_time)
+
+
+def read_speaker_turns(reader: TranscriptReader, conv_time: time, speakers: set) -> Iterator[SpeakerTurn]:
+    """Реплики транскрипта по мере чтения файла; имена всех спикеров добавляются в speakers"""
+    def remember_speakers(items: Iterable[dict]) -> Iterator[dict]:
+        for item in items:
+            if 'speaker' in item:
+                speakers.add(item['speaker'])
+            yield item
     
-    return participants_without_username
+    return collect_speaker_turns(remember_speakers(dedup_first_message(reader)), conv_time)
+
 
+def spool_rows(batch: list[SpeakerTurn], raw_texts: list[str], processed_texts: list[str], embeddings: list) -> Iterator[tuple]:
+    """Строки промежуточного файла: спикер, текст, время, обработанный текст, вектор"""
+    for turn, raw_text, processed_text, embedding in zip(batch, raw_texts, processed_texts, embeddings):
+        yield turn.speaker, raw_text, str(turn.message_time), processed_text, vector_literal(embedding) or ""
 
-async def process_speaker_messages(
+
+async def insert_spooled_conversation(
     session: AsyncSession,
-    speaker: str,
-    texts: list[str],
-    conversation_id: int,
-    current_date: date,
-    message_time: time
-):
-    """Вспомогательная функция для обработки сообщений спикера"""
-    user = await session.execute(
-        select(User).where(User.name == speaker)
+    spool: IO[str],
+    speakers: set,
+    conv_date: date,
+    conv_time: time
+) -> tuple[list, int]:
+    """Записывает подготовленные реплики из промежуточного файла одной беседой.
+    Возвращает участников без username и ID беседы; транзакцию завершает вызывающий."""
+    participants_without_username = []
+    
+    # Запись — под блокировкой до конца транзакции: параллельные загрузки
+    # не должны получить один ID беседы или создать одного спикера дважды
+    await session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": INGESTION_LOCK_KEY})
+    
+    # Получаем следующий ID беседы
+    conversation_id = await get_next_conversation_id(session)
+    
+    # Всех уникальных спикеров находим (и недостающих создаём) двумя запросами на беседу
+    users_by_name = await resolve_speakers(session, speakers)
+    participants_ids = {user_id for user_id, _ in users_by_name.values()}
+    
+    # Если у пользователя стандартный username (начинается с unknown_), добавляем в список для обновления
+    for name, (user_id, tg_username) in users_by_name.items():
+        if tg_username and tg_username.startswith("unknown_"):
+            participants_without_username.append({
+                'id': user_id,
+                'name': name
+            })
+    
+    # Создаем беседу с указанной датой, временем и участниками
+    conversation = Conversation(
+        id=conversation_id,
+        date_created=conv_date,
+        time_created=conv_time,
+        participants=list(participants_ids)  # Преобразуем множество в список
     )
-    user = user.scalar_one_or_none()
+    session.add(conversation)
     
-    if not user:
-        user = User(
-            name=speaker,
-            tg_username=f"unknown_{speaker}"
+    # Новая беседа меняет пример стиля владельца для её участников
+    style_digests.invalidate(participants_ids)
+    
+    # Беседа должна попасть в БД раньше сообщений (внешний ключ)
+    await session.flush()
+    
+    spool.seek(0)
+    spooled = csv.reader(spool)
+    if INGESTION_BULK_COPY:
+        await copy_messages(session, (
+            (users_by_name[speaker][0], conversation_id, raw_text, str(conv_date), message_time,
+             processed_text, vector)
+            for speaker, raw_text, message_time, processed_text, vector in spooled
+        ))
+    else:
+        for batch in batched(spooled, EMBEDDING_BATCH_SIZE):
+            messages = [
+                Message(
+                    user_id=users_by_name[speaker][0],
+                    conversation_id=conversation_id,
+                    text=raw_text,
+                    date=conv_date,
+                    time=time.fromisoformat(message_time),
+                    processed_text=processed_text,
+                    embeddings=json.loads(vector) if vector else None
+                )
+                for speaker, raw_text, message_time, processed_text, vector in batch
+            ]
+            session.add_all(messages)
+            await session.flush()
+            # Записанные сообщения больше не нужны в сессии
+            for message in messages:
+                session.expunge(message)
+    
+    return participants_without_username, conversation_id
+
+
+async def process_json_and_insert_data(
+    file_path: str,
+    session: AsyncSession,
+    conversation_date: str,
+    conversation_time: str,
+    on_progress: Optional[Callable[[int, float], Awaitable[None]]] = None
+) -> tuple[list, IngestionStats]:
+    """Обрабатывает JSON файл и вставляет данные в БД. 
+    Возвращает список участников без username (словари с id и name) и статистику загрузки.
+    on_progress(обработано реплик, доля прочитанного файла) вызывается после каждой пачки реплик."""
+    started = perf_counter()
+    stats = IngestionStats()
+    
+    # Преобразуем дату и время из строк в объекты
+    from datetime import datetime
+    conv_date = datetime.strptime(conversation_date, "%Y-%m-%d").date()
+    conv_time = datetime.strptime(conversation_time, "%H:%M").time()
+    
+    # Сообщения читаются из файла потоком; спикеры запоминаются по ходу чтения
+    reader = TranscriptReader(file_path)
+    speakers = set()
+    turns = read_speaker_turns(reader, conv_time, speakers)
+    
+    # Обработанные реплики копятся во временном файле (в памяти до INGESTION_SPOOL_BYTES),
+    # а не в списке: ID беседы и спикеров известны только на этапе записи
+    with tempfile.SpooledTemporaryFile(
+        max_size=INGESTION_SPOOL_BYTES, mode="w+", encoding="utf-8", newline=""
+    ) as spool:
+        spool_writer = csv.writer(spool)
+        
+        # Обрабатываем реплики пачками: векторизация батчем в отдельном потоке
+        for batch in batched(turns, EMBEDDING_BATCH_SIZE):
+            raw_texts = ['/'.join(turn.texts) for turn in batch]
+            processed_texts = await preprocessor.aprocess_many(raw_texts)
+            embeddings = await embedding_many_messages(processed_texts)
+            spool_writer.writerows(spool_rows(batch, raw_texts, processed_texts, embeddings))
+            stats.turns += len(batch)
+            
+            if on_progress:
+                await on_progress(stats.turns, reader.fraction)
+        
+        if on_progress:
+            await on_progress(stats.turns, 1.0)
+        
+        write_started = perf_counter()
+        participants_without_username, stats.conversation_id = await insert_spooled_conversation(
+            session, spool, speakers, conv_date, conv_time
         )
-        session.add(user)
-        await session.flush()
-    
-    # Объединяем тексты
-    raw_text = '/'.join(texts)
-    
-    # Обрабатываем текст
-    processed_text = await process_single_message(raw_text)
-    
-    # Получаем эмбеддинг
-    embedding = await embedding_single_message(processed_text)
-    
-    message = Message(
-        user_id=user.id,
-        conversation_id=conversation_id,
-        text=raw_text,
-        date=current_date,
-        time=message_time,
-        processed_text=processed_text,
-        embeddings=embedding  # Добавляем эмбеддинг
+        stats.write_seconds = perf_counter() - write_started
+    
+    stats.seconds = perf_counter() - started
+    print(
+        f"[DEBUG] Загружено реплик: {stats.turns} за {stats.seconds:.2f} с ({stats.turns_per_second:.1f} реплик/с), "
+        f"запись в БД: {stats.write_seconds:.2f} с ({stats.rows_per_second:.0f} строк/с)"
     )
-    session.add(message)
     
+    return participants_without_username, stats
+
+
+# Окно контекста вокруг найденного сообщения: 2 предыдущих и 5 последующих реплик.
+# Все найденные сообщения обрабатываются одним запросом (LATERAL по индексу
+# messages (conversation_id, date, time, id)), вместе с именами авторов и датой беседы.
+MESSAGE_CONTEXT_QUERY = text("""
+    WITH hits AS (
+        SELECT h.id, h.score, h.ord
+        FROM unnest(CAST(:ids AS integer[]), CAST(:scores AS double precision[]))
+             WITH ORDINALITY AS h(id, score, ord)
+    ),
+    hit_messages AS (
+        SELECT hits.ord, hits.score, m.id, m.conversation_id, m.date, m.time
+        FROM hits
+        JOIN messages m ON m.id = hits.id
+    )
+    SELECT
+        hm.ord,
+        hm.score,
+        c.date_created,
+        c.time_created,
+        around.id = hm.id AS is_hit,
+        u.name,
+        around.text
+    FROM hit_messages hm
+    JOIN conversation c ON c.id = hm.conversation_id
+    CROSS JOIN LATERAL (
+        (
+            SELECT p.id, p.user_id, p.text, p.date, p.time
+            FROM messages p
+            WHERE p.conversation_id = hm.conversation_id
+              AND (p.date, p.time, p.id) < (hm.date, hm.time, hm.id)
+            ORDER BY p.date DESC, p.time DESC, p.id DESC
+            LIMIT :before
+        )
+        UNION ALL
+        (
+            SELECT m.id, m.user_id, m.text, m.date, m.time
+            FROM messages m
+            WHERE m.id = hm.id
+        )
+        UNION ALL
+        (
+            SELECT n.id, n.user_id, n.text, n.date, n.time
+            FROM messages n
+            WHERE n.conversation_id = hm.conversation_id
+              AND (n.date, n.time, n.id) > (hm.date, hm.time, hm.id)
+            ORDER BY n.date ASC, n.time ASC, n.id ASC
+            LIMIT :after
+        )
+    ) AS around
+    JOIN users u ON u.id = around.user_id
+    ORDER BY hm.ord, around.date, around.time, around.id
+""")
+
+
 async def get_message_contexts(
-    message_tuples: list[tuple[str, str, float]], 
+    message_tuples: list[tuple[int, str, str, float]], 
     session: AsyncSession
 ) -> str:
     """
     Формирует контекст для каждого сообщения из списка кортежей.
     
     Args:
-        message_tuples: Список кортежей (текст, обработанный текст, оценка сходства)
+        message_tuples: Список кортежей (id сообщения, текст, обработанный текст, оценка сходства)
         session: Асинхронная сессия SQLAlchemy
         
     Returns:
         Строка с контекстом для каждого сообщения в требуемом формате
     """
-    result = []
-    
-    for text, processed_text, similarity in message_tuples:
-        # Находим сообщение из кортежа в базе
-        message_query = select(Message).where(
-            and_(
-                Message.text == text,
-                Message.processed_text == processed_text
+    if not message_tuples:
+        return ""
+    
+    rows = await session.execute(
+        MESSAGE_CONTEXT_QUERY,
+        {
+            "ids": [message_id for message_id, _, _, _ in message_tuples],
+            "scores": [float(similarity) for _, _, _, similarity in message_tuples],
+            "before": 2,
+            "after": 5,
+        }
+    )
+    
+    # Группируем строки по найденному сообщению (порядок хитов сохраняется)
+    blocks = {}
+    for row in rows:
+        if row.ord not in blocks:
+            # Форматируем дату и время беседы
+            conv_date_time = (
+                f"{row.date_created.strftime('%Y-%m-%d')} "
+                f"{row.time_created.strftime('%H:%M:%S')}"
             )
-        )
-        message = (await session.execute(message_query)).scalar_one_or_none()
-        
-        if not message:
-            continue
-            
-        # Получаем информацию о беседе
-        conv_query = select(Conversation).where(Conversation.id == message.conversation_id)
-        conversation = (await session.execute(conv_query)).scalar_one()
-        
-        # Получаем информацию об авторе
-        user_query = select(User).where(User.id == message.user_id)
-        user = (await session.execute(user_query)).scalar_one()
-        
-        # Форматируем дату и время беседы
-        conv_date_time = (
-            f"{conversation.date_created.strftime('%Y-%m-%d')} "
-            f"{conversation.time_created.strftime('%H:%M:%S')}"
-        )
+            blocks[row.ord] = [f"Дата и время разговора: {conv_date_time}"]
         
-        # Получаем все сообщения из этой беседы в хронологическом порядке
-        messages_query = (
-            select(Message)
-            .where(Message.conversation_id == message.conversation_id)
-            .order_by(Message.date.asc(), Message.time.asc())
-        )
-        all_messages = (await session.execute(messages_query)).scalars().all()
-        
-        # Находим индекс текущего сообщения
-        try:
-            current_idx = [m.id for m in all_messages].index(message.id)
-        except ValueError:
-            continue
-            
-        # Формируем список сообщений для вывода
-        output_messages = []
-        
-        # 2 предыдущих сообщения
-        prev_messages = all_messages[max(0, current_idx-2):current_idx]
-        for msg in prev_messages:
-            user_query = select(User).where(User.id == msg.user_id)
-            msg_user = (await session.execute(user_query)).scalar_one()
-            output_messages.append(f"{msg_user.name}: {msg.text}")
-            
-        # Текущее сообщение
-        output_messages.append(f"{user.name}: {message.text} [similarity: {similarity:.2f}]")
-        
-        # 5 последующих сообщений
-        next_messages = all_messages[current_idx+1:current_idx+6]
-        for msg in next_messages:
-            user_query = select(User).where(User.id == msg.user_id)
-            msg_user = (await session.execute(user_query)).scalar_one()
-            output_messages.append(f"{msg_user.name}: {msg.text}")
-            
-        # Формируем блок для этого сообщения
-        block = [
-            f"Дата и время разговора: {conv_date_time}",
-            *output_messages,
-            ""  # Пустая строка для разделения блоков
-        ]
-        
-        result.append("\n".join(block))
+        if row.is_hit:
+            blocks[row.ord].append(f"{row.name}: {row.text} [similarity: {row.score:.2f}]")
+        else:
+            blocks[row.ord].append(f"{row.name}: {row.text}")
     
-    return "\n".join(result)
\ No newline at end of file
+    # Пустая строка для разделения блоков
+    return "\n".join("\n".join([*block, ""]) for block in blocks.values())
\ No newline at end of file
@@ -0,0 +1,136 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Deque, List, Optional, Tuple
+
+from config import EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_MAX_WAIT_MS
+from db_operations.process_messages import embedding_executor, _encode_batch
+from metrics import percentile
+
+
+@dataclass
+class EmbeddingMetrics:
+    """Метрики сервиса векторизации (по последним window батчам/запросам)"""
+    window: int = 1000
+    requests: int = 0
+    batches: int = 0
+    batch_sizes: Deque[int] = field(default_factory=deque)
+    queue_waits_ms: Deque[float] = field(default_factory=deque)
+    encode_ms: Deque[float] = field(default_factory=deque)
+
+    def record_batch(self, size: int, waits_ms: List[float], encode_ms: float) -> None:
+        self.requests += size
+        self.batches += 1
+        self._push(self.batch_sizes, size)
+        self._push(self.encode_ms, encode_ms)
+        for wait in waits_ms:
+            self._push(self.queue_waits_ms, wait)
+
+    def _push(self, values: deque, value) -> None:
+        values.append(value)
+        if len(values) > self.window:
+            values.popleft()
+
+    def snapshot(self) -> dict:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "avg_batch_size": sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else 0.0,
+            "max_batch_size": max(self.batch_sizes, default=0),
+            "queue_wait_p50_ms": percentile(self.queue_waits_ms, 50),
+            "queue_wait_p95_ms": percentile(self.queue_waits_ms, 95),
+            "encode_p95_ms": percentile(self.encode_ms, 95),
+        }
+
+
+class EmbeddingService:
+    """
+    Векторизация коротких запросов с микробатчингом.
+    
+    Конкурентные вызовы embed() собираются в очередь в течение max_wait_ms
+    (или пока не наберётся max_batch_size текстов) и векторизуются одним
+    вызовом model.encode в embedding_executor.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE,
+        max_wait_ms: float = EMBEDDING_MAX_WAIT_MS
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = EmbeddingMetrics()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def embed(self, text: str) -> Optional[List[float]]:
+        """Возвращает эмбеддинг текста (None для пустого текста)"""
+        if not text:
+            return None
+        
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future, perf_counter()))
+        return await future
+
+    def stats(self) -> dict:
+        return self.metrics.snapshot()
+
+    async def close(self) -> None:
+        """Останавливает фоновую задачу сбора батчей"""
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def _collect_batch(self) -> List[Tuple[str, asyncio.Future, float]]:
+        batch = [await self._queue.get()]
+        deadline = perf_counter() + self.max_wait
+        
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            started = perf_counter()
+            waits_ms = [(started - enqueued) * 1000 for _, _, enqueued in batch]
+            
+            try:
+                embeddings = await loop.run_in_executor(
+                    embedding_executor,
+                    _encode_batch,
+                    [text for text, _, _ in batch],
+                    self.max_batch_size
+                )
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            self.metrics.record_batch(len(batch), waits_ms, (perf_counter() - started) * 1000)
+            for (_, future, _), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding.tolist())
+
+
+# Общий сервис для векторизации поисковых фраз
+embedding_service = EmbeddingService()
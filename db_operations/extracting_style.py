@@ -1,65 +1,248 @@
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
-from Database.db_create import User, Conversation, Message  # Импортируем модели
+from collections import defaultdict
+from time import perf_counter
+from typing import Dict, Iterable, List, Optional, Set
 
-async def get_conversation_messages(
-    username_owner: str,
-    username_guest: str,
-    session: AsyncSession
-) -> str:
-    # Получаем id пользователей
-    owner_query = select(User.id).where(User.tg_username == username_owner)  # Используем User
-    guest_query = select(User.id).where(User.tg_username == username_guest)  # Используем User
-    
-    owner_id = (await session.execute(owner_query)).scalar()
-    guest_id = (await session.execute(guest_query)).scalar()
-    print(owner_id, guest_id)
-    if not owner_id or not guest_id:
-        return "Один из пользователей не найден"
-    
-    # Находим 3 последние беседы между этими пользователями
-    conv_query = (
-        select(Conversation.id)  # Используем Conversation
-        .where(Conversation.participants.contains([owner_id, guest_id]))
-        .order_by(Conversation.date_created.desc(), Conversation.time_created.desc())
-        .limit(3)
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import bindparam
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.sql import text
+
+from config import owner_username, STYLE_EXEMPLARS_LIMIT, STYLE_EXEMPLARS_CHAR_BUDGET, STYLE_EXEMPLARS_EF_SEARCH
+
+# Сколько последних бесед с гостем и сколько сообщений с начала и конца каждой беседы попадает в пример стиля
+STYLE_CONVERSATIONS = 3
+STYLE_EDGE_MESSAGES = 5
+STYLE_MESSAGE_CHARS = 200
+
+STYLE_SEPARATOR = "(Обращайся к пользователю также как это указано в примере сообщений): \n\n"
+
+# Одним запросом: последние беседы владельца с каждым гостем (row_number по беседам гостя)
+# и первые/последние сообщения каждой беседы (row_number в обе стороны)
+STYLE_DIGEST_QUERY = """
+    WITH owner AS (
+        SELECT id FROM users WHERE tg_username = :owner LIMIT 1
+    ),
+    recent AS (
+        SELECT guest_id, guest_username, conversation_id, conv_rank
+        FROM (
+            SELECT
+                g.id AS guest_id,
+                g.tg_username AS guest_username,
+                c.id AS conversation_id,
+                row_number() OVER (
+                    PARTITION BY g.id
+                    ORDER BY c.date_created DESC, c.time_created DESC, c.id DESC
+                ) AS conv_rank
+            FROM owner o
+            JOIN conversation c ON c.participants @> ARRAY[o.id]
+            JOIN users g ON g.id = ANY(c.participants) AND g.id <> o.id
+            WHERE g.tg_username IS NOT NULL AND {guest_filter}
+        ) ranked_conversations
+        WHERE conv_rank <= :conversations
+    ),
+    edges AS (
+        SELECT
+            r.guest_id, r.guest_username, r.conv_rank,
+            m.text, m.date, m.time, m.id,
+            row_number() OVER (PARTITION BY m.conversation_id ORDER BY m.date, m.time, m.id) AS from_start,
+            row_number() OVER (PARTITION BY m.conversation_id ORDER BY m.date DESC, m.time DESC, m.id DESC) AS from_end
+        FROM recent r
+        JOIN messages m ON m.conversation_id = r.conversation_id
     )
-    
-    conv_ids = (await session.execute(conv_query)).scalars().all()
-    
-    if not conv_ids:
-        return "Беседы между пользователями не найдены"
-    
+    SELECT guest_id, guest_username, conv_rank, left(text, :message_chars) AS text
+    FROM edges
+    WHERE from_start <= :edge OR from_end <= :edge
+    ORDER BY guest_id, conv_rank, date, time, id
+"""
+
+# Реплики владельца из бесед с гостем, ближайшие к сообщению гостя (HNSW индекс по embeddings)
+STYLE_EXEMPLARS_QUERY = text("""
+    WITH owner AS (
+        SELECT id FROM users WHERE tg_username = :owner LIMIT 1
+    ),
+    guest AS (
+        SELECT id FROM users WHERE tg_username = :guest LIMIT 1
+    )
+    SELECT m.text
+    FROM messages m
+    JOIN owner o ON m.user_id = o.id
+    CROSS JOIN guest g
+    WHERE m.embeddings IS NOT NULL
+      AND m.conversation_id IN (
+          SELECT c.id FROM conversation c WHERE c.participants @> ARRAY[o.id, g.id]
+      )
+    ORDER BY m.embeddings <=> :embedding
+    LIMIT :limit
+""").bindparams(bindparam("embedding", type_=Vector()))
+
+
+def format_digest(conversations: List[List[str]]) -> str:
+    """Собирает пример стиля из сообщений бесед (от последней к более ранним)"""
     result = []
+    for i, messages in enumerate(conversations, 1):
+        conv_result = [f"Беседа {i}"]
+        conv_result.extend(messages)
+        result.append("\n".join(conv_result))
+    return STYLE_SEPARATOR.join(result)
+
+
+def pack_exemplars(texts: List[str], char_budget: int = STYLE_EXEMPLARS_CHAR_BUDGET) -> str:
+    """Укладывает реплики (от самых похожих) в лимит символов, пропуская повторы и не поместившиеся"""
+    packed = []
+    used = 0
+    seen = set()
+    for message_text in texts:
+        exemplar = message_text.strip()[:STYLE_MESSAGE_CHARS]
+        if not exemplar or exemplar in seen:
+            continue
+        if used + len(exemplar) + 1 > char_budget:
+            continue
+        seen.add(exemplar)
+        packed.append(exemplar)
+        used += len(exemplar) + 1
+    return "\n".join(packed)
+
+
+async def select_style_exemplars(
+    session_maker: async_sessionmaker[AsyncSession],
+    username_guest: str,
+    embedding: List[float],
+    username_owner: str = owner_username,
+    limit: int = STYLE_EXEMPLARS_LIMIT
+) -> Optional[str]:
+    """Пример стиля из реплик владельца, самых похожих на сообщение гостя, или None, если бесед нет"""
+    if not username_guest or embedding is None:
+        return None
     
-    for i, conv_id in enumerate(conv_ids, 1):
-        # Получаем первые 5 сообщений
-        first_messages_query = (
-            select(Message.text)  # Используем Message
-            .where(Message.conversation_id == conv_id)
-            .order_by(Message.date.asc(), Message.time.asc())
-            .limit(5)
+    async with session_maker() as session:
+        # Без запаса кандидатов индекс вернёт ef_search ближайших по всей базе, и фильтр по гостю их отсеет
+        await session.execute(
+            text("SELECT set_config('hnsw.ef_search', :ef_search, true)"),
+            {"ef_search": str(STYLE_EXEMPLARS_EF_SEARCH)}
         )
-        first_messages = (await session.execute(first_messages_query)).scalars().all()
-        
-        # Получаем последние 5 сообщений
-        last_messages_query = (
-            select(Message.text)  # Используем Message
-            .where(Message.conversation_id == conv_id)
-            .order_by(Message.date.desc(), Message.time.desc())
-            .limit(5)
+        result = await session.execute(
+            STYLE_EXEMPLARS_QUERY,
+            {"owner": username_owner, "guest": username_guest, "embedding": embedding, "limit": limit}
         )
-        last_messages = (await session.execute(last_messages_query)).scalars().all()
-        last_messages.reverse()  # Чтобы сохранить хронологический порядок
-        
-        # Объединяем и обрезаем сообщения
-        all_messages = first_messages + last_messages
-        trimmed_messages = [msg[:200] for msg in all_messages]
-        
-        # Формируем результат для этой беседы
-        conv_result = [f"Беседа {i}"]
-        conv_result.extend(trimmed_messages)
-        
-        result.append("\n".join(conv_result))
+        texts = result.scalars().all()
     
-    return "(Обращайся к пользователю также как это указано в примере сообщений): \n\n".join(result)
+    return pack_exemplars(texts) or None
+
+
+class StyleDigestCache:
+    """
+    Готовые примеры стиля владельца для каждого гостя.
+
+    Все примеры строятся одним запросом при старте, поэтому первое сообщение
+    сессии не делает запросов к БД. После загрузки новой беседы её участники
+    помечаются устаревшими и пересчитываются тем же запросом только для них.
+    """
+
+    def __init__(self, owner: str = owner_username):
+        self.owner = owner
+        self._digests: Dict[str, Optional[str]] = {}
+        self._usernames: Dict[int, str] = {}
+        self._stale: Set[int] = set()
+        self._loaded = False
+        self.hits = 0
+        self.queries = 0
+
+    async def _query(self, session: AsyncSession, guest_filter: str, params: dict) -> Dict[int, tuple]:
+        """Возвращает {id гостя: (username, пример стиля)} для гостей, подходящих под фильтр"""
+        self.queries += 1
+        result = await session.execute(
+            text(STYLE_DIGEST_QUERY.format(guest_filter=guest_filter)),
+            {
+                "owner": self.owner,
+                "conversations": STYLE_CONVERSATIONS,
+                "edge": STYLE_EDGE_MESSAGES,
+                "message_chars": STYLE_MESSAGE_CHARS,
+                **params
+            }
+        )
+
+        conversations: Dict[int, Dict[int, List[str]]] = defaultdict(lambda: defaultdict(list))
+        usernames: Dict[int, str] = {}
+        for guest_id, guest_username, conv_rank, message_text in result:
+            usernames[guest_id] = guest_username
+            conversations[guest_id][conv_rank].append(message_text)
+
+        return {
+            guest_id: (usernames[guest_id], format_digest([by_rank[rank] for rank in sorted(by_rank)]))
+            for guest_id, by_rank in conversations.items()
+        }
+
+    def _store(self, digests: Dict[int, tuple]) -> None:
+        for guest_id, (username, digest) in digests.items():
+            old_username = self._usernames.get(guest_id)
+            if old_username and old_username != username:
+                self._digests.pop(old_username, None)
+            self._usernames[guest_id] = username
+            self._digests[username] = digest
+
+    async def load(self, session_maker: async_sessionmaker[AsyncSession]) -> None:
+        """Строит примеры стиля для всех гостей владельца"""
+        started = perf_counter()
+        try:
+            async with session_maker() as session:
+                digests = await self._query(session, "TRUE", {})
+        except Exception as e:
+            # Без предзагрузки примеры стиля строятся по одному при первом сообщении гостя
+            print(f"Ошибка построения примеров стиля: {e}")
+            return
+        self._digests.clear()
+        self._usernames.clear()
+        self._store(digests)
+        self._loaded = True
+        print(f"Примеры стиля построены для {len(digests)} гостей за {perf_counter() - started:.2f} с")
+
+    def invalidate(self, user_ids: Iterable[int]) -> None:
+        """Помечает примеры стиля участников устаревшими (после загрузки беседы или смены username)"""
+        for user_id in user_ids:
+            username = self._usernames.pop(user_id, None)
+            if username is not None:
+                self._digests.pop(username, None)
+            self._stale.add(user_id)
+        # Гость без бесед мог появиться в новой беседе под ещё не известным id
+        self._digests = {username: digest for username, digest in self._digests.items() if digest is not None}
+
+    async def refresh(self, session_maker: async_sessionmaker[AsyncSession]) -> None:
+        """Пересчитывает устаревшие примеры стиля одним запросом"""
+        if not self._stale:
+            return
+        user_ids = set(self._stale)
+        async with session_maker() as session:
+            digests = await self._query(session, "g.id = ANY(:guest_ids)", {"guest_ids": list(user_ids)})
+        self._stale -= user_ids
+        self._store(digests)
+
+    async def get(self, session_maker: async_sessionmaker[AsyncSession], username: str) -> Optional[str]:
+        """Пример стиля для гостя или None, если бесед с ним нет"""
+        if not username:
+            return None
+        if username in self._digests:
+            self.hits += 1
+            return self._digests[username]
+
+        # Все гости уже известны и ничего не устарело — бесед с этим пользователем нет
+        if self._loaded and not self._stale:
+            self.hits += 1
+            return None
+
+        async with session_maker() as session:
+            digests = await self._query(session, "g.tg_username = :username", {"username": username})
+        self._store(digests)
+        if not digests:
+            self._digests[username] = None
+        return self._digests[username]
+
+    def stats(self) -> dict:
+        return {
+            "guests": sum(digest is not None for digest in self._digests.values()),
+            "hits": self.hits,
+            "queries": self.queries,
+            "stale": len(self._stale),
+        }
+
+
+style_digests = StyleDigestCache()
@@ -0,0 +1,393 @@
+import asyncio
+import os
+import socket
+import uuid
+from time import monotonic
+from typing import List, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from sqlalchemy import select, update, func, or_, and_, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from Database.db_create import IngestionJob
+from db_operations.db_operatins import process_json_and_insert_data, ask_for_usernames, IngestionStats
+from db_operations.extracting_style import style_digests
+from answer_cache import answer_cache
+from config import INGESTION_WORKERS, INGESTION_PROGRESS_INTERVAL, INGESTION_HEARTBEAT_INTERVAL, INGESTION_LEASE_SECONDS
+
+# Статусы загрузки
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+ACTIVE_STATUSES = (JOB_QUEUED, JOB_RUNNING)
+
+
+class LeaseLost(Exception):
+    """Аренду задачи перехватил другой экземпляр: результат этого не сохраняется"""
+
+
+def format_eta(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.0f} с"
+    return f"{seconds // 60:.0f} мин {seconds % 60:.0f} с"
+
+
+class JobProgress:
+    """Сообщение владельцу о ходе загрузки: обновляется не чаще раза в interval секунд"""
+
+    def __init__(
+        self,
+        bot: Bot,
+        session_maker: async_sessionmaker[AsyncSession],
+        job: IngestionJob,
+        interval: float = INGESTION_PROGRESS_INTERVAL
+    ):
+        self.bot = bot
+        self.session_maker = session_maker
+        self.job = job
+        self.interval = interval
+        self.started = monotonic()
+        self._next_update = 0.0
+
+    async def update(self, done: int, fraction: float) -> None:
+        """Вызывается после каждой пачки реплик; fraction — доля прочитанного файла"""
+        now = monotonic()
+        if now < self._next_update and fraction < 1:
+            return
+        self._next_update = now + self.interval
+
+        if fraction < 1:
+            # Общее число реплик неизвестно до конца чтения — оценка по доле файла
+            eta = (now - self.started) / fraction * (1 - fraction) if fraction else 0.0
+            await self.show(
+                f"⏳ {self.job.file_name}: обработано {done} реплик ({fraction:.0%}), "
+                f"осталось ~{format_eta(eta)}"
+            )
+        else:
+            await self.show(f"💾 {self.job.file_name}: {done} реплик обработано, запись в БД…")
+
+        # Прогресс в таблице нужен команде /jobs; ошибка записи не должна прерывать загрузку
+        try:
+            async with self.session_maker() as session:
+                await session.execute(
+                    update(IngestionJob)
+                    .where(IngestionJob.id == self.job.id)
+                    .values(turns_done=done)
+                )
+                await session.commit()
+        except Exception as e:
+            print(f"Ошибка сохранения прогресса загрузки {self.job.id}: {e}")
+
+    async def show(self, text: str) -> None:
+        if self.job.progress_message_id is None:
+            return
+        try:
+            await self.bot.edit_message_text(
+                text=text,
+                chat_id=self.job.chat_id,
+                message_id=self.job.progress_message_id
+            )
+        except Exception as e:
+            # Например, сообщение удалено или текст не изменился
+            print(f"Ошибка обновления сообщения о загрузке {self.job.id}: {e}")
+
+
+class IngestionQueue:
+    """
+    Фоновая обработка загруженных файлов разговоров.
+
+    Обработчик загрузки только сохраняет файл и ставит задачу в очередь,
+    поэтому владелец сразу может загружать следующий файл. Задачи хранятся
+    в таблице ingestion_jobs и выполняются workers воркерами.
+
+    Выполняемая задача арендуется экземпляром бота (worker_id), который раз
+    в heartbeat_interval секунд продлевает аренду (heartbeat_at). Задача,
+    аренду которой не продлевали lease_seconds секунд, считается брошенной
+    (экземпляр упал или был остановлен) и выполняется заново — её транзакция
+    откатилась. Задачи других работающих экземпляров не трогаются.
+
+    Файл загрузки лежит на диске экземпляра, который его принял (date_json/),
+    и в общую БД не копируется. Поэтому экземпляр подбирает только задачи,
+    файл которых есть у него локально: брошенная задача другого хоста ждёт,
+    пока не запустится экземпляр с тем же диском.
+
+    Беседа записывается и задача отмечается выполненной в одной транзакции,
+    причём только если аренда всё ещё у этого экземпляра: повторно
+    выполненная задача не создаёт дубликат беседы.
+    """
+
+    def __init__(
+        self,
+        workers: int = INGESTION_WORKERS,
+        heartbeat_interval: float = INGESTION_HEARTBEAT_INTERVAL,
+        lease_seconds: float = INGESTION_LEASE_SECONDS
+    ):
+        self.workers = workers
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_seconds = lease_seconds
+        # Уникален для каждого запуска: после перезапуска старая аренда не продлевается
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.bot: Optional[Bot] = None
+        self.dispatcher: Optional[Dispatcher] = None
+        self.session_maker: Optional[async_sessionmaker[AsyncSession]] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: Set[int] = set()
+        self._tasks: List[asyncio.Task] = []
+        self.completed = 0
+        self.failed = 0
+        self.reclaimed = 0
+
+    async def start(self, bot: Bot, dispatcher: Dispatcher) -> None:
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.session_maker = dispatcher['ingestion_session_maker']
+        self._queue = asyncio.Queue()
+
+        job_ids = await self._reclaim()
+        if job_ids:
+            print(f"Возобновлено загрузок: {len(job_ids)}")
+
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        # Прерванные загрузки этого экземпляра сразу возвращаются в очередь, не дожидаясь конца аренды
+        try:
+            async with self.session_maker() as session:
+                await session.execute(
+                    update(IngestionJob)
+                    .where(IngestionJob.status == JOB_RUNNING, IngestionJob.worker_id == self.worker_id)
+                    .values(status=JOB_QUEUED, worker_id=None, heartbeat_at=None, turns_done=0, started_at=None)
+                )
+                await session.commit()
+        except Exception as e:
+            print(f"Ошибка возврата загрузок в очередь: {e}")
+
+    async def submit(
+        self,
+        chat_id: int,
+        owner_id: int,
+        file_name: str,
+        file_path: str,
+        conversation_date: str,
+        conversation_time: str
+    ) -> IngestionJob:
+        """Сохраняет задачу и ставит её в очередь; ход загрузки показывается в отдельном сообщении"""
+        progress = await self.bot.send_message(chat_id, f"⏳ {file_name}: в очереди")
+
+        async with self.session_maker() as session:
+            job = IngestionJob(
+                chat_id=chat_id,
+                owner_id=owner_id,
+                file_name=file_name,
+                file_path=file_path,
+                conversation_date=conversation_date,
+                conversation_time=conversation_time,
+                status=JOB_QUEUED,
+                progress_message_id=progress.message_id
+            )
+            session.add(job)
+            await session.commit()
+
+        self._enqueue(job.id)
+        return job
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "workers": self.workers if self._tasks else 0,
+            "completed": self.completed,
+            "failed": self.failed,
+            "reclaimed": self.reclaimed,
+        }
+
+    def _enqueue(self, job_id: int) -> None:
+        if job_id not in self._queued:
+            self._queued.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    async def _reclaim(self) -> List[int]:
+        """
+        Возвращает в очередь брошенные загрузки и ставит в локальную очередь ожидающие.
+
+        Рассматриваются только задачи, файл которых есть на этом хосте.
+        Из экземпляров с общим диском задачу забирает тот, кто первым
+        переведёт её в running.
+        """
+        stale = and_(
+            IngestionJob.status == JOB_RUNNING,
+            or_(
+                IngestionJob.heartbeat_at.is_(None),
+                IngestionJob.heartbeat_at < func.now() - text(f"interval '{self.lease_seconds:g} seconds'")
+            )
+        )
+        async with self.session_maker() as session:
+            result = await session.execute(
+                select(IngestionJob.id, IngestionJob.file_path)
+                .where(or_(stale, IngestionJob.status == JOB_QUEUED))
+                .order_by(IngestionJob.id)
+            )
+            job_ids = [job_id for job_id, file_path in result.all() if os.path.exists(file_path)]
+            if job_ids:
+                result = await session.execute(
+                    update(IngestionJob)
+                    .where(IngestionJob.id.in_(job_ids), stale)
+                    .values(status=JOB_QUEUED, worker_id=None, heartbeat_at=None, turns_done=0, started_at=None)
+                    .returning(IngestionJob.id)
+                )
+                self.reclaimed += len(result.scalars().all())
+                await session.commit()
+
+        new_ids = [job_id for job_id in job_ids if job_id not in self._queued]
+        for job_id in new_ids:
+            self._enqueue(job_id)
+        return new_ids
+
+    async def _heartbeat(self) -> None:
+        """Продлевает аренду выполняемых задач и подбирает брошенные другими экземплярами"""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                async with self.session_maker() as session:
+                    await session.execute(
+                        update(IngestionJob)
+                        .where(IngestionJob.status == JOB_RUNNING, IngestionJob.worker_id == self.worker_id)
+                        .values(heartbeat_at=func.now())
+                    )
+                    await session.commit()
+                await self._reclaim()
+            except Exception as e:
+                print(f"Ошибка продления аренды загрузок: {e}")
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                print(f"Ошибка выполнения загрузки {job_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: int) -> None:
+        # Задачу забирает тот, кто первым перевёл её в running
+        async with self.session_maker() as session:
+            result = await session.execute(
+                update(IngestionJob)
+                .where(IngestionJob.id == job_id, IngestionJob.status == JOB_QUEUED)
+                .values(status=JOB_RUNNING, started_at=func.now(), worker_id=self.worker_id, heartbeat_at=func.now())
+                .returning(IngestionJob)
+            )
+            job = result.scalar_one_or_none()
+            await session.commit()
+        if job is None:
+            return
+
+        progress = JobProgress(self.bot, self.session_maker, job)
+        await progress.show(f"⏳ {job.file_name}: обработка…")
+
+        try:
+            async with self.session_maker() as session:
+                try:
+                    participants_without_username, stats = await process_json_and_insert_data(
+                        file_path=job.file_path,
+                        session=session,
+                        conversation_date=job.conversation_date,
+                        conversation_time=job.conversation_time,
+                        on_progress=progress.update
+                    )
+                    finished = await self._finish(
+                        job_id,
+                        session=session,
+                        status=JOB_DONE,
+                        conversation_id=stats.conversation_id,
+                        turns_done=stats.turns,
+                        turns_total=stats.turns
+                    )
+                    if not finished:
+                        raise LeaseLost(f"загрузку {job_id} уже выполняет другой экземпляр")
+                    await session.commit()
+                except Exception:
+                    await session.rollback()
+                    raise
+        except LeaseLost as e:
+            print(f"Результат загрузки {job.file_name} отброшен: {e}")
+            return
+        except Exception as e:
+            self.failed += 1
+            print(f"[ERROR] Ошибка при обработке файла {job.file_name}: {e}")
+            await self._finish(job_id, status=JOB_FAILED, error=str(e))
+            await progress.show(f"❌ Ошибка при обработке файла {job.file_name}: {e}")
+            return
+
+        self.completed += 1
+        await self._after_ingestion()
+        await progress.show(
+            f"✅ Файл {job.file_name} успешно обработан\nДанные сохранены в БД\n"
+            f"Реплик: {stats.turns} за {stats.seconds:.1f} с ({stats.turns_per_second:.1f} реплик/с), "
+            f"запись в БД: {stats.rows_per_second:.0f} строк/с"
+        )
+
+        if participants_without_username:
+            await self._ask_usernames(job, participants_without_username, stats)
+
+    async def _finish(self, job_id: int, session: Optional[AsyncSession] = None, **values) -> bool:
+        """
+        Завершает задачу, если она выполняется по аренде этого экземпляра; False — аренду перехватили.
+
+        С session изменение входит в её транзакцию (вместе с записанной беседой), иначе фиксируется сразу.
+        """
+        if session is None:
+            async with self.session_maker() as own_session:
+                finished = await self._finish(job_id, session=own_session, **values)
+                await own_session.commit()
+                return finished
+
+        result = await session.execute(
+            update(IngestionJob)
+            .where(
+                IngestionJob.id == job_id,
+                IngestionJob.status == JOB_RUNNING,
+                IngestionJob.worker_id == self.worker_id
+            )
+            .values(finished_at=func.now(), heartbeat_at=None, **values)
+            .returning(IngestionJob.id)
+        )
+        return result.scalar_one_or_none() is not None
+
+    async def _after_ingestion(self) -> None:
+        # Сохранённые ответы могли устареть: поиск теперь найдёт и новую беседу
+        answer_cache.clear()
+
+        # Примеры стиля участников новой беседы пересчитываются сразу, а не при первом сообщении
+        try:
+            await style_digests.refresh(self.session_maker)
+        except Exception as e:
+            print(f"Ошибка обновления примеров стиля: {e}")
+
+    async def _ask_usernames(self, job: IngestionJob, participants: list, stats: IngestionStats) -> None:
+        """Просит владельца указать username участников, как после загрузки без очереди"""
+        state = self.dispatcher.fsm.get_context(bot=self.bot, chat_id=job.chat_id, user_id=job.owner_id)
+        data = await state.get_data()
+
+        # Несколько загрузок могли завершиться подряд — список участников дополняется, а не заменяется
+        known_ids = {p['id'] for p in data.get('participants_to_update', [])}
+        participants_to_update = data.get('participants_to_update', []) + [
+            p for p in participants if p['id'] not in known_ids
+        ]
+        await state.update_data(
+            conversation_id=stats.conversation_id,
+            participants_to_update=participants_to_update
+        )
+        await ask_for_usernames(self.bot, job.chat_id, state, participants_to_update)
+
+
+ingestion_queue = IngestionQueue()
@@ -1,57 +1,151 @@
+import asyncio
 import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
 import nltk
 # Для эмбеддинга:
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from typing import List
+from typing import List, Optional
 
- 
+from config import EMBEDDING_BATCH_SIZE, PREPROCESS_LEMMA_CACHE_SIZE, PREPROCESS_INLINE_MAX_TEXTS
+from db_operations.resources import ensure_nltk_resources, get_model
+
+
+class TextPreprocessor:
+    """
+    Обработка текста сообщений: нижний регистр, удаление пунктуации, стоп-слов и лемматизация.
+    
+    Инструменты создаются один раз (при первом использовании или прогреве),
+    а результаты лемматизации кэшируются (лексика разговоров сильно
+    повторяется), поэтому для большинства токенов обработка сводится к поиску
+    в словаре.
+    """
+
+    def __init__(self, lemma_cache_size: int = PREPROCESS_LEMMA_CACHE_SIZE):
+        self.lemmatizer = None
+        self.stop_words = frozenset()
+        self.translator = str.maketrans('', '', string.punctuation)
+        self._lemmatize = lru_cache(maxsize=lemma_cache_size)(self._lemmatize_uncached)
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """Загружает стоп-слова и лемматизатор (ресурсы NLTK скачиваются только при отсутствии)"""
+        if self.lemmatizer is not None:
+            return
+        with self._lock:
+            if self.lemmatizer is not None:
+                return
+            ensure_nltk_resources()
+            self.stop_words = frozenset(stopwords.words('russian'))
+            lemmatizer = WordNetLemmatizer()
+            lemmatizer.lemmatize("прогрев")  # WordNet загружается лениво при первом вызове
+            self.lemmatizer = lemmatizer
+
+    def _lemmatize_uncached(self, word: str) -> str:
+        return self.lemmatizer.lemmatize(word)
+
+    def process(self, text: str) -> str:
+        """Обрабатывает один текст"""
+        self.load()
+        
+        # Нижний регистр и удаление пунктуации
+        text = text.lower().strip().translate(self.translator)
+        
+        # Токенизация, удаление стоп-слов и лемматизация
+        processed_words = [
+            self._lemmatize(word)
+            for word in nltk.word_tokenize(text)
+            if word not in self.stop_words and word.isalpha()
+        ]
+        
+        return ' '.join(processed_words)
+
+    def process_many(self, texts: List[str]) -> List[str]:
+        """Обрабатывает пачку текстов (для загрузки разговоров)"""
+        return [self.process(text) for text in texts]
+
+    async def aprocess_many(self, texts: List[str]) -> List[str]:
+        """Обрабатывает пачку текстов; большие пачки — в отдельном потоке, чтобы не блокировать event loop"""
+        if len(texts) <= PREPROCESS_INLINE_MAX_TEXTS:
+            return self.process_many(texts)
+        
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(preprocess_executor, self.process_many, texts)
+
+    def cache_info(self):
+        """Статистика кэша лемм (hits, misses, maxsize, currsize)"""
+        return self._lemmatize.cache_info()
+
+
+preprocess_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preprocess")
+
+# Один экземпляр на процесс
+preprocessor = TextPreprocessor()
 
-# Убедитесь, что эти ресурсы NLTK загружены
-nltk.download('punkt')
-nltk.download('stopwords')
-nltk.download('wordnet')
 
 async def process_single_message(text: str) -> str:
     """Обрабатывает текст сообщения: нижний регистр, удаление пунктуации, стоп-слов и лемматизация"""
-    # Инициализация инструментов обработки текста
-    lemmatizer = WordNetLemmatizer()
-    stop_words = set(stopwords.words('russian'))
-    translator = str.maketrans('', '', string.punctuation)
-    
-    # Обработка текста
-    text = text.lower().strip()
-    
-    # Удаление пунктуации
-    text = text.translate(translator)
-    
-    # Токенизация
-    words = nltk.word_tokenize(text)
-    
-    # Удаление стоп-слов и лемматизация
-    processed_words = [
-        lemmatizer.lemmatize(word) 
-        for word in words 
-        if word not in stop_words and word.isalpha()
-    ]
-    
-    return ' '.join(processed_words)
+    return preprocessor.process(text)
+
+
 
+# Модель загружается лениво: при первом обращении или фоновым прогревом (см. resources.warm_up)
 
+# Отдельный поток для model.encode, чтобы векторизация не блокировала event loop.
+# Один поток: torch сам распараллеливает батч, а параллельные encode только мешают друг другу
+embedding_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
 
-# Загружаем модель один раз при импорте
-model = SentenceTransformer('DeepPavlov/rubert-base-cased-sentence')
 
+def _encode_batch(texts: List[str], batch_size: int) -> np.ndarray:
+    """Синхронно векторизует список текстов (выполняется в embedding_executor)"""
+    return get_model().encode(
+        texts,
+        batch_size=batch_size,
+        convert_to_numpy=True,
+        show_progress_bar=False
+    )
 
-async def embedding_single_message(text: str) -> List[float]:
-    """Векторизует текст в 768-мерное пространство"""
-    if not text:
-        return None
+
+def encode_many(
+    texts: List[str],
+    batch_size: int = EMBEDDING_BATCH_SIZE
+) -> List[Optional[List[float]]]:
+    """
+    Синхронно векторизует список текстов (в embedding_executor или в процессе импорта).
+    
+    Пустые строки получают None;
+    порядок результата совпадает с порядком texts.
+    """
+    result: List[Optional[List[float]]] = [None] * len(texts)
+    non_empty = [(i, text) for i, text in enumerate(texts) if text]
+    if not non_empty:
+        return result
+    
+    embeddings = _encode_batch([text for _, text in non_empty], batch_size)
+    for (i, _), embedding in zip(non_empty, embeddings):
+        result[i] = embedding.tolist()
+    return result
+
+
+async def embedding_many_messages(
+    texts: List[str],
+    batch_size: int = EMBEDDING_BATCH_SIZE
+) -> List[Optional[List[float]]]:
+    """
+    Векторизует список текстов батчами в отдельном потоке.
+    
+    Args:
+        texts: Тексты для векторизации (пустые строки получают None)
+        batch_size: Размер батча для model.encode
     
-    # Получаем эмбеддинг
-    embedding = model.encode(text, convert_to_tensor=False)
+    Returns:
+        Список эмбеддингов в том же порядке, что и texts
+    """
+    if not any(texts):
+        return [None] * len(texts)
     
-    # Конвертируем numpy array в список float
-    return embedding.tolist()
\ No newline at end of file
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(embedding_executor, encode_many, texts, batch_size)
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import List, Tuple
+
+import nltk
+
+from config import EMBEDDING_MODEL_NAME
+
+# Ресурсы NLTK: имя для nltk.download -> путь для nltk.data.find
+NLTK_RESOURCES = {
+    'punkt': 'tokenizers/punkt',
+    'punkt_tab': 'tokenizers/punkt_tab',
+    'stopwords': 'corpora/stopwords',
+    'wordnet': 'corpora/wordnet',
+}
+
+
+class StartupTimer:
+    """Замеряет длительность фаз запуска бота"""
+
+    def __init__(self):
+        self.phases: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, perf_counter() - started))
+
+    def report(self) -> str:
+        with self._lock:
+            lines = [f"  {name}: {seconds * 1000:.0f} мс" for name, seconds in self.phases]
+        return "Время запуска по фазам:\n" + "\n".join(lines)
+
+
+startup_timer = StartupTimer()
+
+_nltk_lock = threading.Lock()
+_nltk_ready = False
+
+_model_lock = threading.Lock()
+_model = None
+
+
+def ensure_nltk_resources() -> None:
+    """Скачивает ресурсы NLTK, только если их нет локально"""
+    global _nltk_ready
+    if _nltk_ready:
+        return
+    
+    with _nltk_lock:
+        if _nltk_ready:
+            return
+        with startup_timer.phase("nltk"):
+            for name, path in NLTK_RESOURCES.items():
+                try:
+                    nltk.data.find(path)
+                except LookupError:
+                    print(f"Ресурс NLTK {name} не найден локально, скачиваем...")
+                    nltk.download(name, quiet=True)
+        _nltk_ready = True
+
+
+def get_model():
+    """
+    Возвращает модель SentenceTransformer, загружая её при первом обращении.
+    
+    Сначала модель ищется в локальном кэше HuggingFace без обращения к сети,
+    и только если весов нет — скачивается.
+    """
+    global _model
+    if _model is not None:
+        return _model
+    
+    with _model_lock:
+        if _model is not None:
+            return _model
+        with startup_timer.phase("model"):
+            # Импорт torch/sentence_transformers сам по себе занимает секунды
+            from sentence_transformers import SentenceTransformer
+            try:
+                _model = SentenceTransformer(EMBEDDING_MODEL_NAME, local_files_only=True)
+            except Exception:
+                print(f"Модель {EMBEDDING_MODEL_NAME} не найдена локально, скачиваем...")
+                _model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        return _model
+
+
+async def warm_up() -> None:
+    """Фоновый прогрев: ресурсы NLTK, модель и предобработчик текста загружаются в отдельном потоке"""
+    # Импорт здесь, чтобы не было циклической зависимости с process_messages
+    from db_operations.process_messages import preprocessor
+    
+    try:
+        await asyncio.to_thread(ensure_nltk_resources)
+        await asyncio.to_thread(preprocessor.load)
+        await asyncio.to_thread(get_model)
+        print(startup_timer.report())
+    except Exception as e:
+        print(f"Ошибка прогрева ресурсов: {e}")
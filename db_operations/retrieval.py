@@ -0,0 +1,219 @@
+import asyncio
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from config import (
+    SEARCH_MODE, SEARCH_LIMIT, SEARCH_THRESHOLD, HYBRID_CANDIDATES,
+    HYBRID_VECTOR_WEIGHT, HYBRID_LEXICAL_WEIGHT, HYBRID_RRF_K, SPECULATION_SIMILARITY
+)
+from Database.db_create import SearchHit, find_similar_messages, find_lexical_messages
+from db_operations.db_operatins import get_message_contexts
+from db_operations.embedding_service import embedding_service
+from db_operations.process_messages import process_single_message
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[tuple]],
+    weights: Sequence[float],
+    limit: int,
+    k: int = HYBRID_RRF_K
+) -> List[SearchHit]:
+    """
+    Сливает несколько ранжированных списков (id, текст, обработанный текст, оценка)
+    по формуле RRF: sum(weight / (k + rank)).
+    
+    Оценка нормируется на максимально возможную (первое место во всех списках),
+    поэтому остаётся в диапазоне 0-1, как у косинусного сходства.
+    """
+    scores: Dict[int, float] = {}
+    rows: Dict[int, tuple] = {}
+    
+    for ranking, weight in zip(rankings, weights):
+        for rank, row in enumerate(ranking, 1):
+            message_id = row[0]
+            scores[message_id] = scores.get(message_id, 0.0) + weight / (k + rank)
+            rows.setdefault(message_id, row)
+    
+    max_score = sum(weight / (k + 1) for weight in weights) or 1.0
+    best = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [
+        SearchHit(message_id, rows[message_id][1], rows[message_id][2], scores[message_id] / max_score)
+        for message_id in best
+    ]
+
+
+async def hybrid_search(
+    session_maker: async_sessionmaker[AsyncSession],
+    embedding: Optional[List[float]],
+    query_text: str,
+    processed_query: str,
+    limit: int = SEARCH_LIMIT
+) -> List[SearchHit]:
+    """Параллельно выполняет косинусный и триграммный поиск и сливает результаты через RRF"""
+    
+    async def vector_candidates():
+        if embedding is None:
+            return []
+        async with session_maker() as session:
+            return await find_similar_messages(
+                session=session,
+                embedding=embedding,
+                threshold=SEARCH_THRESHOLD,
+                limit=HYBRID_CANDIDATES
+            )
+    
+    async def lexical_candidates():
+        async with session_maker() as session:
+            return await find_lexical_messages(
+                session=session,
+                query_text=query_text,
+                processed_query=processed_query,
+                limit=HYBRID_CANDIDATES
+            )
+    
+    vector_hits, lexical_hits = await asyncio.gather(vector_candidates(), lexical_candidates())
+    return reciprocal_rank_fusion(
+        [vector_hits, lexical_hits],
+        [HYBRID_VECTOR_WEIGHT, HYBRID_LEXICAL_WEIGHT],
+        limit
+    )
+
+
+async def prepare_query(phrase: str) -> Tuple[str, Optional[List[float]]]:
+    """Лемматизирует поисковую фразу и векторизует её"""
+    processed_phrase = await process_single_message(phrase)
+    embedding = await embedding_service.embed(processed_phrase)
+    return processed_phrase, embedding
+
+
+async def search_messages(
+    session_maker: async_sessionmaker[AsyncSession],
+    phrase: str,
+    processed_phrase: Optional[str] = None,
+    embedding: Optional[List[float]] = None
+) -> List[SearchHit]:
+    """Ищет сообщения по поисковой фразе в режиме SEARCH_MODE"""
+    if processed_phrase is None:
+        processed_phrase, embedding = await prepare_query(phrase)
+    
+    if SEARCH_MODE == "hybrid":
+        return await hybrid_search(session_maker, embedding, phrase, processed_phrase)
+    
+    if embedding is None:
+        return []
+    async with session_maker() as session:
+        return await find_similar_messages(
+            session=session,
+            embedding=embedding,
+            threshold=SEARCH_THRESHOLD,
+            limit=SEARCH_LIMIT
+        )
+
+
+async def retrieve_context(
+    session_maker: async_sessionmaker[AsyncSession],
+    phrase: str,
+    processed_phrase: Optional[str] = None,
+    embedding: Optional[List[float]] = None
+) -> str:
+    """Находит сообщения по поисковой фразе и формирует для них контекст разговора"""
+    message_tuples = await search_messages(session_maker, phrase, processed_phrase, embedding)
+    async with session_maker() as session:
+        context = await get_message_contexts(
+            message_tuples=message_tuples,
+            session=session
+        )
+    print(f' Результаты поиска ({SEARCH_MODE}) \n{message_tuples} \n\nКонтекст:\n  {context}')
+    return context
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    a, b = np.asarray(a), np.asarray(b)
+    norm = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(a @ b / norm) if norm else 0.0
+
+
+@dataclass
+class SpeculationStats:
+    """Счётчики спекулятивного поиска"""
+    started: int = 0
+    hits: int = 0
+    misses: int = 0
+    unused: int = 0  # модель ответила без поисковой фразы
+    saved_seconds: float = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        resolved = self.hits + self.misses
+        return self.hits / resolved if resolved else 0.0
+
+
+speculation_stats = SpeculationStats()
+
+
+class SpeculativeRetrieval:
+    """
+    Поиск по исходному сообщению пользователя, запущенный параллельно с первым вызовом LLM.
+    
+    Если модель запросила |поисковую фразу|, близкую к сообщению пользователя
+    (косинусное сходство не ниже SPECULATION_SIMILARITY), используется уже
+    найденный контекст, иначе выполняется обычный поиск по фразе.
+    """
+
+    def __init__(
+        self,
+        session_maker: async_sessionmaker[AsyncSession],
+        text: str,
+        processed_text: Optional[str] = None,
+        embedding: Optional[List[float]] = None
+    ):
+        self.session_maker = session_maker
+        self.text = text
+        self.processed_text = processed_text
+        self.embedding = embedding
+        self.duration = 0.0
+        self._task = asyncio.create_task(self._prefetch())
+        speculation_stats.started += 1
+
+    async def _prefetch(self) -> str:
+        started = perf_counter()
+        if self.processed_text is None:
+            self.processed_text, self.embedding = await prepare_query(self.text)
+        context = await retrieve_context(self.session_maker, self.text, self.processed_text, self.embedding)
+        self.duration = perf_counter() - started
+        return context
+
+    async def resolve(self, phrase: str) -> str:
+        """Возвращает контекст для поисковой фразы, по возможности — предзагруженный"""
+        processed_phrase, phrase_embedding = await prepare_query(phrase)
+        
+        try:
+            waited_from = perf_counter()
+            context = await self._task
+            waited = perf_counter() - waited_from
+        except Exception as e:
+            print(f"Ошибка спекулятивного поиска: {e}")
+            context = None
+        
+        if (
+            context is not None
+            and self.embedding is not None
+            and phrase_embedding is not None
+            and cosine_similarity(self.embedding, phrase_embedding) >= SPECULATION_SIMILARITY
+        ):
+            speculation_stats.hits += 1
+            speculation_stats.saved_seconds += max(0.0, self.duration - waited)
+            return context
+        
+        speculation_stats.misses += 1
+        return await retrieve_context(self.session_maker, phrase, processed_phrase, phrase_embedding)
+
+    def cancel(self) -> None:
+        """Отменяет поиск, если модель ответила без поисковой фразы"""
+        speculation_stats.unused += 1
+        self._task.cancel()
@@ -0,0 +1,112 @@
+import codecs
+import json
+import os
+from itertools import islice
+from typing import Iterable, Iterator, List, TypeVar
+
+from config import TRANSCRIPT_READ_CHUNK_BYTES
+
+T = TypeVar("T")
+
+
+class TranscriptReader:
+    """
+    Потоковое чтение транскрипта — JSON-массива сообщений {speaker, text, start}.
+
+    Файл читается кусками по chunk_size байт, и элементы массива разбираются
+    по одному (json.JSONDecoder.raw_decode), поэтому в памяти находится
+    только текущий кусок, а не весь файл. fraction — доля прочитанного файла,
+    по ней оценивается оставшееся время загрузки.
+    """
+
+    def __init__(self, file_path: str, chunk_size: int = TRANSCRIPT_READ_CHUNK_BYTES):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(file_path)
+        self.bytes_read = 0
+        self.items = 0
+        self._decoder = json.JSONDecoder()
+
+    @property
+    def fraction(self) -> float:
+        return self.bytes_read / self.size if self.size else 1.0
+
+    def __iter__(self) -> Iterator[dict]:
+        utf8 = codecs.getincrementaldecoder("utf-8-sig")()
+        buffer = ""
+        pos = 0
+        eof = False
+        started = False
+        expect_value = True  # после '[' или ',' ждём элемент, после элемента — ',' или ']'
+
+        with open(self.file_path, "rb") as f:
+            while True:
+                # Пропускаем пробелы; если буфер кончился — дочитываем файл
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos == len(buffer):
+                    if eof:
+                        raise ValueError("Файл транскрипта оборвался: массив сообщений не закрыт")
+                    buffer, pos, eof = self._read_more(f, utf8, buffer, pos)
+                    continue
+
+                char = buffer[pos]
+                if not started:
+                    if char != "[":
+                        raise ValueError("Файл транскрипта должен содержать JSON-массив сообщений")
+                    started = True
+                    pos += 1
+                elif char == "]" and (expect_value is False or self.items == 0):
+                    return
+                elif not expect_value:
+                    if char != ",":
+                        raise ValueError(f"Ошибка разбора транскрипта после элемента {self.items}")
+                    expect_value = True
+                    pos += 1
+                else:
+                    try:
+                        item, end = self._decoder.raw_decode(buffer, pos)
+                    except json.JSONDecodeError:
+                        if eof:
+                            raise
+                        buffer, pos, eof = self._read_more(f, utf8, buffer, pos)
+                        continue
+                    # Число или литерал на границе куска мог разобраться не полностью
+                    if end == len(buffer) and not eof:
+                        buffer, pos, eof = self._read_more(f, utf8, buffer, pos)
+                        continue
+                    pos = end
+                    expect_value = False
+                    self.items += 1
+                    yield item
+
+    def _read_more(self, f, utf8, buffer: str, pos: int) -> tuple:
+        # Разобранную часть буфера отбрасываем, чтобы он не рос вместе с файлом
+        chunk = f.read(self.chunk_size)
+        self.bytes_read += len(chunk)
+        return buffer[pos:] + utf8.decode(chunk, final=not chunk), 0, not chunk
+
+
+def dedup_first_message(items: Iterable[dict]) -> Iterator[dict]:
+    """Пропускает второе сообщение, если оно повторяет первое (по тексту и спикеру)"""
+    items = iter(items)
+    first = next(items, None)
+    if first is None:
+        return
+    yield first
+
+    second = next(items, None)
+    if second is None:
+        return
+    if first.get('text') == second.get('text') and first.get('speaker') == second.get('speaker'):
+        print(f"[DEBUG] Пропущен дубликат первого сообщения")
+    else:
+        yield second
+    yield from items
+
+
+def batched(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Разбивает поток на списки по size элементов"""
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
@@ -1,29 +1,115 @@
-from typing import Dict, List
-from dataclasses import dataclass
-from openai import AsyncOpenAI
-from config import DEESEEK_API_KEY1, ADMIN_GROUP_ID, owner_username
+from typing import AsyncIterator, List, Optional
+from config import ADMIN_GROUP_ID, owner_username, STYLE_MODE
 from aiogram import Bot
 from models import UserData
-from db_operations.extracting_style import get_conversation_messages
+from db_operations.extracting_style import style_digests, select_style_exemplars
+from db_operations.retrieval import prepare_query
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from fastapi import Depends
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from db_operations.db_operatins import get_sessionmaker
+from context_store import context_store
+from llm_gateway import llm_gateway, LLMOverloaded
 
 import json
 import os
 
-client = AsyncOpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=DEESEEK_API_KEY1,
-)
+GENERATION_ERROR_TEXT = "Произошла ошибка при генерации ответа. Мы уже работаем над исправлением!"
+BUSY_TEXT = "Сейчас слишком много обращений, попробуйте написать через минуту."
 
-user_contexts: Dict[int, List[dict]] = {}
 
-@dataclass
-class ChatContext:
-    messages: List[dict]
-    max_length: int = 200
+def is_failed_answer(response: str) -> bool:
+    """Ответ — сообщение об ошибке, а не текст модели"""
+    return GENERATION_ERROR_TEXT in response or BUSY_TEXT in response
+
+
+async def notify_admins(bot: Bot, text: str) -> None:
+    """Отправляет сообщение об ошибке в админ-группу"""
+    if ADMIN_GROUP_ID:
+        try:
+            await bot.send_message(ADMIN_GROUP_ID, text)
+        except Exception as send_error:
+            print(f"Не удалось отправить сообщение админу: {send_error}")
+
+
+def load_prompt(promt_type: str) -> str:
+    if os.path.exists("promts.json"):
+        with open("promts.json", "r", encoding="utf-8") as file:
+            prompts = json.load(file)
+            return prompts.get(promt_type, "")
+    return ""
+
+
+async def build_system_prompt(
+    username: str,
+    text: str,
+    bot: Bot,
+    promt_type: str,
+    session_maker: async_sessionmaker[AsyncSession]
+) -> str:
+    """Системный промт с примерами стиля владельца для этого гостя"""
+    promt = load_prompt(promt_type)
+    
+    try:
+        conversation_history = None
+        if STYLE_MODE == "exemplars":
+            # Короткий пример стиля: реплики владельца, близкие к первому сообщению гостя
+            _, embedding = await prepare_query(text)
+            conversation_history = await select_style_exemplars(session_maker, username, embedding)
+        if not conversation_history:
+            # Пример стиля владельца заранее построен для каждого гостя, запросов к БД обычно нет
+            conversation_history = await style_digests.get(session_maker, username)
+        # Добавляем историю к промту только если она не пустая
+        if conversation_history:
+            promt = promt.replace('{пример реальных сообщений Владимира Викторовича}', conversation_history)
+            
+    except Exception as e:
+        print(f"Ошибка при получении истории бесед: {e}")
+        await notify_admins(bot, f"Ошибка при получении истории бесед: {e}")
+    
+    return promt
+
+
+async def start_dialogue(
+    user_id: int,
+    username: str,
+    text: str,
+    bot: Bot,
+    promt_type: str,
+    session_maker: async_sessionmaker[AsyncSession]
+) -> Optional[str]:
+    """Контекст диалога с системным промтом: создаёт новый или дополняет сохранённый без промта; возвращает промт"""
+    with_system = promt_type == "The_main_promt"
+    context = await context_store.fetch(user_id)
+    if context is not None and (context.system is not None or not with_system):
+        return context.system
+    
+    promt = await build_system_prompt(username, text, bot, promt_type, session_maker) if with_system else None
+    # Пока строился промт, контекст мог измениться — читаем заново
+    context = await context_store.fetch(user_id)
+    if context is None:
+        context_store.create(user_id, system=promt)
+    elif with_system and context.system is None:
+        context_store.set_system(user_id, promt)
+    else:
+        promt = context.system
+    return promt
+
+
+async def prepare_context(
+    user_id: int,
+    username: str,
+    text: str,
+    bot: Bot,
+    promt_type: str,
+    session_maker: async_sessionmaker[AsyncSession]
+) -> List[dict]:
+    """Добавляет сообщение в контекст диалога (при первом сообщении — с системным промтом) и возвращает сообщения для модели"""
+    await start_dialogue(user_id, username, text, bot, promt_type, session_maker)
+    
+    # После start_dialogue нет ожиданий, поэтому контекст в памяти.
+    # Он обрезается по бюджету токенов, системный промт сохраняется
+    return context_store.append(user_id, "user", text).messages()
 
 
 async def ai_generate(
@@ -35,72 +121,70 @@ async def ai_generate(
     promt_type: str,
     session_maker: async_sessionmaker[AsyncSession]  # Без значения по умолчанию
 ) -> str:
-    if user_id not in user_contexts:
-        user_contexts[user_id] = ChatContext(messages=[])
-    
-    context = user_contexts[user_id]
-
-    def load_prompt(promt_type: str) -> str:
-        if os.path.exists("promts.json"):
-            with open("promts.json", "r", encoding="utf-8") as file:
-                prompts = json.load(file)
-                return prompts.get(promt_type, "")
-        return ""
-    
-    if len(context.messages) == 0:
-        promt = load_prompt(promt_type)
+    messages = await prepare_context(user_id, username, text, bot, promt_type, session_maker)
+
+    try:
+        assistant_response = await llm_gateway.complete(user_id, messages)
+        await context_store.add_turns(user_id, ("assistant", assistant_response))
         
-        # Получаем историю сообщений из БД
-        conversation_history = ""
-        try:
-            async with session_maker() as session:
-                conversation_history = await get_conversation_messages(
-                    username_owner=owner_username,
-                    username_guest=username,
-                    session=session
-                )
-                print(conversation_history)
-                # Добавляем историю к промту только если она не пустая
-                if conversation_history and not conversation_history.startswith(("Один из пользователей не найден", "Беседы между пользователями не найдены")):
-                    promt = promt.replace('{пример реальных сообщений Владимира Викторовича}', conversation_history)
-                
-                    
-        except Exception as e:
-            print(f"Ошибка при получении истории бесед: {e}")
-            if ADMIN_GROUP_ID:
-                try:
-                    await bot.send_message(ADMIN_GROUP_ID, f"Ошибка при получении истории бесед: {e}")
-                except Exception as send_error:
-                    print(f"Не удалось отправить сообщение админу: {send_error}")
+        return assistant_response
         
-        if promt_type == "The_main_promt":
-            context.messages.append({"role": "system", "content": promt})
+    except LLMOverloaded:
+        # Перегрузка — штатная ситуация, администраторов не беспокоим
+        return BUSY_TEXT
+    except Exception as e:
+        error_msg = f"🚨 Critical API Error: {str(e)}"
+        print(error_msg)
+        await notify_admins(bot, error_msg)
+        return GENERATION_ERROR_TEXT
 
-    context.messages.append({"role": "user", "content": text})
 
-    if len(context.messages) > context.max_length * 2:
-        context.messages = context.messages[-context.max_length * 2:]
+async def ai_generate_stream(
+    user_id: int,
+    username: str,
+    text: str,
+    bot: Bot,
+    user_data: UserData,
+    promt_type: str,
+    session_maker: async_sessionmaker[AsyncSession]
+) -> AsyncIterator[str]:
+    """То же, что ai_generate, но отдаёт ответ по частям по мере генерации"""
+    messages = await prepare_context(user_id, username, text, bot, promt_type, session_maker)
+    parts = []
 
     try:
-        completion = await client.chat.completions.create(
-            model="deepseek/deepseek-chat-v3-0324:free",
-            messages=context.messages
-        )
-
-        assistant_response = completion.choices[0].message.content
-        context.messages.append({"role": "assistant", "content": assistant_response})
+        async for delta in llm_gateway.stream(user_id, messages):
+            parts.append(delta)
+            yield delta
         
-        return assistant_response
+        await context_store.add_turns(user_id, ("assistant", "".join(parts)))
         
+    except LLMOverloaded:
+        yield BUSY_TEXT
     except Exception as e:
         error_msg = f"🚨 Critical API Error: {str(e)}"
         print(error_msg)
-        if ADMIN_GROUP_ID:
-            try:
-                await bot.send_message(ADMIN_GROUP_ID, error_msg)
-            except Exception as send_error:
-                print(f"Не удалось отправить сообщение админу: {send_error}")
-        return "Произошла ошибка при генерации ответа. Мы уже работаем над исправлением!"
+        await notify_admins(bot, error_msg)
+        if parts:
+            # Сохраняем то, что успели получить, чтобы контекст не расходился с показанным
+            await context_store.add_turns(user_id, ("assistant", "".join(parts)))
+        yield GENERATION_ERROR_TEXT
+
+
+async def is_new_dialogue(user_id: int) -> bool:
+    """В диалоге ещё нет реплик: ответ зависит только от вопроса и системного промта"""
+    context = await context_store.fetch(user_id)
+    return context is None or not context.turns
+
+
+async def remember_exchange(user_id: int, question: str, answer: str) -> None:
+    """
+    Добавляет в контекст диалога вопрос и ответ, полученный без вызова модели (из кэша).
+    
+    Контекст должен быть уже создан через start_dialogue, иначе реплики не сохранятся.
+    """
+    await context_store.add_turns(user_id, ("user", question), ("assistant", answer))
+
 
 def clear_context(user_id: int):
-    user_contexts.pop(user_id, None)
\ No newline at end of file
+    context_store.delete(user_id)
\ No newline at end of file
@@ -0,0 +1,88 @@
+from collections import Counter
+from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject, User
+
+from config import owners, developers
+from lists_of_users.access_control import access_store
+
+
+class Role(str, Enum):
+    OWNER = "owner"
+    DEVELOPER = "developer"
+    ADMITTED = "admitted"
+    BLACKLISTED = "blacklisted"
+    UNKNOWN = "unknown"
+
+
+# Кому доступно общение с ИИ
+AI_ROLES = frozenset({Role.OWNER, Role.DEVELOPER, Role.ADMITTED})
+
+
+class AccessGateMiddleware(BaseMiddleware):
+    """
+    Определяет роль отправителя каждого апдейта до всех обработчиков.
+
+    Роль вычисляется один раз по спискам в памяти (ID владельцев и разработчиков
+    из config, списки доступа из access_store) и передаётся обработчикам
+    параметром role. Апдейты из чёрного списка отбрасываются сразу: до чтения
+    состояния FSM и тем более до вызова модели.
+    """
+
+    def __init__(self):
+        self.owner_ids = frozenset(owners)
+        self.developer_ids = frozenset(developers)
+        self.roles: Counter = Counter()
+        self.dropped = 0
+
+    def classify(self, user: Optional[User]) -> Role:
+        if user is None:
+            return Role.UNKNOWN
+        if user.id in self.owner_ids:
+            return Role.OWNER
+        if user.id in self.developer_ids:
+            return Role.DEVELOPER
+        if access_store.is_blacklisted(user.username):
+            return Role.BLACKLISTED
+        if access_store.is_admitted(user.username):
+            return Role.ADMITTED
+        return Role.UNKNOWN
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        role = self.classify(data.get("event_from_user"))
+        self.roles[role] += 1
+        if role is Role.BLACKLISTED:
+            self.dropped += 1
+            return None
+
+        data["role"] = role
+        return await handler(event, data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **{role.value: self.roles[role] for role in Role},
+            "dropped": self.dropped,
+        }
+
+
+access_gate = AccessGateMiddleware()
+
+
+def register_access_gate(dp: Dispatcher) -> None:
+    """
+    Подключает access_gate внешним middleware апдейтов.
+
+    Встроенный FSMContextMiddleware читает состояние из хранилища, поэтому
+    он временно снимается и возвращается после access_gate: отброшенные
+    апдейты не доходят до хранилища.
+    """
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware.register(access_gate)
+    dp.update.outer_middleware.register(dp.fsm)
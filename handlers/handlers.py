@@ -1,3 +1,4 @@
+import asyncio
 import json
 import re
 
@@ -6,23 +7,27 @@ from aiogram.types import Message
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from typing import Dict
+from typing import List, Optional, Tuple
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-from config import ADMIN_GROUP_ID, owners, developers
-from lists_of_users.create_JSON_lists import load_admitted, load_blacklist, load_applications
+from config import ADMIN_GROUP_ID, owners, developers, SPECULATIVE_RETRIEVAL, STREAMING_RESPONSES
+from lists_of_users.access_control import access_store
 from models import UserData
-from generate import ai_generate, clear_context
+from generate import GENERATION_ERROR_TEXT, ai_generate, ai_generate_stream, clear_context, remember_exchange, is_failed_answer, is_new_dialogue, start_dialogue
 from keyboards import application_key, owners_keyboard, admitted_keyboard
-from db_operations.db_operatins import get_sessionmaker, get_message_contexts
-from db_operations.process_messages import embedding_single_message, process_single_message
-from Database.db_create import find_similar_messages
-
-applications: Dict[str, str] = load_applications()
-blacklist: Dict[str, str] = load_blacklist()
-admitted: Dict[str, str] = load_admitted()
+from db_operations.db_operatins import get_sessionmaker
+from db_operations.retrieval import retrieve_context, prepare_query, SpeculativeRetrieval
+from answer_cache import answer_cache, prompt_fingerprint
+from handlers.streaming import TelegramStreamWriter, consume_stream
+from handlers.turn_queue import UserTurnQueue
+from handlers.access_gate import Role, AI_ROLES
 
 handlers_router = Router()
+
+# Сообщения одного пользователя обрабатываются по очереди, пришедшие во время генерации — одной репликой
+turn_queue: UserTurnQueue[Message] = UserTurnQueue()
+
+QUEUE_BUSY_TEXT = "⏳ Я ещё отвечаю на предыдущие сообщения. Подождите немного, пожалуйста."
   
 class Form_with_AI(StatesGroup):
     default_communication = State()
@@ -80,8 +85,6 @@ async def handle_admin_group_message(message: types.Message):
 @handlers_router.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
     username = message.from_user.username
-    # Загружаем актуальный список пользователей из JSON
-    list_of_users = load_admitted()
     if message.from_user.id in owners:
         await message.answer(
             "Вы владелец бота",  # Текст сообщения
@@ -89,7 +92,7 @@ async def cmd_start(message: Message, state: FSMContext):
         )
         return
     
-    if f"@{username}" in admitted or len(list_of_users) is None:
+    if access_store.is_admitted(username):
         await message.answer(
             "✨ Добро пожаловать в чат с ботом Володей! ✨\n\n"
             "🤖 Бот Володя — ваш персональный собеседник, который:\n"
@@ -215,22 +218,29 @@ async def process_default_communication(
     message: Message, 
     state: FSMContext, 
     bot: Bot,
-    dispatcher: Dispatcher  # Добавляем Dispatcher в параметры
+    dispatcher: Dispatcher,  # Добавляем Dispatcher в параметры
+    role: Role  # Роль отправителя от AccessGateMiddleware
 ):
     # Проверка команды выхода в первую очередь
     if message.text and message.text.lower() in ("!!!выход!!!", "/exit"):
         await state.clear()
-        if message.from_user.username in load_admitted():
+        if role is Role.OWNER:
             await message.answer(
             "✅ Режим общения с ИИ деактивирован",
-            reply_markup=admitted_keyboard)
-        elif message.from_user.id in owners:
+            reply_markup=owners_keyboard)
+        elif role in AI_ROLES:
             await message.answer(
             "✅ Режим общения с ИИ деактивирован",
-            reply_markup=owners_keyboard)
+            reply_markup=admitted_keyboard)
         print(f"Пользователь {message.from_user.id} вышел из режима ИИ")
         return
     
+    # Доступ могли отозвать, пока пользователь был в режиме ИИ — модель не вызывается
+    if role not in AI_ROLES:
+        await state.clear()
+        await message.answer("У вас нет доступа к боту, но вы можете оставить заявку.", reply_markup=application_key)
+        return
+    
     # Получаем данные из состояния
     data = await state.get_data()
     
@@ -244,44 +254,148 @@ async def process_default_communication(
     # Получаем sessionmaker из dispatcher
     session_maker = await get_sessionmaker(dispatcher)
     
-    # Генерируем ответ с помощью AI
-    response = await ai_generate(
+    accepted = await turn_queue.run(
+        message.from_user.id,
+        message,
+        lambda messages: answer_turn(messages, user_data, bot, session_maker)
+    )
+    if not accepted:
+        await message.answer(QUEUE_BUSY_TEXT)
+
+
+async def answer_turn(messages: List[Message], user_data: UserData, bot: Bot, session_maker) -> None:
+    """Отвечает на реплику пользователя: одно сообщение или несколько, пришедших во время прошлой генерации"""
+    message = messages[-1]
+    text = "\n".join(m.text for m in messages if m.text)
+    
+    # Повторный первый вопрос отвечается из семантического кэша, без LLM и поиска.
+    # Ответ посреди диалога зависит от предыдущих реплик, поэтому тогда кэш не используется
+    processed_text, embedding, prompt_key = None, None, None
+    cacheable = answer_cache.enabled and bool(text) and await is_new_dialogue(message.from_user.id)
+    if cacheable:
+        # Системный промт строится сразу: ответы в кэше разделены по нему,
+        # а ответ из кэша сохраняется в уже созданный контекст диалога
+        promt = await start_dialogue(
+            message.from_user.id, message.from_user.username, text, bot, "The_main_promt", session_maker
+        )
+        prompt_key = prompt_fingerprint(promt or "")
+        # Вектор вопроса затем переиспользует спекулятивный поиск
+        processed_text, embedding = await prepare_query(text)
+        cached = answer_cache.lookup(prompt_key, embedding)
+        if cached:
+            await remember_exchange(message.from_user.id, text, cached.answer)
+            await message.answer(cached.answer)
+            return
+    
+    # Поиск по исходному сообщению идёт параллельно с первым вызовом LLM
+    speculation = None
+    if SPECULATIVE_RETRIEVAL and text:
+        speculation = SpeculativeRetrieval(session_maker, text, processed_text, embedding)
+    
+    generate_kwargs = dict(
         user_id=message.from_user.id,
         username=message.from_user.username,
-        text=message.text,
         bot=bot,
         user_data=user_data,
         promt_type="The_main_promt",
         session_maker=session_maker
     )
-    print(f"{message.text}\n\n {response}")
-    if re.findall(r"\|.+\|", response):
-    # Создаем сессию через session_maker
-        async with session_maker() as session:
-            embed_response = await embedding_single_message(await process_single_message(str(re.findall(r"(?<=\|).+(?=\|)",response)[0]).strip("|")))
-            message_tuples = await find_similar_messages(
-                session=session,  # Передаем реальную сессию
-                embedding=embed_response,
-                threshold=0.1
-            )
-            context = await get_message_contexts(
-                message_tuples=message_tuples,
-                session=session  # Тоже передаем сессию
-            )
-            print(f' Результаты косинусного поиска \n{message_tuples} \n\nКонтекст:\n  {context}')
-            
-        response = await ai_generate(
-            user_id=message.from_user.id,
-            username=message.from_user.username,
-            text=f'Пополнение контекста:Найди ответ на вопрос пользователя среди следующих сообщений:\n{context}\n\nЕсли ответа, ответь что у тебя нет информации/нет ответа, но в том же стиле как это ответил бы Владимир Викторович',
-            bot=bot,
-            user_data=user_data,
-            promt_type="The_main_promt",
-            session_maker=session_maker
-        )
+    
+    if STREAMING_RESPONSES:
+        response, context = await answer_streaming(message, text, session_maker, speculation, generate_kwargs)
+    else:
+        response, context = await answer_at_once(message, text, session_maker, speculation, generate_kwargs)
+    
+    # Кэшируются только ответы на первый вопрос, найденные в базе разговоров
+    if cacheable and context is not None and not is_failed_answer(response):
+        answer_cache.store(prompt_key, text, embedding, response)
+
+
+async def answer_at_once(
+    message: Message,
+    text: str,
+    session_maker,
+    speculation: Optional[SpeculativeRetrieval],
+    generate_kwargs: dict
+) -> Tuple[str, Optional[str]]:
+    """Отвечает одним сообщением; возвращает ответ и найденный контекст (None, если поиска не было)"""
+    context = None
+    
+    # Генерируем ответ с помощью AI
+    response = await ai_generate(text=text, **generate_kwargs)
+    print(f"{text}\n\n {response}")
+    phrase = extract_search_phrase(response)
+    if phrase:
+        context = await find_context(session_maker, phrase, speculation)
+        response = await ai_generate(text=CONTEXT_PROMPT.format(context=context), **generate_kwargs)
+    elif speculation:
+        speculation.cancel()
         
-    # Отправляем ответ пользователю
+    # Отправляем ответ пользователю (пустое сообщение Telegram не примет)
+    if not response.strip():
+        response = GENERATION_ERROR_TEXT
     await message.answer(response)
+    return response, context
+
+
+CONTEXT_PROMPT = (
+    'Пополнение контекста:Найди ответ на вопрос пользователя среди следующих сообщений:\n{context}\n\n'
+    'Если ответа, ответь что у тебя нет информации/нет ответа, но в том же стиле как это ответил бы Владимир Викторович'
+)
+
+
+def extract_search_phrase(response: str) -> Optional[str]:
+    """Возвращает поисковую фразу из ответа модели вида |фраза| или None"""
+    found = re.findall(r"(?<=\|).+(?=\|)", response)
+    return str(found[0]).strip("|") if found else None
+
+
+async def find_context(session_maker, phrase: str, speculation: Optional[SpeculativeRetrieval]) -> str:
+    """Контекст из базы разговоров для поисковой фразы (по возможности — уже найденный спекулятивно)"""
+    if speculation:
+        return await speculation.resolve(phrase)
+    return await retrieve_context(session_maker, phrase)
+
+
+async def answer_streaming(
+    message: Message,
+    text: str,
+    session_maker,
+    speculation: Optional[SpeculativeRetrieval],
+    generate_kwargs: dict
+) -> Tuple[str, Optional[str]]:
+    """Отвечает с потоковой выдачей: заглушка сразу, затем редактирование по мере генерации"""
+    context = None
+    writer = TelegramStreamWriter(message)
+    await writer.start()
+    
+    # Поиск стартует, как только модель закрыла |поисковую фразу|, не дожидаясь конца ответа
+    retrieval = None
+    
+    def on_phrase(phrase: str) -> None:
+        nonlocal retrieval
+        retrieval = asyncio.create_task(find_context(session_maker, phrase, speculation))
+    
+    response = await consume_stream(
+        ai_generate_stream(text=text, **generate_kwargs),
+        writer,
+        on_phrase
+    )
+    print(f"{text}\n\n {response}")
+    
+    phrase = extract_search_phrase(response)
+    if phrase:
+        context = await (retrieval or find_context(session_maker, phrase, speculation))
+        response = await consume_stream(
+            ai_generate_stream(text=CONTEXT_PROMPT.format(context=context), **generate_kwargs),
+            writer
+        )
+    elif speculation:
+        speculation.cancel()
+    
+    # Пустой ответ заменяется текстом ошибки — он же не попадёт в кэш ответов
+    response = await writer.finish(response)
+    return response, context
 
     
 @handlers_router.message(Command("reset"))
@@ -0,0 +1,73 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from config import MAX_CONCURRENT_UPDATES
+
+
+class InFlightMiddleware(BaseMiddleware):
+    """
+    Ограничивает число одновременно обрабатываемых апдейтов и отслеживает их.
+
+    Апдейт держит слот всё время обработки, включая генерацию ответа, поэтому
+    при остановке бота drain дожидается уже начатых ответов, прежде чем
+    закрываются клиент модели и хранилища.
+    """
+
+    def __init__(self, limit: int = MAX_CONCURRENT_UPDATES):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.active = 0
+        self.waiting = 0
+        self.processed = 0
+        self.draining = False
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        self._idle.clear()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self._semaphore.release()
+            self.active -= 1
+            self.processed += 1
+            if not self.active and not self.waiting:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """Ждёт завершения обрабатываемых апдейтов; False, если не успели за timeout секунд"""
+        self.draining = True
+        if self.active or self.waiting:
+            print(f"Ожидаем завершения апдейтов: {self.active} в работе, {self.waiting} в очереди")
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Не дождались завершения апдейтов за {timeout:.0f} с: {self.active} в работе")
+            return False
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "processed": self.processed,
+        }
+
+
+in_flight = InFlightMiddleware()
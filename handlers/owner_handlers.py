@@ -5,9 +5,23 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
 from config import owners
-from lists_of_users.create_JSON_lists import load_applications, load_admitted, load_blacklist, save_admitted, save_applications, save_blacklist
-from handlers.handlers import Form_with_AI
+from lists_of_users.access_control import access_store
+from handlers.handlers import Form_with_AI, turn_queue
+from handlers.access_gate import Role, AI_ROLES, access_gate
+from handlers.in_flight import in_flight
 from keyboards import owners_keyboard, admitted_keyboard
+from db_operations.embedding_service import embedding_service
+from db_operations.process_messages import preprocessor
+from db_operations.retrieval import speculation_stats
+from context_store import context_store
+from db_operations.extracting_style import style_digests
+from answer_cache import answer_cache
+from llm_gateway import llm_gateway
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from Database.db_create import IngestionJob
+from Database.pools import pool_stats
+from db_operations.ingestion_jobs import ingestion_queue, ACTIVE_STATUSES, JOB_RUNNING
 
 owners_router = Router()
 
@@ -39,14 +53,14 @@ async def handle_view_blacklist(message: Message, state: FSMContext):
 # Функции для обработки
 async def view_applications(message: types.Message, state: FSMContext):
     """Показывает заявки на доступ"""
-    applications = load_applications()
+    applications = access_store.applications.items()
     if not applications:
         await message.answer("Нет новых заявок.")
         return
     
     buttons = [
         [InlineKeyboardButton(text=username, callback_data=f"app_{user_id}")]
-        for user_id, username in applications.items()
+        for user_id, username in applications
     ]
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
@@ -58,14 +72,14 @@ async def view_applications(message: types.Message, state: FSMContext):
 
 async def view_admitted(message: types.Message, state: FSMContext):
     """Показывает список разрешенных пользователей"""
-    admitted = load_admitted()
+    admitted = access_store.admitted.items()
     if not admitted:
         await message.answer("Нет пользователей с доступом.")
         return
     
     buttons = [
         [InlineKeyboardButton(text=username, callback_data=f"perm_{user_id}")]
-        for user_id, username in admitted.items()
+        for user_id, username in admitted
     ]
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
@@ -77,14 +91,14 @@ async def view_admitted(message: types.Message, state: FSMContext):
 
 async def view_blacklist(message: types.Message, state: FSMContext):
     """Показывает чёрный список"""
-    blacklist = load_blacklist()
+    blacklist = access_store.blacklist.items()
     if not blacklist:
         await message.answer("Чёрный список пуст.")
         return
     
     buttons = [
         [InlineKeyboardButton(text=username, callback_data=f"bl_{user_id}")]
-        for user_id, username in blacklist.items()
+        for user_id, username in blacklist
     ]
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
@@ -117,16 +131,13 @@ async def handle_inline_buttons(callback: types.CallbackQuery, state: FSMContext
             return
 
         data = callback.data
-        applications = load_applications()
-        admitted = load_admitted()
-        blacklist = load_blacklist()
 
         # Обработка заявок (VIEW_APPLICATIONS)
         if data.startswith("app_"):
             username = data[4:]  # Получаем username из callback данных
             
-            if username in applications:
-                full_name = applications[username]
+            full_name = access_store.applications.get(username)
+            if full_name is not None:
                 keyboard = InlineKeyboardMarkup(inline_keyboard=[
                     [
                         InlineKeyboardButton(text="✅ Одобрить", callback_data=f"approve_{username}"),
@@ -146,14 +157,8 @@ async def handle_inline_buttons(callback: types.CallbackQuery, state: FSMContext
         elif data.startswith("approve_"):
             username = data[8:]
             
-            if username in applications:
-                full_name = applications[username]
-                admitted[username] = full_name
-                del applications[username]
-                
-                save_admitted(admitted)
-                save_applications(applications)
-                
+            full_name = access_store.approve(username)
+            if full_name is not None:
                 await callback.message.edit_text(
                     f"✅ Доступ предоставлен: {full_name} ({username})"
                 )
@@ -161,7 +166,7 @@ async def handle_inline_buttons(callback: types.CallbackQuery, state: FSMContext
                 # Попытка уведомить пользователя
                 try:
                     await bot.send_message(
-                        chat_id=f'@{username}',
+                        chat_id=username,  # ключи списков уже начинаются с '@'
                         text=f"🎉 Ваша заявка одобрена, {full_name}! Теперь вы можете пользоваться ботом."
                     )
                 except Exception as e:
@@ -176,11 +181,8 @@ async def handle_inline_buttons(callback: types.CallbackQuery, state: FSMContext
         elif data.startswith("reject_"):
             username = data[7:]
             
-            if username in applications:
-                full_name = applications[username]
-                del applications[username]
-                save_applications(applications)
-                
+            full_name = access_store.reject(username)
+            if full_name is not None:
                 await callback.message.edit_text(
                     f"❌ Заявка отклонена: {full_name} ({username})"
                 )
@@ -193,8 +195,8 @@ async def handle_inline_buttons(callback: types.CallbackQuery, state: FSMContext
         elif data.startswith("perm_"):
             username = data[5:]
             
-            if username in admitted:
-                full_name = admitted[username]
+            full_name = access_store.admitted.get(username)
+            if full_name is not None:
                 keyboard = InlineKeyboardMarkup(inline_keyboard=[
                     [
                         InlineKeyboardButton(text="🚫 Забанить", callback_data=f"revoke_{username}"),
@@ -214,14 +216,8 @@ async def handle_inline_buttons(callback: types.CallbackQuery, state: FSMContext
         elif data.startswith("revoke_"):
             username = data[7:]
             
-            if username in admitted:
-                full_name = admitted[username]
-                blacklist[username] = full_name
-                del admitted[username]
-                
-                save_admitted(admitted)
-                save_blacklist(blacklist)
-                
+            full_name = access_store.revoke(username)
+            if full_name is not None:
                 await callback.message.edit_text(
                     f"🚫 Пользователь заблокирован: {full_name} ({username})"
                 )
@@ -234,8 +230,8 @@ async def handle_inline_buttons(callback: types.CallbackQuery, state: FSMContext
         elif data.startswith("bl_"):
             username = data[3:]
             
-            if username in blacklist:
-                full_name = blacklist[username]
+            full_name = access_store.blacklist.get(username)
+            if full_name is not None:
                 keyboard = InlineKeyboardMarkup(inline_keyboard=[
                     [
                         InlineKeyboardButton(text="✅ Разбанить", callback_data=f"unban_{username}"),
@@ -255,14 +251,8 @@ async def handle_inline_buttons(callback: types.CallbackQuery, state: FSMContext
         elif data.startswith("unban_"):
             username = data[6:]
             
-            if username in blacklist:
-                full_name = blacklist[username]
-                admitted[username] = full_name
-                del blacklist[username]
-                
-                save_blacklist(blacklist)
-                save_admitted(admitted)
-                
+            full_name = access_store.unban(username)
+            if full_name is not None:
                 await callback.message.edit_text(
                     f"✅ Пользователь разблокирован: {full_name} ({username})"
                 )
@@ -283,13 +273,13 @@ async def handle_inline_buttons(callback: types.CallbackQuery, state: FSMContext
         await callback.answer("⚠️ Произошла ошибка при обработке", show_alert=True)
         
 @owners_router.message(F.text == "💬 Общаться с ботом")
-async def handle_chat_with_bot(message: types.Message, state: FSMContext):
+async def handle_chat_with_bot(message: types.Message, state: FSMContext, role: Role):
     """
     Рабочий обработчик кнопки "Общаться с ботом" для владельцев
     """
-    # Проверяем, является ли пользователь владельцем
-    if f'@{message.from_user.username}' not in load_admitted():
-        print(load_admitted(), message.from_user.username)
+    # Проверяем, что пользователю доступно общение с ИИ (роль определена AccessGateMiddleware)
+    if role not in AI_ROLES:
+        print(f"Нет в списке разрешённых: {message.from_user.username}")
         await message.answer(
             "⚠️ Эта функция Вам не доступна",
             reply_markup=admitted_keyboard  # Возвращаем клавиатуру
@@ -311,6 +301,108 @@ async def check_state(message: types.Message, state: FSMContext):
     current_state = await state.get_state()
     await message.answer(f"Текущее состояние: {current_state}")
 
+@owners_router.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    """Показывает владельцу метрики работы бота"""
+    if not await is_owner(message):
+        return
+    
+    embedding = embedding_service.stats()
+    lemmas = preprocessor.cache_info()
+    lemma_lookups = lemmas.hits + lemmas.misses
+    contexts = context_store.stats()
+    styles = style_digests.stats()
+    answers = answer_cache.stats()
+    llm = llm_gateway.stats()
+    turns = turn_queue.stats()
+    ingestion = ingestion_queue.stats()
+    access = access_store.stats()
+    gate = access_gate.stats()
+    updates = in_flight.stats()
+    pools = pool_stats()
+    pool_lines = "\n".join(
+        f"{name}: выдано {pool['checkouts']}, занято {pool['in_use']}, таймаутов {pool['timeouts']}, "
+        f"ожидание p50/p95/макс {pool['wait_p50_ms']:.1f}/{pool['wait_p95_ms']:.1f}/{pool['wait_max_ms']:.0f} мс"
+        for name, pool in pools.items()
+    )
+    await message.answer(
+        "📊 Векторизация поисковых фраз\n"
+        f"Запросов: {embedding['requests']}, батчей: {embedding['batches']}\n"
+        f"Средний батч: {embedding['avg_batch_size']:.1f} (макс. {embedding['max_batch_size']})\n"
+        f"Ожидание в очереди p50/p95: {embedding['queue_wait_p50_ms']:.1f}/{embedding['queue_wait_p95_ms']:.1f} мс\n"
+        f"Векторизация батча p95: {embedding['encode_p95_ms']:.1f} мс\n\n"
+        "📚 Кэш лемм\n"
+        f"Размер: {lemmas.currsize}/{lemmas.maxsize}, "
+        f"попаданий: {lemmas.hits / lemma_lookups if lemma_lookups else 0:.0%}\n\n"
+        "🔮 Спекулятивный поиск\n"
+        f"Запусков: {speculation_stats.started}, попаданий: {speculation_stats.hits}, "
+        f"промахов: {speculation_stats.misses}, не понадобилось: {speculation_stats.unused}\n"
+        f"Доля попаданий: {speculation_stats.hit_rate:.0%}, "
+        f"сэкономлено: {speculation_stats.saved_seconds:.1f} с\n\n"
+        "🧠 Контексты диалогов\n"
+        f"Пользователей в памяти: {contexts['users']}, объём: {contexts['bytes'] / 1024:.0f} КБ\n"
+        f"Вытеснено: {contexts['evictions']}, истекло по TTL: {contexts['expirations']}, "
+        f"ожидают записи: {contexts['unsaved']}\n"
+        f"Обновлено из хранилища: {contexts['reloads']}, конфликтов записи: {contexts['conflicts']}\n\n"
+        "🎭 Примеры стиля\n"
+        f"Гостей: {styles['guests']}, из кэша: {styles['hits']}, "
+        f"запросов к БД: {styles['queries']}, устарело: {styles['stale']}\n\n"
+        "💾 Кэш ответов\n"
+        f"Записей: {answers['entries']} (промтов: {answers['prompts']}), попаданий: {answers['hits']}, промахов: {answers['misses']} "
+        f"({answers['hit_rate']:.0%})\n"
+        f"Истекло по TTL: {answers['expirations']}, сбросов после загрузки: {answers['invalidations']}\n\n"
+        "🤖 Запросы к модели\n"
+        f"Запросов: {llm['requests']}, попыток: {llm['attempts']}, повторов: {llm['retries']}, "
+        f"ошибок: {llm['failures']}, отклонено: {llm['rejected']}\n"
+        f"Задержка (до первого токена) p50/p95: {llm['latency_p50_ms']:.0f}/{llm['latency_p95_ms']:.0f} мс, "
+        f"ожидание слота p95: {llm['queue_wait_p95_ms']:.0f} мс, в очереди: {llm['waiting']}\n"
+        f"Дублирующих запросов: {llm['hedges']}, из них быстрее основного: {llm['hedge_wins']}\n\n"
+        "📨 Очередь реплик\n"
+        f"Реплик: {turns['turns']}, объединено сообщений: {turns['coalesced']}, "
+        f"отклонено: {turns['rejected']}\n"
+        f"Сейчас отвечаем: {turns['active_users']} польз., ждут: {turns['waiting']}\n"
+        f"Апдейтов в обработке: {updates['active']}/{updates['limit']}, ждут слота: {updates['waiting']}, "
+        f"обработано: {updates['processed']}\n\n"
+        "📥 Загрузки разговоров\n"
+        f"В очереди: {ingestion['queued']}, воркеров: {ingestion['workers']}, "
+        f"завершено: {ingestion['completed']}, с ошибкой: {ingestion['failed']}, "
+        f"возвращено после сбоя: {ingestion['reclaimed']}\n\n"
+        "🔐 Списки доступа\n"
+        f"Разрешённых: {access['admitted']}, заявок: {access['applications']}, в чёрном списке: {access['blacklist']}\n"
+        f"Изменений: {access['changes']}, записей: {access['flushes']}, конфликтов записи: {access['conflicts']}, ожидают записи: {access['unsaved']}\n"
+        f"Апдейтов по ролям: владелец {gate['owner']}, разработчик {gate['developer']}, "
+        f"разрешённые {gate['admitted']}, неизвестные {gate['unknown']}, "
+        f"чёрный список {gate['blacklisted']} (отброшено: {gate['dropped']})\n\n"
+        "🗄 Пулы соединений с БД\n"
+        f"{pool_lines}"
+    )
+
+@owners_router.message(Command("jobs"))
+async def cmd_jobs(message: types.Message, async_session_maker: async_sessionmaker[AsyncSession]):
+    """Показывает владельцу загрузки разговоров в очереди и в работе"""
+    if not await is_owner(message):
+        return
+    
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(IngestionJob)
+            .where(IngestionJob.status.in_(ACTIVE_STATUSES))
+            .order_by(IngestionJob.id)
+        )
+        jobs = result.scalars().all()
+    
+    if not jobs:
+        await message.answer("Нет загрузок в очереди")
+        return
+    
+    lines = ["📥 Загрузки разговоров"]
+    for job in jobs:
+        if job.status == JOB_RUNNING:
+            lines.append(f"#{job.id} {job.file_name}: обработано {job.turns_done} реплик")
+        else:
+            lines.append(f"#{job.id} {job.file_name}: в очереди")
+    await message.answer("\n".join(lines))
+
 async def handle_owner_commands(message: types.Message, state: FSMContext):
     """Обработчик команд хозяина"""
     if not await is_owner(message):
@@ -4,7 +4,7 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 
-from lists_of_users.create_JSON_lists import load_admitted, save_applications
+from lists_of_users.access_control import access_store
 
 
 application_router = Router()
@@ -46,10 +46,8 @@ async def process_username(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка: ФИО не найдено")
         return
 
-    # Обновляем словарь и сохраняем в JSON
-    list_of_users = load_admitted()
-    list_of_users[username] = fio
-    save_applications(list_of_users)  # сохраняем изменения
+    # Заявка попадает в список заявок (запись на диск — отложенная)
+    access_store.add_application(username, fio)
     
     await message.answer("✅ Заявка сохранена!")
     await state.clear()
\ No newline at end of file
@@ -0,0 +1,133 @@
+import asyncio
+import re
+from time import monotonic
+from typing import AsyncIterator, Callable, List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from config import STREAM_EDIT_INTERVAL, STREAM_PLACEHOLDER
+from generate import GENERATION_ERROR_TEXT
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Поисковая фраза в начале ответа модели: |фраза|
+LEADING_PHRASE = re.compile(r"^\s*\|(.+?)\|", re.DOTALL)
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Разбивает длинный текст на части, которые помещаются в одно сообщение Telegram"""
+    return [text[i:i + limit] for i in range(0, len(text), limit)] or [text]
+
+
+class TelegramStreamWriter:
+    """
+    Показывает ответ по мере генерации: отправляет сообщение-заглушку
+    и редактирует его не чаще, чем раз в STREAM_EDIT_INTERVAL секунд.
+    """
+
+    def __init__(self, message: Message, interval: float = STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self.sent: Optional[Message] = None
+        self.shown = ""
+        self.next_edit_at = 0.0
+
+    async def start(self) -> None:
+        """Отправляет заглушку сразу, до первых токенов"""
+        self.sent = await self.message.answer(STREAM_PLACEHOLDER, parse_mode=None)
+        self.next_edit_at = monotonic() + self.interval
+
+    async def update(self, text: str) -> None:
+        """Промежуточное обновление: пропускается, если с прошлого редактирования прошло мало времени"""
+        if monotonic() < self.next_edit_at:
+            return
+        # Незакрытые теги в недописанном тексте ломают HTML-разметку — промежуточные версии без неё
+        await self._edit(split_message(text)[0], parse_mode=None)
+
+    async def finish(self, text: str) -> str:
+        """
+        Итоговый текст: первая часть — редактированием заглушки, остальное — новыми сообщениями.
+        
+        Пустой ответ Telegram не принимает, а заглушка осталась бы навсегда —
+        вместо него показывается GENERATION_ERROR_TEXT. Возвращает показанный текст.
+        """
+        if not text.strip():
+            text = GENERATION_ERROR_TEXT
+        first, *rest = split_message(text)
+        
+        if self.sent is None:
+            await self.message.answer(first)
+        else:
+            delay = self.next_edit_at - monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._edit(first, final=True)
+        
+        for part in rest:
+            await self.message.answer(part)
+        return text
+
+    async def _edit(self, text: str, parse_mode=None, final: bool = False) -> None:
+        if not text.strip() or (text == self.shown and not final):
+            return
+        
+        kwargs = {} if final else {"parse_mode": parse_mode}
+        try:
+            await self.sent.edit_text(text, **kwargs)
+            self.shown = text
+        except TelegramRetryAfter as e:
+            self.next_edit_at = monotonic() + e.retry_after
+            if final:
+                await asyncio.sleep(e.retry_after)
+                await self._edit(text, final=True)
+            return
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                pass
+            elif final:
+                # Модель могла вернуть текст, который не разбирается как HTML
+                await self.sent.edit_text(text, parse_mode=None)
+                self.shown = text
+            else:
+                print(f"Не удалось обновить сообщение: {e}")
+        
+        self.next_edit_at = monotonic() + self.interval
+
+
+async def consume_stream(
+    deltas: AsyncIterator[str],
+    writer: TelegramStreamWriter,
+    on_phrase: Optional[Callable[[str], None]] = None
+) -> str:
+    """
+    Читает поток частей ответа и показывает его пользователю.
+    
+    Если ответ начинается с |поисковой фразы|, он не показывается, а on_phrase
+    вызывается сразу после закрывающей черты — поиск стартует до конца генерации.
+    Возвращает полный текст ответа.
+    """
+    text = ""
+    hidden = None if on_phrase else False
+    phrase_sent = False
+    
+    async for delta in deltas:
+        text += delta
+        
+        if hidden is None:
+            stripped = text.lstrip()
+            if not stripped:
+                continue
+            hidden = stripped.startswith("|")
+        
+        if hidden:
+            if not phrase_sent:
+                match = LEADING_PHRASE.match(text)
+                if match:
+                    phrase_sent = True
+                    on_phrase(match.group(1).strip())
+            continue
+        
+        await writer.update(text)
+    
+    return text
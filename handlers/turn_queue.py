@@ -0,0 +1,70 @@
+from typing import Awaitable, Callable, Dict, Generic, List, TypeVar
+
+from config import CHAT_MAX_PENDING_MESSAGES
+
+T = TypeVar("T")
+
+
+class UserTurnQueue(Generic[T]):
+    """
+    Очередь реплик пользователя перед генерацией ответа.
+
+    У каждого пользователя одновременно обрабатывается не больше одной реплики.
+    Сообщения, пришедшие во время генерации, копятся и затем обрабатываются
+    одной репликой (один вызов LLM вместо нескольких). Если накопилось
+    max_pending сообщений, новые не принимаются — вызывающий отвечает «занят».
+
+    Реплики обрабатывает тот вызов run, который застал пользователя свободным:
+    он выполняет свою реплику и затем все накопившиеся, пока очередь не опустеет.
+    """
+
+    def __init__(self, max_pending: int = CHAT_MAX_PENDING_MESSAGES):
+        self.max_pending = max_pending
+        # Пользователь есть в словаре, пока для него идёт генерация; значение — ожидающие сообщения
+        self._pending: Dict[int, List[T]] = {}
+        self.turns = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    def busy(self, user_id: int) -> bool:
+        return user_id in self._pending
+
+    async def run(self, user_id: int, item: T, process: Callable[[List[T]], Awaitable[None]]) -> bool:
+        """
+        Ставит сообщение в очередь пользователя.
+
+        Возвращает False, если очередь пользователя заполнена и сообщение отклонено.
+        """
+        pending = self._pending.get(user_id)
+        if pending is not None:
+            if len(pending) >= self.max_pending:
+                self.rejected += 1
+                return False
+            pending.append(item)
+            return True
+
+        self._pending[user_id] = []
+        batch = [item]
+        try:
+            while batch:
+                self.turns += 1
+                self.coalesced += len(batch) - 1
+                try:
+                    await process(batch)
+                except Exception as e:
+                    # Ошибка одной реплики не должна оставить без ответа накопившиеся
+                    print(f"Ошибка обработки реплики пользователя {user_id}: {e}")
+                batch = self._pending[user_id]
+                self._pending[user_id] = []
+        finally:
+            del self._pending[user_id]
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active_users": len(self._pending),
+            "waiting": sum(len(pending) for pending in self._pending.values()),
+            "turns": self.turns,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+        }
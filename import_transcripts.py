@@ -0,0 +1,252 @@
+"""
+Пакетный импорт транскриптов из папки в БД (без Telegram).
+
+    python import_transcripts.py [папка] [--manifest manifest.json] [--workers N]
+
+Дата и время беседы берутся из манифеста ({"файл.json": {"date": "2024-05-01", "time": "10:00"}})
+или из имени файла: 2024-05-01_10-00.json, 20240501_1000.json (без времени — 00:00).
+Предобработка и векторизация идут в пуле процессов, запись в БД — в главном процессе
+по мере готовности файлов. Импортированные файлы запоминаются по SHA-256 содержимого,
+поэтому прерванный импорт можно просто запустить снова.
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from Database.db_create import init_db, ImportedTranscript
+from db_operations.db_operatins import JSON_FOLDER, read_speaker_turns, spool_rows, insert_spooled_conversation
+from db_operations.process_messages import preprocessor, encode_many
+from db_operations.resources import get_model
+from db_operations.transcripts import TranscriptReader, batched
+from config import EMBEDDING_BATCH_SIZE, IMPORT_WORKERS
+
+# Дата (ГГГГ-ММ-ДД или ГГГГММДД) и необязательное время (ЧЧ-ММ, ЧЧ:ММ, ЧЧММ) в имени файла
+FILENAME_DATETIME = re.compile(r"(\d{4})-?(\d{2})-?(\d{2})(?:[ _T-]+(\d{2})[-:.hH]?(\d{2}))?")
+
+
+@dataclass
+class Transcript:
+    """Файл транскрипта, ожидающий импорта"""
+    file_path: str
+    file_name: str
+    sha256: str
+    conversation_date: str
+    conversation_time: str
+
+
+def date_time_from_name(file_name: str) -> Optional[Tuple[str, str]]:
+    """Дата и время беседы из имени файла или None"""
+    for match in FILENAME_DATETIME.finditer(file_name):
+        year, month, day, hour, minute = match.groups()
+        conversation_date = f"{year}-{month}-{day}"
+        conversation_time = f"{hour}:{minute}" if hour else "00:00"
+        try:
+            datetime.strptime(f"{conversation_date} {conversation_time}", "%Y-%m-%d %H:%M")
+        except ValueError:
+            continue
+        return conversation_date, conversation_time
+    return None
+
+
+def load_manifest(manifest_path: Optional[str]) -> Dict[str, Tuple[str, str]]:
+    """Читает манифест {имя файла: {date, time}}"""
+    if not manifest_path:
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    return {
+        file_name: (entry['date'], entry.get('time', "00:00"))
+        for file_name, entry in manifest.items()
+    }
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def collect_transcripts(directory: str, manifest: Dict[str, Tuple[str, str]], imported: set) -> List[Transcript]:
+    """Файлы папки, которые ещё не импортированы и для которых известны дата и время"""
+    transcripts = []
+    seen = set(imported)
+    for file_name in sorted(os.listdir(directory)):
+        file_path = os.path.join(directory, file_name)
+        if not file_name.lower().endswith('.json') or not os.path.isfile(file_path):
+            continue
+
+        sha256 = file_sha256(file_path)
+        if sha256 in seen:
+            print(f"Пропущен (уже импортирован): {file_name}")
+            continue
+
+        date_time = manifest.get(file_name) or date_time_from_name(file_name)
+        if date_time is None:
+            print(f"Пропущен (нет даты в имени файла и манифесте): {file_name}")
+            continue
+
+        # Проверяем формат сразу, а не после векторизации
+        try:
+            datetime.strptime(f"{date_time[0]} {date_time[1]}", "%Y-%m-%d %H:%M")
+        except ValueError:
+            print(f"Пропущен (неверные дата или время {date_time[0]} {date_time[1]}): {file_name}")
+            continue
+
+        seen.add(sha256)
+        transcripts.append(Transcript(file_path, file_name, sha256, *date_time))
+    return transcripts
+
+
+def init_worker(torch_threads: int) -> None:
+    """Запуск процесса пула: модель и ресурсы NLTK загружаются один раз на процесс"""
+    import torch
+    # Процессы сами делят ядра между собой, потоки torch внутри каждого только мешали бы
+    torch.set_num_threads(torch_threads)
+    preprocessor.load()
+    get_model()
+
+
+def prepare_transcript(file_path: str, conversation_time: str, spool_path: str) -> Tuple[List[str], int]:
+    """
+    Предобработка и векторизация транскрипта (выполняется в процессе пула).
+
+    Реплики пишутся в spool_path в формате insert_spooled_conversation;
+    возвращаются имена спикеров и число реплик.
+    """
+    conv_time = datetime.strptime(conversation_time, "%H:%M").time()
+    speakers = set()
+    turns = 0
+    with open(spool_path, 'w', encoding='utf-8', newline='') as spool:
+        writer = csv.writer(spool)
+        for batch in batched(read_speaker_turns(TranscriptReader(file_path), conv_time, speakers), EMBEDDING_BATCH_SIZE):
+            raw_texts = ['/'.join(turn.texts) for turn in batch]
+            processed_texts = preprocessor.process_many(raw_texts)
+            writer.writerows(spool_rows(batch, raw_texts, processed_texts, encode_many(processed_texts)))
+            turns += len(batch)
+    return sorted(speakers), turns
+
+
+async def import_directory(directory: str, manifest_path: Optional[str], workers: int) -> int:
+    """Импортирует транскрипты папки; возвращает число файлов, загрузить которые не удалось"""
+    started = perf_counter()
+    manifest = load_manifest(manifest_path)
+    database = await init_db()
+    session_maker = database.ingestion_session_maker
+
+    async with session_maker() as session:
+        result = await session.execute(select(ImportedTranscript.sha256))
+        imported = set(result.scalars().all())
+
+    transcripts = collect_transcripts(directory, manifest, imported)
+    if not transcripts:
+        print("Новых транскриптов нет")
+        await database.dispose()
+        return 0
+
+    cpu_count = os.cpu_count() or 1
+    workers = min(workers or cpu_count, len(transcripts))
+    print(f"К импорту: {len(transcripts)} файлов, процессов: {workers}")
+
+    loop = asyncio.get_running_loop()
+    total_turns = 0
+    failed = 0
+    without_username = set()
+
+    with tempfile.TemporaryDirectory(prefix="import_transcripts_") as spool_dir, ProcessPoolExecutor(
+        max_workers=workers,
+        # spawn: дочерние процессы не наследуют event loop и соединения с БД
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(max(1, cpu_count // workers),)
+    ) as pool:
+        async def prepare(transcript: Transcript) -> tuple:
+            spool_path = os.path.join(spool_dir, f"{transcript.sha256}.csv")
+            try:
+                speakers, turns = await loop.run_in_executor(
+                    pool, prepare_transcript, transcript.file_path, transcript.conversation_time, spool_path
+                )
+            except Exception as e:
+                return transcript, spool_path, None, 0, e
+            return transcript, spool_path, speakers, turns, None
+
+        # Файлы записываются в БД в порядке готовности, пока остальные векторизуются
+        for done, next_prepared in enumerate(asyncio.as_completed([prepare(t) for t in transcripts]), 1):
+            transcript, spool_path, speakers, turns, error = await next_prepared
+            try:
+                if error is not None:
+                    raise error
+                conv_date = datetime.strptime(transcript.conversation_date, "%Y-%m-%d").date()
+                conv_time = datetime.strptime(transcript.conversation_time, "%H:%M").time()
+
+                async with session_maker() as session:
+                    try:
+                        with open(spool_path, 'r', encoding='utf-8', newline='') as spool:
+                            participants, conversation_id = await insert_spooled_conversation(
+                                session, spool, set(speakers), conv_date, conv_time
+                            )
+                        # Отметка об импорте — в той же транзакции, что и беседа
+                        session.add(ImportedTranscript(
+                            sha256=transcript.sha256,
+                            file_name=transcript.file_name,
+                            conversation_id=conversation_id
+                        ))
+                        await session.commit()
+                    except Exception:
+                        await session.rollback()
+                        raise
+            except Exception as e:
+                failed += 1
+                print(f"[{done}/{len(transcripts)}] ❌ {transcript.file_name}: {e}")
+                continue
+            finally:
+                if os.path.exists(spool_path):
+                    os.remove(spool_path)
+
+            total_turns += turns
+            without_username.update(p['name'] for p in participants)
+            print(f"[{done}/{len(transcripts)}] ✅ {transcript.file_name}: {turns} реплик, беседа {conversation_id}")
+
+    await database.dispose()
+
+    seconds = perf_counter() - started
+    print(
+        f"Импортировано файлов: {len(transcripts) - failed}, с ошибкой: {failed}; "
+        f"реплик: {total_turns} за {seconds:.1f} с ({total_turns / seconds if seconds else 0:.1f} реплик/с)"
+    )
+    if without_username:
+        print("Участники без tg_username: " + ", ".join(sorted(without_username)))
+    if failed < len(transcripts):
+        # Работающий бот строит примеры стиля при запуске
+        print("Перезапустите бота, чтобы примеры стиля учитывали новые беседы")
+    return failed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Пакетный импорт транскриптов разговоров в БД")
+    parser.add_argument("directory", nargs="?", default=JSON_FOLDER, help=f"папка с JSON файлами (по умолчанию {JSON_FOLDER})")
+    parser.add_argument("--manifest", help='JSON {"файл.json": {"date": "ГГГГ-ММ-ДД", "time": "ЧЧ:ММ"}}')
+    parser.add_argument("--workers", type=int, default=IMPORT_WORKERS, help="число процессов (0 — по числу ядер)")
+    args = parser.parse_args()
+
+    failed = asyncio.run(import_directory(args.directory, args.manifest, args.workers))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
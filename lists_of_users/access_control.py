@@ -0,0 +1,330 @@
+import asyncio
+from typing import Dict, List, Optional, Set, Tuple
+
+from lists_of_users.create_JSON_lists import (
+    APPLICATIONS_JSON, ADMITTED_JSON, BLACKLIST_JSON,
+    load_applications, load_admitted, load_blacklist, write_json_atomic
+)
+from storage import KeyValueBackend
+from config import ACCESS_FLUSH_DELAY, ACCESS_REFRESH_INTERVAL
+
+ACCESS_NAMESPACE = "access"
+
+# Сколько раз подряд повторять запись списков, если их одновременно изменил другой экземпляр
+MAX_WRITE_ATTEMPTS = 5
+
+# Имена списков (ключи в общем хранилище)
+APPLICATIONS = "applications"
+ADMITTED = "admitted"
+BLACKLIST = "blacklist"
+
+LIST_FILES = {
+    APPLICATIONS: APPLICATIONS_JSON,
+    ADMITTED: ADMITTED_JSON,
+    BLACKLIST: BLACKLIST_JSON,
+}
+
+
+def normalize_username(username: Optional[str]) -> Optional[str]:
+    """Username в виде ключа списков: '@' в начале, без пробелов по краям"""
+    if not username:
+        return None
+    username = username.strip().lstrip("@")
+    return f"@{username}" if username else None
+
+
+class AccessList:
+    """
+    Список {@username: ФИО}.
+
+    Поиск не зависит от регистра и наличия '@' (username в Telegram
+    регистронезависимы), а ключ хранится в том виде, в каком был добавлен.
+    """
+
+    def __init__(self, entries: Optional[Dict[str, str]] = None):
+        self._entries: Dict[str, str] = {}
+        self._index: Dict[str, str] = {}
+        for username, full_name in (entries or {}).items():
+            self.set(username, full_name)
+
+    def key(self, username: Optional[str]) -> Optional[str]:
+        """Ключ пользователя в списке или None"""
+        normalized = normalize_username(username)
+        return self._index.get(normalized.casefold()) if normalized else None
+
+    def __contains__(self, username: Optional[str]) -> bool:
+        return self.key(username) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, username: Optional[str]) -> Optional[str]:
+        key = self.key(username)
+        return self._entries[key] if key else None
+
+    def set(self, username: str, full_name: str) -> None:
+        old_key = self.key(username)
+        if old_key:
+            del self._entries[old_key]
+        key = normalize_username(username)
+        self._entries[key] = full_name
+        self._index[key.casefold()] = key
+
+    def pop(self, username: Optional[str]) -> Optional[Tuple[str, str]]:
+        """Удаляет пользователя; возвращает (ключ, ФИО) или None"""
+        key = self.key(username)
+        if key is None:
+            return None
+        del self._index[key.casefold()]
+        return key, self._entries.pop(key)
+
+    def items(self) -> List[Tuple[str, str]]:
+        return list(self._entries.items())
+
+    def to_dict(self) -> Dict[str, str]:
+        return dict(self._entries)
+
+
+class AccessStore:
+    """
+    Заявки, разрешённые пользователи и чёрный список в памяти процесса.
+
+    Проверки доступа — поиск в словаре, без чтения файлов. Изменения пишутся
+    через flush_delay секунд после первого из них, поэтому серия решений
+    владельца сохраняется одной записью. Файлы lists_of_users заменяются
+    атомарно (временный файл + os.replace); после attach списки хранятся
+    в общем хранилище (kv_store) вместо файлов.
+
+    В общем хранилище списки могут менять несколько экземпляров бота, поэтому
+    пишутся не снимки, а изменения по пользователям: при записи список
+    перечитывается, к нему применяются несохранённые изменения этого
+    экземпляра, и он записывается с проверкой версии (set_versioned). Чужие
+    изменения подхватываются при записи и раз в refresh_interval секунд.
+    """
+
+    def __init__(self, flush_delay: float = ACCESS_FLUSH_DELAY, refresh_interval: float = ACCESS_REFRESH_INTERVAL):
+        self.flush_delay = flush_delay
+        self.refresh_interval = refresh_interval
+        self.applications = AccessList()
+        self.admitted = AccessList()
+        self.blacklist = AccessList()
+        self.backend: Optional[KeyValueBackend] = None
+        self._dirty: Set[str] = set()
+        # Несохранённые изменения: список -> {username в нижнем регистре: (username, ФИО или None — удалён)}
+        self._pending: Dict[str, Dict[str, Tuple[str, Optional[str]]]] = {}
+        self._lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        self._refresher: Optional[asyncio.Task] = None
+        self.changes = 0
+        self.flushes = 0
+        self.conflicts = 0
+
+    @property
+    def _lists(self) -> Dict[str, AccessList]:
+        return {APPLICATIONS: self.applications, ADMITTED: self.admitted, BLACKLIST: self.blacklist}
+
+    def load(self) -> None:
+        """Читает списки из JSON-файлов (один раз при запуске)"""
+        self.applications = AccessList(load_applications())
+        self.admitted = AccessList(load_admitted())
+        self.blacklist = AccessList(load_blacklist())
+
+    async def attach(self, backend: KeyValueBackend) -> None:
+        """Переносит хранение списков в общее хранилище; отсутствующие там списки берутся из файлов"""
+        self.backend = backend
+        for name in list(self._lists):
+            stored = await backend.get(ACCESS_NAMESPACE, name)
+            if stored is None:
+                # Список из файла переносится как изменения: их можно объединить с записью другого экземпляра
+                for username, full_name in self._lists[name].items():
+                    self._record(name, username, full_name)
+                self._dirty.add(name)
+            else:
+                setattr(self, name, self._parse(stored)[1])
+        if self._dirty:
+            await self.flush()
+        self._refresher = asyncio.create_task(self._run_refresher())
+
+    async def close(self) -> None:
+        """Останавливает отложенную запись и обновление и сохраняет оставшиеся изменения"""
+        for task in (self._flusher, self._refresher):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._flusher = None
+        self._refresher = None
+        await self.flush()
+
+    def is_admitted(self, username: Optional[str]) -> bool:
+        return username in self.admitted
+
+    def is_blacklisted(self, username: Optional[str]) -> bool:
+        return username in self.blacklist
+
+    def add_application(self, username: str, full_name: str) -> None:
+        self.applications.set(username, full_name)
+        self._record(APPLICATIONS, username, full_name)
+        self._changed(APPLICATIONS)
+
+    def approve(self, username: str) -> Optional[str]:
+        """Заявка -> разрешённые; возвращает ФИО или None, если заявки нет"""
+        return self._move(self.applications, self.admitted, APPLICATIONS, ADMITTED, username)
+
+    def reject(self, username: str) -> Optional[str]:
+        """Удаляет заявку; возвращает ФИО или None, если заявки нет"""
+        removed = self.applications.pop(username)
+        if removed is None:
+            return None
+        self._record(APPLICATIONS, removed[0], None)
+        self._changed(APPLICATIONS)
+        return removed[1]
+
+    def revoke(self, username: str) -> Optional[str]:
+        """Разрешённые -> чёрный список; возвращает ФИО или None, если пользователя нет"""
+        return self._move(self.admitted, self.blacklist, ADMITTED, BLACKLIST, username)
+
+    def unban(self, username: str) -> Optional[str]:
+        """Чёрный список -> разрешённые; возвращает ФИО или None, если пользователя нет"""
+        return self._move(self.blacklist, self.admitted, BLACKLIST, ADMITTED, username)
+
+    async def flush(self) -> None:
+        """Записывает изменённые списки"""
+        async with self._lock:
+            if not self._dirty:
+                return
+            names = set(self._dirty)
+            self._dirty.clear()
+            pending = {name: self._pending.pop(name, {}) for name in names}
+
+            try:
+                if self.backend is not None:
+                    await self._write_merged(pending)
+                else:
+                    snapshot = {name: self._lists[name].to_dict() for name in names}
+                    await asyncio.to_thread(self._write_files, snapshot)
+                self.flushes += 1
+            except asyncio.CancelledError:
+                self._restore_pending(names, pending)
+                raise
+            except Exception as e:
+                # Списки остаются изменёнными и будут записаны следующей попыткой
+                self._restore_pending(names, pending)
+                print(f"Ошибка сохранения списков доступа: {e}")
+
+    async def refresh(self) -> None:
+        """Перечитывает списки из общего хранилища (их могли изменить другие экземпляры)"""
+        if self.backend is None:
+            return
+        async with self._lock:
+            for name, (_, entries) in (await self._read(list(self._lists))).items():
+                # Несохранённые изменения этого экземпляра остаются поверх прочитанного
+                self._apply(entries, self._pending.get(name, {}))
+                setattr(self, name, entries)
+
+    def stats(self) -> dict:
+        return {
+            "admitted": len(self.admitted),
+            "applications": len(self.applications),
+            "blacklist": len(self.blacklist),
+            "changes": self.changes,
+            "flushes": self.flushes,
+            "conflicts": self.conflicts,
+            "unsaved": len(self._dirty),
+        }
+
+    async def _write_merged(self, pending: Dict[str, Dict[str, Tuple[str, Optional[str]]]]) -> None:
+        """Применяет изменения к свежим спискам из хранилища и записывает их с проверкой версии"""
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            merged = {}
+            for name, (version, entries) in (await self._read(list(pending))).items():
+                self._apply(entries, pending[name])
+                merged[name] = (version + 1, entries)
+
+            conflicts = await self.backend.set_versioned(ACCESS_NAMESPACE, {
+                name: {"version": version, "entries": entries.to_dict()}
+                for name, (version, entries) in merged.items()
+            })
+            for name, (_, entries) in merged.items():
+                if name in conflicts:
+                    continue
+                # Изменения, сделанные во время записи, остаются поверх записанного
+                self._apply(entries, self._pending.get(name, {}))
+                setattr(self, name, entries)
+                del pending[name]
+
+            if not pending:
+                return
+            self.conflicts += len(pending)
+        raise RuntimeError(f"списки {', '.join(sorted(pending))} постоянно изменяются другими экземплярами")
+
+    async def _read(self, names: List[str]) -> Dict[str, Tuple[int, AccessList]]:
+        result = {}
+        for name in names:
+            stored = await self.backend.get(ACCESS_NAMESPACE, name)
+            result[name] = self._parse(stored) if stored is not None else (0, AccessList())
+        return result
+
+    @staticmethod
+    def _parse(stored: dict) -> Tuple[int, AccessList]:
+        # Раньше списки хранились без версии, простым словарём {username: ФИО}
+        if "entries" not in stored:
+            return 0, AccessList(stored)
+        return stored.get("version", 0), AccessList(stored["entries"])
+
+    @staticmethod
+    def _apply(entries: AccessList, changes: Dict[str, Tuple[str, Optional[str]]]) -> None:
+        for username, full_name in changes.values():
+            if full_name is None:
+                entries.pop(username)
+            else:
+                entries.set(username, full_name)
+
+    def _record(self, name: str, username: str, full_name: Optional[str]) -> None:
+        self._pending.setdefault(name, {})[normalize_username(username).casefold()] = (username, full_name)
+
+    def _restore_pending(self, names: Set[str], pending: Dict[str, Dict[str, Tuple[str, Optional[str]]]]) -> None:
+        self._dirty |= names
+        for name, changes in pending.items():
+            # Более поздние изменения того же пользователя важнее возвращаемых
+            self._pending[name] = {**changes, **self._pending.get(name, {})}
+
+    def _move(self, source: AccessList, target: AccessList, source_name: str, target_name: str, username: str) -> Optional[str]:
+        moved = source.pop(username)
+        if moved is None:
+            return None
+        target.set(*moved)
+        self._record(source_name, moved[0], None)
+        self._record(target_name, *moved)
+        self._changed(source_name, target_name)
+        return moved[1]
+
+    def _changed(self, *names: str) -> None:
+        self.changes += 1
+        self._dirty.update(names)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run_flusher())
+
+    async def _run_flusher(self) -> None:
+        # Изменения, пришедшие во время записи, сохраняются следующим проходом
+        while self._dirty:
+            await asyncio.sleep(self.flush_delay)
+            await self.flush()
+
+    async def _run_refresher(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Ошибка обновления списков доступа: {e}")
+
+    @staticmethod
+    def _write_files(snapshot: Dict[str, Dict[str, str]]) -> None:
+        for name, data in snapshot.items():
+            write_json_atomic(LIST_FILES[name], data)
+
+
+access_store = AccessStore()
@@ -1,4 +1,5 @@
 import json
+import os
 from pathlib import Path
 from typing import Dict
 
@@ -32,18 +33,23 @@ def load_admitted() -> Dict[str, str]:
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
 
+def write_json_atomic(path: Path, data: Dict[str, str]) -> None:
+    """Записывает JSON через временный файл и os.replace: при сбое на диске остаётся прежний файл целиком."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
 def save_applications(data: Dict[str, str]) -> None:
     """Сохраняет словарь в JSON-файл."""
-    with open(APPLICATIONS_JSON, "w", encoding="utf-8") as file:
-        json.dump(data, file, ensure_ascii=False, indent=4)
+    write_json_atomic(APPLICATIONS_JSON, data)
         
 def save_blacklist(data: Dict[str, str]) -> None:
     """Сохраняет словарь в JSON-файл."""
-    with open(BLACKLIST_JSON, "w", encoding="utf-8") as file:
-        json.dump(data, file, ensure_ascii=False, indent=4)
+    write_json_atomic(BLACKLIST_JSON, data)
         
 def save_admitted(data: Dict[str, str]) -> None:
     """Сохраняет словарь в JSON-файл."""
-    with open(ADMITTED_JSON, "w", encoding="utf-8") as file:
-        json.dump(data, file, ensure_ascii=False, indent=4)
-
+    write_json_atomic(ADMITTED_JSON, data)
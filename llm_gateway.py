@@ -0,0 +1,340 @@
+import asyncio
+import random
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple, TypeVar
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from config import (
+    DEESEEK_API_KEY1, LLM_BASE_URL, LLM_MODEL, LLM_HEDGE_MODEL, LLM_HEDGE_AFTER_SECONDS,
+    LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT, LLM_MAX_CONNECTIONS, LLM_MAX_KEEPALIVE_CONNECTIONS,
+    LLM_MAX_CONCURRENCY, LLM_MAX_CONCURRENCY_PER_USER, LLM_MAX_QUEUE,
+    LLM_MAX_RETRIES, LLM_BACKOFF_BASE, LLM_BACKOFF_MAX
+)
+from metrics import percentile
+
+T = TypeVar("T")
+
+# Ошибки, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,  # включает APITimeoutError
+)
+
+
+class LLMOverloaded(Exception):
+    """Очередь ожидания к модели заполнена — запрос отклонён сразу, без ожидания"""
+
+
+@dataclass
+class LLMMetrics:
+    """Метрики обращений к модели (задержки — по последним window запросам)"""
+    window: int = 1000
+    requests: int = 0
+    failures: int = 0
+    rejected: int = 0
+    attempts: int = 0
+    retries: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    waiting: int = 0
+    latencies_ms: Deque[float] = field(default_factory=deque)
+    queue_waits_ms: Deque[float] = field(default_factory=deque)
+
+    def _push(self, values: deque, value: float) -> None:
+        values.append(value)
+        if len(values) > self.window:
+            values.popleft()
+
+    def snapshot(self) -> dict:
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "waiting": self.waiting,
+            "latency_p50_ms": percentile(self.latencies_ms, 50),
+            "latency_p95_ms": percentile(self.latencies_ms, 95),
+            "queue_wait_p95_ms": percentile(self.queue_waits_ms, 95),
+        }
+
+
+class LLMGateway:
+    """
+    Обращения к OpenAI-совместимому API (OpenRouter) с ограничением нагрузки.
+
+    - Не больше max_concurrency запросов всего и max_per_user на пользователя;
+      ожидающих слота не больше max_queue, остальные сразу получают LLMOverloaded.
+    - Явные таймауты соединения/чтения и пул keep-alive соединений httpx.
+    - Повтор при 429/5xx/сетевых ошибках с экспоненциальной задержкой и полным джиттером
+      (Retry-After сервера учитывается).
+    - Если основная модель не ответила (для потока — не прислала первый токен)
+      за hedge_after секунд, параллельно запускается запрос к hedge_model;
+      используется ответ, пришедший первым, второй отменяется.
+
+    base_url настраивается, поэтому шлюз можно проверить на локальном
+    поддельном OpenAI-совместимом сервере.
+    """
+
+    def __init__(
+        self,
+        base_url: str = LLM_BASE_URL,
+        api_key: str = DEESEEK_API_KEY1,
+        model: str = LLM_MODEL,
+        hedge_model: str = LLM_HEDGE_MODEL,
+        hedge_after: float = LLM_HEDGE_AFTER_SECONDS,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        max_per_user: int = LLM_MAX_CONCURRENCY_PER_USER,
+        max_queue: int = LLM_MAX_QUEUE,
+        max_retries: int = LLM_MAX_RETRIES,
+        backoff_base: float = LLM_BACKOFF_BASE,
+        backoff_max: float = LLM_BACKOFF_MAX
+    ):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.hedge_model = hedge_model
+        self.hedge_after = hedge_after
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.metrics = LLMMetrics()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._user_semaphores: Dict[int, asyncio.Semaphore] = {}
+        self._user_holders: Dict[int, int] = {}
+        self._client: Optional[AsyncOpenAI] = None
+        # Проигравшие хеджированные запросы, которые ещё доотменяются в фоне
+        self._discards: Set[asyncio.Task] = set()
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        # Клиент создаётся при первом запросе: httpx-пул привязан к работающему event loop
+        if self._client is None:
+            self._client = AsyncOpenAI(
+                base_url=self.base_url,
+                api_key=self.api_key,
+                max_retries=0,  # повторы делает сам шлюз
+                http_client=httpx.AsyncClient(
+                    timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS
+                    )
+                )
+            )
+        return self._client
+
+    async def close(self) -> None:
+        for task in self._discards:
+            task.cancel()
+        await asyncio.gather(*self._discards, return_exceptions=True)
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def complete(self, user_id: int, messages: List[dict]) -> str:
+        """Ответ модели целиком"""
+        async with self._slot(user_id):
+            started = perf_counter()
+            try:
+                completion = await self._hedged(
+                    lambda model: self._with_retries(
+                        lambda: self.client.chat.completions.create(model=model, messages=messages)
+                    ),
+                    self._discard_completion
+                )
+            except Exception:
+                self.metrics.failures += 1
+                raise
+            self.metrics._push(self.metrics.latencies_ms, (perf_counter() - started) * 1000)
+            return completion.choices[0].message.content or ""
+
+    async def stream(self, user_id: int, messages: List[dict]) -> AsyncIterator[str]:
+        """
+        Ответ модели по частям.
+
+        Повторы и хеджирование действуют до первого токена: после того как
+        пользователь начал получать ответ, переключаться на другой запрос нельзя.
+        """
+        async with self._slot(user_id):
+            started = perf_counter()
+            try:
+                stream, iterator, first = await self._hedged(
+                    lambda model: self._with_retries(lambda: self._open_stream(model, messages)),
+                    self._discard_stream
+                )
+            except Exception:
+                self.metrics.failures += 1
+                raise
+            self.metrics._push(self.metrics.latencies_ms, (perf_counter() - started) * 1000)
+
+            try:
+                if first:
+                    yield first
+                async for chunk in iterator:
+                    delta = self._delta(chunk)
+                    if delta:
+                        yield delta
+            finally:
+                await stream.close()
+
+    def stats(self) -> dict:
+        return self.metrics.snapshot()
+
+    @asynccontextmanager
+    async def _slot(self, user_id: int) -> AsyncIterator[None]:
+        """Слот в общем и пользовательском лимитах на время одного запроса"""
+        await self._acquire(user_id)
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+    async def _acquire(self, user_id: int) -> None:
+        user_semaphore = self._user_semaphores.get(user_id)
+        must_wait = (user_semaphore is not None and user_semaphore.locked()) or self._semaphore.locked()
+        if must_wait and self.metrics.waiting >= self.max_queue:
+            self.metrics.rejected += 1
+            raise LLMOverloaded()
+
+        if user_semaphore is None:
+            user_semaphore = self._user_semaphores[user_id] = asyncio.Semaphore(self.max_per_user)
+        self.metrics.requests += 1
+        self._user_holders[user_id] = self._user_holders.get(user_id, 0) + 1
+        self.metrics.waiting += 1
+        waited_from = perf_counter()
+        try:
+            await user_semaphore.acquire()
+            try:
+                await self._semaphore.acquire()
+            except BaseException:
+                user_semaphore.release()
+                raise
+        except BaseException:
+            self._forget_user(user_id)
+            raise
+        finally:
+            self.metrics.waiting -= 1
+        self.metrics._push(self.metrics.queue_waits_ms, (perf_counter() - waited_from) * 1000)
+
+    def _release(self, user_id: int) -> None:
+        self._semaphore.release()
+        self._user_semaphores[user_id].release()
+        self._forget_user(user_id)
+
+    def _forget_user(self, user_id: int) -> None:
+        # Семафор пользователя удаляется, когда у него не осталось запросов
+        self._user_holders[user_id] -= 1
+        if not self._user_holders[user_id]:
+            del self._user_holders[user_id]
+            del self._user_semaphores[user_id]
+
+    async def _with_retries(self, call: Callable[[], Awaitable[T]]) -> T:
+        for attempt in range(self.max_retries + 1):
+            self.metrics.attempts += 1
+            try:
+                return await call()
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                self.metrics.retries += 1
+                print(f"Ошибка LLM ({type(e).__name__}), повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        # Полный джиттер: случайная задержка до экспоненциально растущего потолка
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                delay = max(delay, min(float(retry_after), self.backoff_max))
+            except ValueError:
+                pass
+        return delay
+
+    async def _hedged(
+        self,
+        request: Callable[[str], Awaitable[T]],
+        discard: Callable[[T], Awaitable[None]]
+    ) -> T:
+        """Запрос к основной модели, а при задержке — параллельно к запасной; возвращает первый успешный"""
+        primary = asyncio.create_task(request(self.model))
+        tasks = {primary}
+        winner: Optional[asyncio.Task] = None
+        try:
+            if self.hedge_model:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+                if not done:
+                    self.metrics.hedges += 1
+                    tasks.add(asyncio.create_task(request(self.hedge_model)))
+            
+            error: Optional[BaseException] = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is not primary:
+                            self.metrics.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks - {winner}:
+                task.cancel()
+                # Ссылка на фоновую задачу хранится, иначе её может собрать сборщик мусора
+                cleanup = asyncio.create_task(self._discard_later(task, discard))
+                self._discards.add(cleanup)
+                cleanup.add_done_callback(self._discards.discard)
+
+    @staticmethod
+    async def _discard_later(task: asyncio.Task, discard: Callable[[T], Awaitable[None]]) -> None:
+        # Проигравший запрос мог успеть завершиться до отмены — освобождаем его ресурсы
+        try:
+            result = await task
+        except BaseException:
+            return
+        await discard(result)
+
+    async def _open_stream(self, model: str, messages: List[dict]) -> Tuple[openai.AsyncStream, AsyncIterator, str]:
+        """Открывает поток и дожидается первого непустого фрагмента"""
+        stream = await self.client.chat.completions.create(model=model, messages=messages, stream=True)
+        iterator = stream.__aiter__()
+        try:
+            async for chunk in iterator:
+                delta = self._delta(chunk)
+                if delta:
+                    return stream, iterator, delta
+        except BaseException:
+            await stream.close()
+            raise
+        return stream, iterator, ""
+
+    @staticmethod
+    async def _discard_completion(completion) -> None:
+        pass
+
+    @staticmethod
+    async def _discard_stream(opened: Tuple[openai.AsyncStream, AsyncIterator, str]) -> None:
+        await opened[0].close()
+
+    @staticmethod
+    def _delta(chunk) -> Optional[str]:
+        return chunk.choices[0].delta.content if chunk.choices else None
+
+
+llm_gateway = LLMGateway()
@@ -0,0 +1,10 @@
+from typing import Iterable
+
+
+def percentile(values: Iterable[float], percent: float) -> float:
+    """Перцентиль по выборке (без интерполяции), 0 для пустой выборки"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
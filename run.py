@@ -2,51 +2,104 @@ import asyncio
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from typing import Dict
-import nltk
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
-from Database.db_create import init_db
-from handlers.handlers import handlers_router
-from handlers.request_handler import application_router
-from handlers.owner_handlers import owners_router
-from db_operations.db_operatins import dboperations_router
-from lists_of_users.create_JSON_lists import load_applications, load_blacklist, load_admitted
-from config import TOKEN  # API ключ телеграмма
+from db_operations.resources import startup_timer, warm_up
 
+with startup_timer.phase("imports"):
+    from Database.db_create import init_db
+    from handlers.handlers import handlers_router
+    from handlers.request_handler import application_router
+    from handlers.owner_handlers import owners_router
+    from db_operations.db_operatins import dboperations_router
+    from lists_of_users.access_control import access_store
+    from context_store import context_store
+    from db_operations.extracting_style import style_digests
+    from storage import create_backend, KeyValueFSMStorage
+    from llm_gateway import llm_gateway
+    from handlers.access_gate import register_access_gate
+    from handlers.in_flight import in_flight
+    from webhook import set_webhook, run_webhook
+    from db_operations.ingestion_jobs import ingestion_queue
+from config import TOKEN, ACCESS_STORAGE, RUN_MODE, TELEGRAM_API_SERVER, SHUTDOWN_DRAIN_TIMEOUT  # API ключ телеграмма
+
+
+async def on_startup(dispatcher: Dispatcher, bot: Bot) -> None:
+    # Модель и ресурсы NLTK прогреваются в фоне, не задерживая приём апдейтов
+    dispatcher['warm_up_task'] = asyncio.create_task(warm_up())
+    # Примеры стиля владельца для всех гостей строятся одним запросом заранее
+    dispatcher['style_digests_task'] = asyncio.create_task(style_digests.load(dispatcher['ingestion_session_maker']))
+    # Загрузки, прерванные перезапуском, продолжаются в фоне
+    await ingestion_queue.start(bot, dispatcher)
+    if RUN_MODE == "webhook":
+        await set_webhook(bot, dispatcher)
+    print(startup_timer.report())
+
+
+async def on_shutdown(dispatcher: Dispatcher) -> None:
+    # Начатые ответы дописываются до закрытия клиента модели и хранилищ
+    await in_flight.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    await ingestion_queue.close()
+    # Несохранённые решения по доступу записываются до закрытия хранилища
+    await access_store.close()
+    await llm_gateway.close()
+    # Сохраняем несохранённые контексты диалогов до закрытия хранилища
+    await context_store.close()
+    if dispatcher['storage_backend']:
+        await dispatcher['storage_backend'].close()
+    await dispatcher['database'].dispose()
 
 
 async def main():
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER)) if TELEGRAM_API_SERVER else None
+    bot = Bot(token=TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+    # Инициализируем базу данных и получаем engine и sessionmaker
+    with startup_timer.phase("database"):
+        database = await init_db()
+    async_session_maker = database.session_maker
     
-    try:
-        nltk.download('punkt')
-        nltk.download('stopwords')
-        nltk.download('wordnet')
-        print("NLTK resources downloaded successfully")
-    except Exception as e:
-        print(f"Error downloading NLTK resources: {e}")
-    bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    
-    dp = Dispatcher()
+    # Контексты диалогов и состояния FSM в общем хранилище (если настроено) переживают перезапуск
+    storage_backend = create_backend(async_session_maker)
+    if storage_backend:
+        context_store.attach(storage_backend)
+        dp = Dispatcher(storage=KeyValueFSMStorage(storage_backend))
+    else:
+        dp = Dispatcher()
+    # Роль отправителя определяется до чтения FSM и обработчиков; чёрный список отбрасывается
+    register_access_gate(dp)
+    # Число одновременно обрабатываемых апдейтов ограничено; при остановке их дожидаемся
+    dp.update.outer_middleware.register(in_flight)
     dp.include_router(dboperations_router) 
     dp.include_router(handlers_router)
     dp.include_router(application_router)
     dp.include_router(owners_router)
-
-    # Инициализируем базу данных и получаем engine и sessionmaker
-    engine, async_session_maker = await init_db()
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    dp['storage_backend'] = storage_backend
     
-    applications: Dict[str, str] = load_applications()
-    blacklist: Dict[str, str] = load_blacklist()
-    list_of_users: Dict[str, str] = load_admitted()
+    # Списки доступа читаются один раз: дальше проверки идут по памяти
+    access_store.load()
+    if ACCESS_STORAGE == "storage":
+        if storage_backend is None:
+            raise RuntimeError("Для ACCESS_STORAGE = \"storage\" нужно общее хранилище: укажите STORAGE_BACKEND = \"postgres\" или \"sqlite\" в config.py")
+        await access_store.attach(storage_backend)
     
-    # Сохраняем engine и sessionmaker в диспетчере для дальнейшего использования
-    dp['applications'] = applications
-    dp['blacklist'] = blacklist
-    dp['list_of_users'] = list_of_users
+    # Сохраняем движки и sessionmaker'ы в диспетчере для дальнейшего использования
+    dp['database'] = database
     dp['async_session_maker'] = async_session_maker
+    # Загрузка разговоров работает через отдельный пул и не занимает соединения поиска
+    dp['ingestion_session_maker'] = database.ingestion_session_maker
+    dp['ingestion_queue'] = ingestion_queue
     
-    # Запускаем polling
-    await dp.start_polling(bot)
+    if RUN_MODE == "webhook":
+        # Апдейты приходят на встроенный HTTP-сервер; несколько экземпляров — только при маршрутизации по chat_id
+        await run_webhook(dp, bot)
+    else:
+        # Вебхук, оставшийся от запуска в режиме webhook, мешает getUpdates
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
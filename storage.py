@@ -0,0 +1,247 @@
+import asyncio
+import copy
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from time import monotonic
+from typing import Any, Dict, Mapping, Optional, Set, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.sql import text
+
+from config import STORAGE_BACKEND, STORAGE_READ_CACHE_SECONDS, STORAGE_SQLITE_PATH
+
+
+class KeyValueBackend(ABC):
+    """Общее хранилище JSON-значений по (пространство имён, ключ) для контекстов диалогов и состояний FSM"""
+
+    @abstractmethod
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        """Возвращает значение или None, если ключа нет"""
+
+    @abstractmethod
+    async def set_many(self, namespace: str, items: Mapping[str, Optional[Any]]) -> None:
+        """Записывает несколько значений одной операцией; None удаляет ключ"""
+
+    @abstractmethod
+    async def set_versioned(self, namespace: str, items: Mapping[str, Dict[str, Any]]) -> Set[str]:
+        """
+        Записывает значения с полем version, если в хранилище записи нет
+        или её version на единицу меньше. Возвращает ключи, записать которые
+        не удалось: их успели изменить другие экземпляры бота.
+        """
+
+    async def set(self, namespace: str, key: str, value: Optional[Any]) -> None:
+        await self.set_many(namespace, {key: value})
+
+    async def close(self) -> None:
+        pass
+
+
+class PostgresKeyValueBackend(KeyValueBackend):
+    """Хранение в таблице kv_store основной БД (создаётся миграцией)"""
+
+    def __init__(self, session_maker: async_sessionmaker[AsyncSession]):
+        self.session_maker = session_maker
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        async with self.session_maker() as session:
+            result = await session.execute(
+                text("SELECT value::text FROM kv_store WHERE namespace = :namespace AND key = :key"),
+                {"namespace": namespace, "key": key}
+            )
+            value = result.scalar()
+        # Читаем как текст: иначе строковое значение (состояние FSM) неотличимо от сериализованного JSON
+        return json.loads(value) if value is not None else None
+
+    async def set_many(self, namespace: str, items: Mapping[str, Optional[Any]]) -> None:
+        upserts = [
+            {"namespace": namespace, "key": key, "value": json.dumps(value, ensure_ascii=False)}
+            for key, value in items.items() if value is not None
+        ]
+        deletes = [key for key, value in items.items() if value is None]
+        
+        async with self.session_maker() as session:
+            if upserts:
+                await session.execute(
+                    text("""
+                        INSERT INTO kv_store (namespace, key, value, updated_at)
+                        VALUES (:namespace, :key, CAST(:value AS jsonb), now())
+                        ON CONFLICT (namespace, key)
+                        DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+                    """),
+                    upserts
+                )
+            if deletes:
+                await session.execute(
+                    text("DELETE FROM kv_store WHERE namespace = :namespace AND key = ANY(:keys)"),
+                    {"namespace": namespace, "keys": deletes}
+                )
+            await session.commit()
+
+    async def set_versioned(self, namespace: str, items: Mapping[str, Dict[str, Any]]) -> Set[str]:
+        if not items:
+            return set()
+        async with self.session_maker() as session:
+            # Ожидаемая версия записи — на единицу меньше новой, поэтому условие обходится без отдельного параметра
+            result = await session.execute(
+                text("""
+                    INSERT INTO kv_store (namespace, key, value, updated_at)
+                    SELECT :namespace, item.key, item.value, now()
+                    FROM jsonb_each(CAST(:items AS jsonb)) AS item(key, value)
+                    ON CONFLICT (namespace, key)
+                    DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+                    WHERE COALESCE((kv_store.value->>'version')::int, 0) = (EXCLUDED.value->>'version')::int - 1
+                    RETURNING key
+                """),
+                {"namespace": namespace, "items": json.dumps(dict(items), ensure_ascii=False)}
+            )
+            written = set(result.scalars().all())
+            await session.commit()
+        return set(items) - written
+
+
+class SQLiteKeyValueBackend(KeyValueBackend):
+    """Локальный файл SQLite: для разработки и тестов без PostgreSQL"""
+
+    def __init__(self, path: str = STORAGE_SQLITE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS kv_store (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        self._conn.commit()
+
+    def _get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM kv_store WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_many(self, namespace: str, items: Mapping[str, Optional[Any]]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO kv_store (namespace, key, value) VALUES (?, ?, ?)",
+                [
+                    (namespace, key, json.dumps(value, ensure_ascii=False))
+                    for key, value in items.items() if value is not None
+                ]
+            )
+            self._conn.executemany(
+                "DELETE FROM kv_store WHERE namespace = ? AND key = ?",
+                [(namespace, key) for key, value in items.items() if value is None]
+            )
+
+    def _set_versioned(self, namespace: str, items: Mapping[str, Dict[str, Any]]) -> Set[str]:
+        conflicts = set()
+        with self._lock, self._conn:
+            for key, value in items.items():
+                cursor = self._conn.execute(
+                    """
+                    INSERT INTO kv_store (namespace, key, value) VALUES (?, ?, ?)
+                    ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value
+                    WHERE COALESCE(json_extract(kv_store.value, '$.version'), 0) = json_extract(excluded.value, '$.version') - 1
+                    """,
+                    (namespace, key, json.dumps(value, ensure_ascii=False))
+                )
+                if cursor.rowcount == 0:
+                    conflicts.add(key)
+        return conflicts
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self._get, namespace, key)
+
+    async def set_many(self, namespace: str, items: Mapping[str, Optional[Any]]) -> None:
+        await asyncio.to_thread(self._set_many, namespace, dict(items))
+
+    async def set_versioned(self, namespace: str, items: Mapping[str, Dict[str, Any]]) -> Set[str]:
+        return await asyncio.to_thread(self._set_versioned, namespace, dict(items))
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class KeyValueFSMStorage(BaseStorage):
+    """
+    Хранилище состояний FSM aiogram поверх KeyValueBackend.
+    
+    Записи идут в хранилище сразу, прочитанное кэшируется на read_cache_seconds:
+    на одно обновление aiogram несколько раз читает состояние и данные, и без
+    кэша каждое чтение — отдельный запрос. Другой экземпляр бота увидит
+    изменение не позже чем через read_cache_seconds (0 — читать всегда).
+    """
+
+    namespace = "fsm"
+
+    def __init__(
+        self,
+        backend: KeyValueBackend,
+        key_builder: Optional[KeyBuilder] = None,
+        read_cache_seconds: float = STORAGE_READ_CACHE_SECONDS
+    ):
+        self.backend = backend
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.read_cache_seconds = read_cache_seconds
+        self._cache: Dict[str, Tuple[float, Any]] = {}
+
+    async def _read(self, key: str) -> Any:
+        """Значение из кэша, если оно свежее, иначе из хранилища"""
+        now = monotonic()
+        cached = self._cache.get(key)
+        if cached is not None and now - cached[0] < self.read_cache_seconds:
+            return copy.deepcopy(cached[1])
+        value = await self.backend.get(self.namespace, key)
+        self._remember(key, value, now)
+        return copy.deepcopy(value)
+
+    async def _write(self, key: str, value: Any) -> None:
+        await self.backend.set(self.namespace, key, value)
+        self._remember(key, copy.deepcopy(value), monotonic())
+
+    def _remember(self, key: str, value: Any, now: float) -> None:
+        if self.read_cache_seconds <= 0:
+            return
+        # Устаревшие записи чистятся попутно, чтобы кэш не рос по числу гостей
+        if len(self._cache) >= 1000:
+            self._cache = {
+                k: v for k, v in self._cache.items()
+                if now - v[0] < self.read_cache_seconds
+            }
+        self._cache[key] = (now, value)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self._write(self.key_builder.build(key, "state"), state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._read(self.key_builder.build(key, "state"))
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._write(self.key_builder.build(key, "data"), dict(data) or None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return await self._read(self.key_builder.build(key, "data")) or {}
+
+    async def close(self) -> None:
+        # Хранилище общее с контекстами диалогов — его закрывает run.py после сброса контекстов
+        pass
+
+
+def create_backend(session_maker: async_sessionmaker[AsyncSession]) -> Optional[KeyValueBackend]:
+    """Создаёт хранилище по настройке STORAGE_BACKEND (None — хранить всё в памяти процесса)"""
+    if STORAGE_BACKEND == "postgres":
+        return PostgresKeyValueBackend(session_maker)
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteKeyValueBackend(STORAGE_SQLITE_PATH)
+    return None
@@ -0,0 +1,91 @@
+import asyncio
+
+from lists_of_users.access_control import AccessStore, AccessList, ACCESS_NAMESPACE, ADMITTED, APPLICATIONS
+from storage import SQLiteKeyValueBackend
+
+
+def make_store(backend) -> AccessStore:
+    store = AccessStore(flush_delay=0.01, refresh_interval=60)
+    store.applications = AccessList({"@guest": "Гость"})
+    return store
+
+
+def test_instances_merge_changes(tmp_path):
+    async def scenario():
+        backend = SQLiteKeyValueBackend(str(tmp_path / "storage.sqlite3"))
+        first, second = make_store(backend), make_store(backend)
+        await first.attach(backend)
+        await second.attach(backend)
+
+        # Оба экземпляра меняют списки по своей копии: записи не затирают друг друга
+        assert first.approve("@Guest") == "Гость"
+        second.add_application("@other", "Другой")
+        await first.flush()
+        await second.flush()
+
+        stored = await backend.get(ACCESS_NAMESPACE, APPLICATIONS)
+        assert stored["entries"] == {"@other": "Другой"}
+        assert (await backend.get(ACCESS_NAMESPACE, ADMITTED))["entries"] == {"@guest": "Гость"}
+        # Записанные списки второй экземпляр получил при записи, остальные — при обновлении
+        assert "@guest" not in second.applications
+        assert not second.is_admitted("@guest")
+        await second.refresh()
+        assert second.is_admitted("@guest")
+        await first.refresh()
+        assert "@other" in first.applications
+
+        await first.close()
+        await second.close()
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_legacy_snapshot_is_read(tmp_path):
+    async def scenario():
+        backend = SQLiteKeyValueBackend(str(tmp_path / "storage.sqlite3"))
+        # Формат до версионирования: просто словарь {username: ФИО}
+        await backend.set(ACCESS_NAMESPACE, ADMITTED, {"@old": "Старый"})
+        store = make_store(backend)
+        await store.attach(backend)
+        assert store.is_admitted("@OLD")
+
+        store.revoke("@old")
+        await store.flush()
+        assert (await backend.get(ACCESS_NAMESPACE, ADMITTED)) == {"version": 1, "entries": {}}
+        await store.close()
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+class RacingBackend(SQLiteKeyValueBackend):
+    """Перед первой записью списка другой экземпляр успевает записать его новую версию"""
+
+    raced = True
+
+    async def set_versioned(self, namespace, items):
+        if not self.raced:
+            self.raced = True
+            await self.set(namespace, APPLICATIONS, {"version": 2, "entries": {"@rival": "Соперник"}})
+        return await super().set_versioned(namespace, items)
+
+
+def test_conflicting_write_is_retried(tmp_path):
+    async def scenario():
+        backend = RacingBackend(str(tmp_path / "storage.sqlite3"))
+        store = AccessStore(flush_delay=0.01, refresh_interval=60)
+        await store.attach(backend)
+        # Начальная запись списков прошла, теперь запись будет опережена
+        backend.raced = False
+
+        store.add_application("@mine", "Мой")
+        await store.flush()
+        stored = await backend.get(ACCESS_NAMESPACE, APPLICATIONS)
+        assert stored == {"version": 3, "entries": {"@rival": "Соперник", "@mine": "Мой"}}
+        assert store.stats()["conflicts"] == 1
+        assert "@rival" in store.applications
+        await store.close()
+        await backend.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,76 @@
+import asyncio
+from types import SimpleNamespace
+
+from answer_cache import AnswerCache, answer_cache, prompt_fingerprint
+
+
+def test_answers_are_shared_by_prompt():
+    cache = AnswerCache(similarity=0.9, enabled=True)
+    cache.store(prompt_fingerprint("общий промт"), "Где вы работали?", [1.0, 0.0], "Общий ответ")
+
+    # Гости с одинаковым системным промтом получают общий ответ
+    assert cache.lookup(prompt_fingerprint("общий промт"), [0.99, 0.05]).answer == "Общий ответ"
+    # С другим промтом (персональные примеры стиля) ответ не переиспользуется
+    assert cache.lookup(prompt_fingerprint("промт гостя"), [1.0, 0.0]) is None
+    assert cache.stats()["prompts"] == 1
+
+
+def test_eviction_keeps_prompt_index_consistent():
+    cache = AnswerCache(similarity=0.9, max_entries=1, enabled=True)
+    cache.store("a", "вопрос", [1.0, 0.0], "ответ 1")
+    cache.store("b", "вопрос", [1.0, 0.0], "ответ 2")
+
+    assert cache.lookup("a", [1.0, 0.0]) is None
+    assert cache.lookup("b", [1.0, 0.0]).answer == "ответ 2"
+    assert cache.stats()["prompts"] == 1
+
+
+def make_message(user_id: int, text: str, replies: list):
+    async def answer(reply_text, **kwargs):
+        replies.append(reply_text)
+
+    return SimpleNamespace(text=text, from_user=SimpleNamespace(id=user_id, username="guest"), answer=answer)
+
+
+def test_cache_hit_is_kept_in_dialogue_context(monkeypatch):
+    import generate
+    import handlers.handlers as handlers
+    from context_store import context_store
+
+    async def fake_prompt(*args, **kwargs):
+        return "SYS"
+
+    async def fake_query(text):
+        return text, [1.0, 0.0]
+
+    async def fake_complete(user_id, messages):
+        return "ответ модели"
+
+    monkeypatch.setattr(generate, "build_system_prompt", fake_prompt)
+    monkeypatch.setattr(handlers, "prepare_query", fake_query)
+    monkeypatch.setattr(handlers, "SPECULATIVE_RETRIEVAL", False)
+    monkeypatch.setattr(handlers, "STREAMING_RESPONSES", False)
+    monkeypatch.setattr(generate.llm_gateway, "complete", fake_complete)
+    monkeypatch.setattr(answer_cache, "enabled", True)
+
+    async def scenario():
+        user_id = 991
+        replies = []
+        answer_cache.store(prompt_fingerprint("SYS"), "Где вы работали?", [1.0, 0.0], "Ответ из кэша")
+        try:
+            await handlers.answer_turn([make_message(user_id, "Где вы работали?", replies)], None, None, None)
+            await handlers.answer_turn([make_message(user_id, "А потом?", replies)], None, None, None)
+
+            assert replies == ["Ответ из кэша", "ответ модели"]
+            assert context_store.get(user_id).messages() == [
+                {"role": "system", "content": "SYS"},
+                {"role": "user", "content": "Где вы работали?"},
+                {"role": "assistant", "content": "Ответ из кэша"},
+                {"role": "user", "content": "А потом?"},
+                {"role": "assistant", "content": "ответ модели"},
+            ]
+        finally:
+            context_store.delete(user_id)
+            answer_cache.clear()
+
+    asyncio.run(scenario())
@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+from llm_gateway import LLMGateway
+
+
+class FakeOpenAI:
+    """Поддельный OpenAI-совместимый сервер: задержка и ошибки задаются по имени модели"""
+
+    def __init__(self):
+        self.delays = {}
+        self.rate_limited = 0
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.runner = None
+        self.base_url = None
+
+    async def completions(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        model = body["model"]
+        self.requests.append(model)
+        if self.rate_limited:
+            self.rate_limited -= 1
+            return web.json_response(
+                {"error": {"message": "rate limited", "type": "rate_limit"}},
+                status=429,
+                headers={"retry-after": "0"}
+            )
+
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delays.get(model, 0))
+        finally:
+            self.active -= 1
+        return web.json_response({
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": f"ответ {model}"},
+                "finish_reason": "stop"
+            }],
+        })
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.completions)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}/v1"
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+
+def run_with_server(scenario):
+    async def main():
+        server = FakeOpenAI()
+        await server.start()
+        try:
+            await scenario(server)
+        finally:
+            await server.stop()
+
+    asyncio.run(main())
+
+
+def make_gateway(server: FakeOpenAI, **kwargs) -> LLMGateway:
+    options = dict(
+        base_url=server.base_url,
+        api_key="test",
+        model="primary",
+        hedge_model="",
+        hedge_after=10.0,
+        max_concurrency=10,
+        max_per_user=1,
+        max_queue=10,
+        max_retries=3,
+        backoff_base=0.01,
+        backoff_max=0.05
+    )
+    options.update(kwargs)
+    return LLMGateway(**options)
+
+
+MESSAGES = [{"role": "user", "content": "привет"}]
+
+
+def test_per_user_limit():
+    async def scenario(server):
+        server.delays["primary"] = 0.2
+        gateway = make_gateway(server)
+        # Запросы одного пользователя идут по одному
+        await asyncio.gather(*(gateway.complete(1, MESSAGES) for _ in range(3)))
+        assert server.max_active == 1
+
+        # Разные пользователи не ждут друг друга
+        server.max_active = 0
+        await asyncio.gather(*(gateway.complete(user_id, MESSAGES) for user_id in (1, 2, 3)))
+        assert server.max_active == 3
+        await gateway.close()
+
+    run_with_server(scenario)
+
+
+def test_rate_limit_is_retried():
+    async def scenario(server):
+        server.rate_limited = 2
+        gateway = make_gateway(server)
+        assert await gateway.complete(1, MESSAGES) == "ответ primary"
+        stats = gateway.stats()
+        assert stats["retries"] == 2
+        assert stats["attempts"] == 3
+        assert stats["failures"] == 0
+        await gateway.close()
+
+    run_with_server(scenario)
+
+
+def test_slow_primary_is_hedged():
+    async def scenario(server):
+        server.delays["primary"] = 1.0
+        gateway = make_gateway(server, hedge_model="backup", hedge_after=0.1)
+        assert await gateway.complete(1, MESSAGES) == "ответ backup"
+        stats = gateway.stats()
+        assert stats["hedges"] == 1
+        assert stats["hedge_wins"] == 1
+        assert server.requests == ["primary", "backup"]
+        # Отмена проигравшего запроса отслеживается и завершается при закрытии
+        await gateway.close()
+        assert not gateway._discards
+
+    run_with_server(scenario)
+
+
+def test_fast_primary_is_not_hedged():
+    async def scenario(server):
+        gateway = make_gateway(server, hedge_model="backup", hedge_after=1.0)
+        assert await gateway.complete(1, MESSAGES) == "ответ primary"
+        assert gateway.stats()["hedges"] == 0
+        assert server.requests == ["primary"]
+        await gateway.close()
+
+    run_with_server(scenario)
@@ -0,0 +1,12 @@
+from collections import deque
+
+from metrics import percentile
+
+
+def test_percentile():
+    assert percentile([], 95) == 0.0
+    assert percentile(deque([5.0]), 50) == 5.0
+    values = [float(value) for value in range(1, 101)]
+    assert percentile(values, 50) == 51.0
+    assert percentile(values, 95) == 95.0
+    assert percentile(values, 100) == 100.0
@@ -0,0 +1,192 @@
+import asyncio
+from time import time
+
+from aiogram.fsm.storage.base import StorageKey
+
+from context_store import ContextStore, CONTEXT_NAMESPACE
+from storage import SQLiteKeyValueBackend, KeyValueFSMStorage
+
+
+def make_backend(tmp_path) -> SQLiteKeyValueBackend:
+    return SQLiteKeyValueBackend(str(tmp_path / "storage.sqlite3"))
+
+
+class CountingBackend(SQLiteKeyValueBackend):
+    """Считает чтения, чтобы проверить, сколько запросов уходит в хранилище"""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.reads = 0
+
+    async def get(self, namespace, key):
+        self.reads += 1
+        return await super().get(namespace, key)
+
+
+def test_sqlite_backend_set_get_delete(tmp_path):
+    async def scenario():
+        backend = make_backend(tmp_path)
+        await backend.set_many("ns", {"a": {"x": 1}, "b": "text"})
+        assert await backend.get("ns", "a") == {"x": 1}
+        assert await backend.get("ns", "b") == "text"
+        assert await backend.get("other", "a") is None
+
+        await backend.set("ns", "a", None)
+        assert await backend.get("ns", "a") is None
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_backend_versioned_write(tmp_path):
+    async def scenario():
+        backend = make_backend(tmp_path)
+        assert await backend.set_versioned("ns", {"k": {"version": 1}}) == set()
+        assert await backend.set_versioned("ns", {"k": {"version": 2}}) == set()
+        # Версия 2 уже записана — запись на основе версии 1 отклоняется
+        assert await backend.set_versioned("ns", {"k": {"version": 2, "stale": True}}) == {"k"}
+        assert await backend.get("ns", "k") == {"version": 2}
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_fsm_storage_roundtrip(tmp_path):
+    async def scenario():
+        backend = make_backend(tmp_path)
+        storage = KeyValueFSMStorage(backend)
+        key = StorageKey(bot_id=1, chat_id=2, user_id=3)
+
+        await storage.set_state(key, "Form:waiting")
+        await storage.set_data(key, {"file": "a.json"})
+        # Второй экземпляр бота видит то же состояние
+        other = KeyValueFSMStorage(backend, read_cache_seconds=0)
+        assert await other.get_state(key) == "Form:waiting"
+        assert await other.get_data(key) == {"file": "a.json"}
+
+        await storage.set_state(key, None)
+        await storage.set_data(key, {})
+        assert await other.get_state(key) is None
+        assert await other.get_data(key) == {}
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_fsm_storage_caches_reads(tmp_path):
+    async def scenario():
+        backend = CountingBackend(str(tmp_path / "storage.sqlite3"))
+        storage = KeyValueFSMStorage(backend, read_cache_seconds=60)
+        key = StorageKey(bot_id=1, chat_id=2, user_id=3)
+
+        await storage.set_data(key, {"file": "a.json"})
+        for _ in range(3):
+            assert await storage.get_state(key) is None
+            data = await storage.get_data(key)
+            assert data == {"file": "a.json"}
+        # Изменение возвращённого словаря не портит кэш
+        data["file"] = "b.json"
+        assert await storage.get_data(key) == {"file": "a.json"}
+        # Данные записаны сквозь кэш, состояние прочитано один раз
+        assert backend.reads == 1
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_context_fetch_reads_once_per_window(tmp_path):
+    async def scenario():
+        backend = CountingBackend(str(tmp_path / "storage.sqlite3"))
+        store = ContextStore(backend=backend)
+        store.create(1, system="SYS")
+        await store.flush()
+
+        cached = ContextStore(backend=backend, read_cache_seconds=60)
+        for _ in range(3):
+            assert (await cached.fetch(1)).system == "SYS"
+        assert backend.reads == 1
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_context_flush_and_lazy_read(tmp_path):
+    async def scenario():
+        backend = make_backend(tmp_path)
+        store = ContextStore(backend=backend)
+        store.create(1, system="SYS")
+        store.append(1, "user", "привет")
+        assert store.stats()["unsaved"] > 0
+        await store.flush()
+        assert store.stats()["unsaved"] == 0
+
+        # После перезапуска контекст читается из хранилища при первом обращении
+        restarted = ContextStore(backend=backend)
+        context = await restarted.fetch(1)
+        assert context.messages() == [
+            {"role": "system", "content": "SYS"},
+            {"role": "user", "content": "привет"},
+        ]
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_two_workers_do_not_lose_turns(tmp_path):
+    async def scenario():
+        backend = make_backend(tmp_path)
+        worker_a = ContextStore(backend=backend, read_cache_seconds=0)
+        worker_b = ContextStore(backend=backend, read_cache_seconds=0)
+        worker_a.create(1, system="SYS")
+        await worker_a.flush()
+
+        await worker_b.add_turns(1, ("user", "b1"))
+        await worker_a.add_turns(1, ("user", "a1"))
+        await worker_b.flush()
+        # Запись a1 основана на устаревшей версии: она объединяется с записью b1
+        await worker_a.flush()
+        assert worker_a.stats()["conflicts"] == 1
+        await worker_a.flush()
+
+        stored = await backend.get(CONTEXT_NAMESPACE, "1")
+        assert [content for _, content in stored["turns"]] == ["b1", "a1"]
+        # Второй экземпляр видит реплику первого при следующем обращении
+        context = await worker_b.fetch(1)
+        assert [content for _, content in context.turns] == ["b1", "a1"]
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_expired_context_is_not_loaded(tmp_path):
+    async def scenario():
+        backend = make_backend(tmp_path)
+        await backend.set_many(CONTEXT_NAMESPACE, {
+            "1": {"system": "SYS", "turns": [["u", "старое"]], "updated_at": time() - 100, "version": 1},
+        })
+        store = ContextStore(backend=backend, ttl_seconds=10)
+        assert await store.fetch(1) is None
+        assert store.stats()["expirations"] == 1
+        await store.flush()
+        assert await backend.get(CONTEXT_NAMESPACE, "1") is None
+        await backend.close()
+
+    asyncio.run(scenario())
+
+
+def test_evicted_context_is_saved_not_recreated(tmp_path):
+    async def scenario():
+        backend = make_backend(tmp_path)
+        store = ContextStore(backend=backend, max_users=1)
+        store.create(1, system="SYS")
+        store.append(1, "user", "первый")
+        store.create(2)
+        # Контекст 1 вытеснен до записи: append не создаёт пустой, fetch возвращает его с историей
+        assert store.append(1, "user", "x") is None
+        await store.flush()
+        context = await store.fetch(1)
+        assert context.system == "SYS"
+        assert [content for _, content in context.turns] == ["первый"]
+        await backend.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,41 @@
+import asyncio
+from types import SimpleNamespace
+
+from generate import GENERATION_ERROR_TEXT
+from handlers.streaming import TelegramStreamWriter
+
+
+def make_message(sent: list, edits: list) -> SimpleNamespace:
+    async def edit_text(text, **kwargs):
+        edits.append(text)
+
+    async def answer(text, **kwargs):
+        sent.append(text)
+        return SimpleNamespace(edit_text=edit_text)
+
+    return SimpleNamespace(answer=answer)
+
+
+def test_empty_answer_replaces_placeholder():
+    async def scenario():
+        sent, edits = [], []
+        writer = TelegramStreamWriter(make_message(sent, edits), interval=0)
+        await writer.start()
+        assert await writer.finish("  ") == GENERATION_ERROR_TEXT
+        # Заглушка не остаётся «…», а заменяется текстом ошибки
+        assert edits == [GENERATION_ERROR_TEXT]
+        assert len(sent) == 1
+
+    asyncio.run(scenario())
+
+
+def test_empty_answer_without_placeholder():
+    async def scenario():
+        sent, edits = [], []
+        writer = TelegramStreamWriter(make_message(sent, edits), interval=0)
+        await writer.finish("")
+        # Пустое сообщение Telegram отклонил бы — отправляется текст ошибки
+        assert sent == [GENERATION_ERROR_TEXT]
+        assert edits == []
+
+    asyncio.run(scenario())
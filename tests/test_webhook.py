@@ -0,0 +1,118 @@
+import asyncio
+
+from aiohttp import web, ClientSession
+from aiogram import Bot, Dispatcher, Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message
+
+from config import WEBHOOK_PATH
+from handlers.in_flight import InFlightMiddleware
+from webhook import create_app, webhook_secret
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class FakeBotAPI:
+    """Поддельный Bot API: запоминает вызванные методы"""
+
+    def __init__(self):
+        self.calls = []
+        self.runner = None
+        self.base_url = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.json() if request.content_type == "application/json" else dict(await request.post())
+        self.calls.append((method, data))
+        if method == "sendMessage":
+            result = {
+                "message_id": len(self.calls),
+                "date": 0,
+                "chat": {"id": int(data["chat_id"]), "type": "private"},
+                "text": data["text"],
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    def sent(self):
+        return [data["text"] for method, data in self.calls if method == "sendMessage"]
+
+
+def make_update(update_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 7, "type": "private"},
+            "from": {"id": 7, "is_bot": False, "first_name": "Гость"},
+            "text": f"m{update_id}",
+        },
+    }
+
+
+def test_secret_and_drain_on_shutdown():
+    async def scenario():
+        api = FakeBotAPI()
+        await api.start()
+        bot = Bot("42:TEST", session=AiohttpSession(api=TelegramAPIServer.from_base(api.base_url)))
+
+        tracker = InFlightMiddleware(limit=10)
+        dp = Dispatcher()
+        dp.update.outer_middleware.register(tracker)
+        router = Router()
+
+        @router.message()
+        async def slow_echo(message: Message):
+            await asyncio.sleep(0.5)
+            await message.answer("echo " + message.text)
+
+        async def on_shutdown():
+            assert await tracker.drain(5)
+
+        dp.include_router(router)
+        dp.shutdown.register(on_shutdown)
+
+        runner = web.AppRunner(create_app(dp, bot))
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+        async with ClientSession() as client:
+            async with client.get(url + "/healthz") as response:
+                assert response.status == 200
+
+            # Апдейты без секрета или с чужим секретом не обрабатываются
+            async with client.post(url + WEBHOOK_PATH, json=make_update(1)) as response:
+                assert response.status == 401
+            async with client.post(url + WEBHOOK_PATH, json=make_update(2), headers={SECRET_HEADER: "wrong"}) as response:
+                assert response.status == 401
+
+            for update_id in (3, 4, 5):
+                async with client.post(
+                    url + WEBHOOK_PATH, json=make_update(update_id), headers={SECRET_HEADER: webhook_secret()}
+                ) as response:
+                    assert response.status == 200
+
+            await asyncio.sleep(0.1)
+            assert tracker.active == 3
+
+        # Остановка дожидается начатых ответов и только потом закрывает сессию бота
+        await runner.cleanup()
+        assert sorted(api.sent()) == ["echo m3", "echo m4", "echo m5"]
+        assert tracker.processed == 3
+        await api.runner.cleanup()
+
+    asyncio.run(scenario())
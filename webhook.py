@@ -0,0 +1,120 @@
+import asyncio
+import hashlib
+import signal
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from sqlalchemy import text
+
+from handlers.in_flight import in_flight
+from config import TOKEN, WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT
+
+READY_DB_TIMEOUT = 2.0  # Сколько секунд ждать ответа БД при проверке готовности
+
+
+def webhook_secret() -> str:
+    """
+    Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token.
+
+    Если WEBHOOK_SECRET не задан, он вычисляется из токена: все экземпляры бота
+    за балансировщиком получают один и тот же секрет, а set_webhook одного из
+    них не ломает проверку у остальных.
+    """
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()
+
+
+async def set_webhook(bot: Bot, dispatcher: Dispatcher) -> None:
+    """Сообщает Telegram адрес вебхука и секрет; вызывается при запуске каждого экземпляра"""
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("Для RUN_MODE = \"webhook\" нужно указать WEBHOOK_BASE_URL в config.py")
+    url = WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH
+    await bot.set_webhook(
+        url=url,
+        secret_token=webhook_secret(),
+        allowed_updates=dispatcher.resolve_used_update_types()
+    )
+    print(f"Вебхук установлен: {url}")
+
+
+async def healthz(request: web.Request) -> web.Response:
+    """Процесс жив и отвечает на HTTP"""
+    return web.Response(text="ok")
+
+
+async def readyz(request: web.Request) -> web.Response:
+    """Экземпляр готов принимать апдейты: запуск завершён, остановка не начата, БД отвечает"""
+    app = request.app
+    if not app["started"] or in_flight.draining:
+        return web.Response(status=503, text="not ready")
+
+    session_maker = app["dispatcher"].get("async_session_maker")
+    try:
+        async with session_maker() as session:
+            await asyncio.wait_for(session.execute(text("SELECT 1")), READY_DB_TIMEOUT)
+    except Exception as e:
+        return web.Response(status=503, text=f"database unavailable: {e}")
+
+    warm_up_task = app["dispatcher"].get("warm_up_task")
+    if warm_up_task is not None and not warm_up_task.done():
+        return web.Response(status=503, text="warming up")
+    return web.Response(text="ready")
+
+
+async def _mark_started(app: web.Application) -> None:
+    app["started"] = True
+
+
+def create_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    """
+    HTTP-приложение: приём апдейтов на WEBHOOK_PATH, /healthz и /readyz.
+
+    Апдейт проверяется по секрету и обрабатывается в фоне, Telegram сразу
+    получает ответ 200. setup_application подключается раньше обработчика
+    вебхука: при остановке сначала отрабатывает shutdown диспетчера
+    (ожидание начатых ответов), и только потом закрывается сессия бота.
+
+    Очередь реплик, кэш ответов и примеры стиля живут в памяти процесса,
+    поэтому при нескольких экземплярах апдейты одного чата должны всегда
+    попадать на один экземпляр (маршрутизация по chat_id на балансировщике).
+    """
+    app = web.Application()
+    app["dispatcher"] = dp
+    app["started"] = False
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+
+    setup_application(app, dp, bot=bot)
+    app.on_startup.append(_mark_started)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=webhook_secret(),
+        handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    """Запускает HTTP-сервер и работает до SIGINT/SIGTERM"""
+    runner = web.AppRunner(create_app(dp, bot), handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    await site.start()
+    print(f"Сервер вебхука слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: остановка по Ctrl+C через KeyboardInterrupt
+            pass
+    try:
+        await stop.wait()
+    finally:
+        # Сервер перестаёт принимать соединения, затем срабатывает shutdown диспетчера
+        await runner.cleanup()